@@ -0,0 +1,282 @@
+import asyncio
+import os
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from checkpoint import RetryQueue
+from download import (KlineRequestError, drain_retry_queue, parse_kline_rows, resolve_download_start_time,
+                      resolve_update_start_time, retry_queue_callback, split_time_range)
+from exchange_info import get_exchange_info_index
+from intervals import INTERVAL_MILLISECONDS
+from markets import DEFAULT_MARKET, get_market
+from metrics import instrumented, record_request, record_symbol, stage
+from rate_limit import REQUEST_RETRIES, REQUEST_TIMEOUT, RETRY_AFTER_HEADER, USED_WEIGHT_HEADER, backoff_delay, is_retryable_status
+from resample import materialize_update
+from storage import get_storage
+
+# aiohttp 为可选依赖，只有使用异步下载时才需要安装
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# 连接池中同时保持的最大连接数
+MAX_CONNECTIONS = 32
+
+
+class AsyncKlineClient:
+    """
+    基于 aiohttp 的异步K线客户端。
+    所有请求共用一个有上限的 keep-alive 连接池，并和线程版一样经过共享的权重限速器，
+    因此可以在单核上保持几百个在途请求而不超出权重预算。
+    (aiohttp 不支持 HTTP/1.1 pipelining，并发靠连接复用和多个连接实现。)
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, market=DEFAULT_MARKET):
+        """
+        :param max_connections: 连接池大小
+        :param market: 市场 "spot" / "um" / "cm"，决定接口地址和使用的限速器
+        """
+        if aiohttp is None:
+            raise ImportError("异步下载需要安装 aiohttp: pip install aiohttp")
+        self.max_connections = max_connections
+        self.market = get_market(market)
+        self.limiter = self.market.limiter
+        self._session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+
+    async def get_json(self, url, params=None, weight=1):
+        """
+        经过限速器发送GET请求并解析JSON，重试规则与 rate_limited_get 相同：
+        限频 (429/418) 时按 Retry-After 等待，服务端错误 (5xx) 和网络异常按指数退避 + 抖动重试
+        """
+        for attempt in range(REQUEST_RETRIES + 1):
+            wait = self.limiter.reserve(weight)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            request_start = time.perf_counter()
+            try:
+                async with self._session.get(url, params=params) as response:
+                    record_request(url, time.perf_counter() - request_start, weight, response.status, max(wait, 0.0),
+                                   response.headers.get(USED_WEIGHT_HEADER), self.limiter.max_weight, attempt)
+                    self.limiter.update_from_headers(response.headers)
+                    if is_retryable_status(response.status) and attempt < REQUEST_RETRIES:
+                        if response.status in (418, 429):
+                            if RETRY_AFTER_HEADER not in response.headers:
+                                self.limiter.block(backoff_delay(attempt))
+                            print(f"[警告] 触发频率限制 (HTTP {response.status})，等待后重试...")
+                        else:
+                            print(f"[警告] 服务端错误 (HTTP {response.status})，等待后重试 ({attempt + 1}/{REQUEST_RETRIES})...")
+                            await asyncio.sleep(backoff_delay(attempt))
+                        continue
+                    response.raise_for_status()
+                    return await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                record_request(url, time.perf_counter() - request_start, weight, None, max(wait, 0.0),
+                               weight_limit=self.limiter.max_weight, attempt=attempt)
+                if attempt == REQUEST_RETRIES:
+                    raise
+                print(f"[警告] 请求异常: {e!r}，等待后重试 ({attempt + 1}/{REQUEST_RETRIES})...")
+                await asyncio.sleep(backoff_delay(attempt))
+
+    async def get_kline_data(self, symbol, interval, start_time, end_time, float32=False):
+        """
+        异步版 get_binance_kline_data：没有数据时返回空 DataFrame，请求失败时抛出 KlineRequestError
+        """
+        limit = self.market.kline_limit(interval)
+        params = {
+            "symbol": symbol,
+            "interval": interval,
+            "startTime": start_time,
+            "endTime": end_time,
+            "limit": limit
+        }
+        try:
+            data = await self.get_json(self.market.kline_url, params=params, weight=self.market.kline_weight(limit))
+        except Exception as e:
+            print(f"[错误] 请求失败: {e}")
+            raise KlineRequestError(f"{symbol} {interval} {start_time}-{end_time}: {e}") from e
+        with stage("parse"):
+            return parse_kline_rows(data, float32=float32)
+
+    async def fetch_klines(self, symbol, interval, start_time, end_time, float32=False, on_failure=None):
+        """
+        下载一段时间范围的K线：固定长度的周期按整页窗口同时发出所有请求，否则顺序分页
+        :param on_failure: 窗口请求失败时的回调 on_failure(开始时间, 结束时间, 异常)，None 表示抛出 KlineRequestError
+        :return: 按 Open time 排序的 DataFrame
+        """
+        async def fetch_window(window_start, window_end):
+            try:
+                return await self.get_kline_data(symbol, interval, window_start, window_end - 1, float32)
+            except KlineRequestError as e:
+                if on_failure is None:
+                    raise
+                on_failure(window_start, window_end - 1, e)
+                return pd.DataFrame()
+
+        if interval in INTERVAL_MILLISECONDS:
+            # Binance 的 endTime 是闭区间，窗口结束时间减 1 毫秒，避免相邻窗口重复
+            windows = split_time_range(start_time, end_time + 1, interval, limit=self.market.kline_limit(interval))
+            pages = await asyncio.gather(*[fetch_window(window_start, window_end) for window_start, window_end in windows])
+        else:
+            pages = []
+            current_start_time = start_time
+            while current_start_time < end_time:
+                request_end_time = end_time if self.market.max_window_ms is None else min(end_time, current_start_time + self.market.max_window_ms - 1)
+                df = await self.get_kline_data(symbol, interval, current_start_time, request_end_time, float32)
+                if df.empty:
+                    break
+                pages.append(df)
+                current_start_time = int(df["Open time"].iloc[-1].timestamp() * 1000) + 1
+
+        pages = [page for page in pages if not page.empty]
+        if not pages:
+            return pd.DataFrame()
+        return pd.concat(pages, ignore_index=True)
+
+
+async def _download_async(symbols, interval, start_time, end_time, storage, max_workers, max_connections, retry_queue, market):
+    semaphore = asyncio.Semaphore(max_workers)
+    loop = asyncio.get_running_loop()
+
+    async with AsyncKlineClient(max_connections=max_connections, market=market) as client:
+        async def download_symbol_data(symbol):
+            async with semaphore:
+                try:
+                    print(f"[信息] 开始下载 {symbol} 的数据...")
+                    symbol_start = time.perf_counter()
+                    # 可能需要请求交易对的最早K线，放到线程池中执行，不阻塞事件循环
+                    current_start_time = await loop.run_in_executor(
+                        None, resolve_download_start_time, symbol, start_time, end_time, market)
+                    if current_start_time is None:
+                        return symbol, False
+
+                    all_data = await client.fetch_klines(symbol, interval, current_start_time, end_time,
+                                                         on_failure=retry_queue_callback(retry_queue, symbol, interval))
+                    print(f"[提示] {symbol} 数据已下载完成")
+
+                    # 写文件是阻塞操作，放到线程池中执行，不阻塞其他交易对的网络请求
+                    output_file = await loop.run_in_executor(None, storage.write, symbol, interval, all_data)
+                    record_symbol(symbol, len(all_data), time.perf_counter() - symbol_start)
+                    print(f"[完成] {symbol} 数据已保存到 {output_file}")
+                    return symbol, True
+                except Exception as e:
+                    print(f"[错误] 下载 {symbol} 数据时出错: {e}")
+                    return symbol, False
+
+        return await asyncio.gather(*[download_symbol_data(symbol) for symbol in symbols])
+
+
+# 异步版的下载K线数据方法
+@instrumented("download")
+def download_historical_data_async(symbols, interval, start_date, end_date, output_dir="./binance_data", max_workers=10,
+                                   backend="pickle", max_connections=MAX_CONNECTIONS, market=DEFAULT_MARKET):
+    """
+    批量下载多个交易对的历史数据并保存（asyncio 版本，参数与 download_historical_data_multi_threads 一致）
+    :param symbols: 要下载的交易对列表。例如 ["BTCUSDT", "ETHUSDT"]
+    :param interval: K线周期
+    :param start_date: 开始日期。例如 2023-01-01
+    :param end_date: 结束日期。例如 2023-10-01
+    :param output_dir: 数据保存的目录
+    :param max_workers: 同时处理的交易对数量
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"
+    :param max_connections: 连接池大小
+    :param market: 市场 "spot" / "um" (默认) / "cm"
+    """
+    market = get_market(market)
+    output_dir = market.data_dir(output_dir)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    storage = get_storage(output_dir, backend)
+
+    # 转换开始和结束日期为时间戳
+    start_time = int(datetime.strptime(start_date, "%Y-%m-%d").timestamp() * 1000)
+    end_time = int(datetime.strptime(end_date, "%Y-%m-%d").timestamp() * 1000)
+
+    # 先同步加载 exchangeInfo 缓存，之后查询上市时间不会阻塞事件循环
+    get_exchange_info_index(market=market)
+
+    # 失败的分页记入重试队列，所有交易对下载完后重新下载
+    retry_queue = RetryQueue(output_dir)
+    results = asyncio.run(_download_async(symbols, interval, start_time, end_time, storage, max_workers, max_connections,
+                                          retry_queue, market))
+    drain_retry_queue(retry_queue, storage, interval, max_workers, market=market)
+    successful_symbols = [symbol for symbol, success in results if success]
+    failed_symbols = [symbol for symbol, success in results if not success]
+
+    print(f"[总结] 成功下载 {len(successful_symbols)} 个交易对数据，失败 {len(failed_symbols)} 个。")
+    if failed_symbols:
+        print(f"[失败列表]: {failed_symbols}")
+
+
+async def _update_async(symbols, interval, storage, update_start_time, max_workers, max_connections, materialize, retry_queue,
+                        market):
+    semaphore = asyncio.Semaphore(max_workers)
+    loop = asyncio.get_running_loop()
+
+    async with AsyncKlineClient(max_connections=max_connections, market=market) as client:
+        async def update_single_symbol(symbol):
+            async with semaphore:
+                try:
+                    symbol_start = time.perf_counter()
+                    current_start_time = await loop.run_in_executor(
+                        None, resolve_update_start_time, storage, symbol, interval, update_start_time, market)
+                    if current_start_time is None:
+                        return
+
+                    # 获取当前时间作为结束时间
+                    end_time = int(datetime.now().timestamp() * 1000)
+
+                    print(f"[信息] {symbol}: 开始从 {datetime.fromtimestamp(current_start_time / 1000)} 补充数据")
+                    all_new_data = await client.fetch_klines(symbol, interval, current_start_time, end_time,
+                                                             on_failure=retry_queue_callback(retry_queue, symbol, interval))
+
+                    # 只追加新的尾部数据，重叠窗口在存储层合并去重
+                    output_file = await loop.run_in_executor(None, storage.append, symbol, interval, all_new_data)
+                    print(f"[完成] {symbol} 数据已更新并保存到 {output_file}")
+
+                    if materialize and not all_new_data.empty:
+                        since = int(all_new_data["Open time"].iloc[0].timestamp() * 1000)
+                        written = await loop.run_in_executor(
+                            None, materialize_update, storage, symbol, interval, materialize, since)
+                        print(f"[完成] {symbol} 高级别周期已更新: {written}")
+                    record_symbol(symbol, len(all_new_data), time.perf_counter() - symbol_start)
+                except Exception as e:
+                    print(f"[错误] 数据下载时出错: {e}")
+
+        await asyncio.gather(*[update_single_symbol(symbol) for symbol in symbols])
+
+
+# 异步版更新数据
+@instrumented("update")
+def update_historical_data_async(symbols, interval, output_dir, update_start_time=None, max_workers=5, backend="pickle",
+                                 max_connections=MAX_CONNECTIONS, materialize=None, market=DEFAULT_MARKET):
+    """
+    补充下载指定交易对的数据并保存（asyncio 版本，参数与 update_historical_data_multi_threaded 一致）
+    :param symbols: 交易对列表，例如 ["BTCUSDT", "ETHUSDT"]
+    :param interval: K线周期，例如 "1h", "1d"
+    :param output_dir: 数据保存文件夹
+    :param update_start_time: 起始更新时间，例如 "yyyy-mm-dd"
+    :param max_workers: 同时处理的交易对数量
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"
+    :param max_connections: 连接池大小
+    :param materialize: 同时维护的高级别周期列表，例如 ["1h", "4h", "1d"]
+    :param market: 市场 "spot" / "um" (默认) / "cm"
+    """
+    market = get_market(market)
+    storage = get_storage(market.data_dir(output_dir), backend)
+    get_exchange_info_index(market=market)
+    retry_queue = RetryQueue(storage.root)
+    asyncio.run(_update_async(symbols, interval, storage, update_start_time, max_workers, max_connections, materialize,
+                              retry_queue, market))
+    drain_retry_queue(retry_queue, storage, interval, max_workers, materialize=materialize, market=market)
@@ -0,0 +1,310 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+from check import check_data_completeness
+from download import (KLINE_COLUMNS, download_historical_data_multi_threads, get_binance_kline_data, parse_kline_rows,
+                      update_historical_data_multi_threaded)
+from fake_binance import FakeBinanceServer
+from resample import resample_klines
+from storage import get_storage
+from tools import create_prices_dataframe, resample_to_higher_freq
+
+# 离线基准测试中客户端限速器的权重上限，足够大时只测量代码本身的吞吐
+BENCH_CLIENT_WEIGHT_LIMIT = 10 ** 7
+
+
+def make_kline_pages(total_rows, page_size=1000, interval_ms=60 * 1000, start_time=1577836800000):
+    """
+    生成模拟的分页K线数据
+    :param total_rows: 总行数
+    :param page_size: 每页行数
+    :param interval_ms: K线周期（毫秒）
+    :param start_time: 第一根K线的开始时间，时间戳(毫秒)
+    :return: DataFrame 列表，每个元素为一页
+    """
+    rng = np.random.default_rng(0)
+    pages = []
+    for page_start in range(0, total_rows, page_size):
+        n = min(page_size, total_rows - page_start)
+        open_time = start_time + (page_start + np.arange(n, dtype=np.int64)) * interval_ms
+        prices = rng.random((n, 4)) + 100
+        volumes = rng.random((n, 4)) * 1000
+        df = pd.DataFrame({
+            "Open time": pd.to_datetime(open_time, unit="ms"),
+            "Close time": pd.to_datetime(open_time + interval_ms - 1, unit="ms"),
+            "Open": prices[:, 0], "High": prices[:, 1], "Low": prices[:, 2], "Close": prices[:, 3],
+            "Volume": volumes[:, 0], "Quote asset volume": volumes[:, 1],
+            "Number of trades": rng.integers(0, 1000, n),
+            "Taker buy base asset volume": volumes[:, 2], "Taker buy quote asset volume": volumes[:, 3],
+        })
+        pages.append(df)
+    return pages
+
+
+def bench_page_accumulation(total_rows=1_200_000, page_size=1000):
+    """
+    对比两种分页累积方式：每页 pd.concat 到累积表 vs 先收集到列表最后合并一次
+    :param total_rows: 总行数 (默认 120 万行，约等于 2.3 年的 1m 数据)
+    :param page_size: 每页行数
+    :return: {"rows": 行数, "concat_per_page": 秒, "collect_then_concat": 秒}
+    """
+    pages = make_kline_pages(total_rows, page_size)
+
+    start = time.perf_counter()
+    all_data = pd.DataFrame()
+    for df in pages:
+        all_data = pd.concat([all_data, df], ignore_index=True)
+    concat_per_page = time.perf_counter() - start
+
+    start = time.perf_counter()
+    collected = []
+    for df in pages:
+        collected.append(df)
+    result = pd.concat(collected, ignore_index=True)
+    collect_then_concat = time.perf_counter() - start
+
+    assert result.equals(all_data)
+    return {"rows": total_rows, "concat_per_page": concat_per_page, "collect_then_concat": collect_then_concat}
+
+
+def make_raw_kline_page(page_size=1000, interval_ms=60 * 1000, start_time=1577836800000):
+    """
+    生成与 klines 接口返回格式一致的原始数组 (数值字段为字符串)
+    """
+    rng = np.random.default_rng(0)
+    rows = []
+    for i in range(page_size):
+        open_time = start_time + i * interval_ms
+        p = rng.random(4) + 100
+        v = rng.random(4) * 1000
+        rows.append([open_time, f"{p[0]:.2f}", f"{p[1]:.2f}", f"{p[2]:.2f}", f"{p[3]:.2f}", f"{v[0]:.3f}",
+                     open_time + interval_ms - 1, f"{v[1]:.5f}", int(rng.integers(0, 1000)),
+                     f"{v[2]:.3f}", f"{v[3]:.5f}", "0"])
+    return json.loads(json.dumps(rows))
+
+
+def _parse_kline_rows_pandas(data):
+    """
+    旧版解析方式：先构造字符串 DataFrame，再逐列 to_numeric
+    """
+    columns = [
+        "Open time", "Open", "High", "Low", "Close", "Volume",
+        "Close time", "Quote asset volume", "Number of trades",
+        "Taker buy base asset volume", "Taker buy quote asset volume", "Ignore"
+    ]
+    df = pd.DataFrame(data, columns=columns)
+    df["Open time"] = pd.to_datetime(df["Open time"], unit="ms")
+    df["Close time"] = pd.to_datetime(df["Close time"], unit="ms")
+    numeric_columns = ["Open", "High", "Low", "Close", "Volume",
+                       "Quote asset volume", "Taker buy base asset volume", "Taker buy quote asset volume"]
+    for col in numeric_columns:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    df["Number of trades"] = pd.to_numeric(df["Number of trades"], errors='coerce').astype('Int64')
+    return df[KLINE_COLUMNS]
+
+
+def bench_kline_parse(pages=300, page_size=1000):
+    """
+    对比单页K线解析速度：旧版 pandas 逐列转换 vs parse_kline_rows
+    :param pages: 解析的页数
+    :param page_size: 每页行数
+    :return: {"pages": 页数, "pandas_per_column": 秒, "parse_kline_rows": 秒, "parse_kline_rows_float32": 秒}
+    """
+    data = make_raw_kline_page(page_size)
+    result = {"pages": pages}
+    for name, parse in (("pandas_per_column", _parse_kline_rows_pandas),
+                        ("parse_kline_rows", parse_kline_rows),
+                        ("parse_kline_rows_float32", lambda rows: parse_kline_rows(rows, float32=True))):
+        start = time.perf_counter()
+        for _ in range(pages):
+            parse(data)
+        result[name] = time.perf_counter() - start
+    return result
+
+
+def bench_resample(total_rows=200_000, targets=("1h", "4h", "1d")):
+    """
+    对比把 15m 数据合并成多个周期：每个周期调用一次 resample_to_higher_freq vs resample_klines 一次计算
+    :param total_rows: 15m K线行数 (默认 20 万行，约 5.7 年)
+    :param targets: 目标周期
+    :return: {"rows": 行数, "resample_per_target": 秒, "resample_klines": 秒}
+    """
+    df = pd.concat(make_kline_pages(total_rows, interval_ms=15 * 60 * 1000), ignore_index=True)
+    pandas_freq = {"1h": "1h", "4h": "4h", "1d": "1D"}
+
+    start = time.perf_counter()
+    for target in targets:
+        resample_to_higher_freq(df, pandas_freq[target])
+    resample_per_target = time.perf_counter() - start
+
+    start = time.perf_counter()
+    resample_klines(df, "15m", targets)
+    batch = time.perf_counter() - start
+    return {"rows": total_rows, "resample_per_target": resample_per_target, "resample_klines": batch}
+
+
+def bench_kline_fetch(pages=200, interval="1m", latency=0.0):
+    """
+    通过本地替身服务测量 get_binance_kline_data 的请求 + 解析速度 (每页1000根K线)
+    :param pages: 请求的页数
+    :param interval: K线周期
+    :param latency: 替身服务每个请求的延迟（秒）
+    :return: {"pages": 页数, "seconds": 秒, "pages_per_s": 每秒页数, "rows_per_s": 每秒行数}
+    """
+    with FakeBinanceServer(["BTCUSDT"], latency=latency) as server:
+        server.install(BENCH_CLIENT_WEIGHT_LIMIT)
+        step = 60 * 1000 if interval == "1m" else int(pd.Timedelta(interval).total_seconds() * 1000)
+        start = time.perf_counter()
+        rows = 0
+        for page in range(pages):
+            page_start = server.listing_time + page * 1000 * step
+            rows += len(get_binance_kline_data("BTCUSDT", interval, page_start, page_start + 1000 * step - 1))
+        seconds = time.perf_counter() - start
+    return {"pages": pages, "seconds": seconds, "pages_per_s": pages / seconds, "rows_per_s": rows / seconds}
+
+
+def bench_offline_universe(universe_size=50, interval="15m", days=90, latency=0.0, rate_limit_every=0, retry_after=1,
+                           max_workers=10, backend="pickle"):
+    """
+    在本地替身服务上跑一遍完整流程，测量各个环节的耗时：
+    下载 → 增量更新 → 检查完整性 (清单 / 扫描文件) → create_prices_dataframe → resample_to_higher_freq
+    :param universe_size: 交易对数量
+    :param interval: K线周期
+    :param days: 下载的天数 (截止到昨天)
+    :param latency: 替身服务每个请求的延迟（秒）
+    :param rate_limit_every: 每隔多少个请求返回一次 429，0 表示不返回
+    :param retry_after: 429 响应中的 Retry-After（秒）
+    :param max_workers: 下载和更新的线程数
+    :param backend: 存储后端
+    :return: 各环节的耗时 (秒)、吞吐量和请求统计
+    """
+    symbols = [f"S{i:04d}USDT" for i in range(universe_size)]
+    end = datetime.now().date() - timedelta(days=1)
+    start_date, end_date = str(end - timedelta(days=days)), str(end)
+    result = {"universe": universe_size, "interval": interval, "days": days, "backend": backend}
+
+    with FakeBinanceServer(symbols, latency=latency, rate_limit_every=rate_limit_every, retry_after=retry_after) as server, \
+            tempfile.TemporaryDirectory() as data_dir, contextlib.redirect_stdout(io.StringIO()):
+        server.install(BENCH_CLIENT_WEIGHT_LIMIT)
+
+        def timed(name, function, *args, **kwargs):
+            start = time.perf_counter()
+            value = function(*args, **kwargs)
+            result[f"{name}_s"] = time.perf_counter() - start
+            return value
+
+        timed("download", download_historical_data_multi_threads, symbols, interval, start_date, end_date, data_dir,
+              max_workers=max_workers, backend=backend)
+        result["download_requests"] = server.stats["klines"]
+        result["download_rows_per_s"] = server.stats["rows"] / result["download_s"]
+
+        timed("update", update_historical_data_multi_threaded, symbols, interval, data_dir, max_workers=max_workers, backend=backend)
+        timed("check_manifest", check_data_completeness, symbols, interval, data_dir, required_end_date=end_date, backend=backend)
+        check = timed("check_verify", check_data_completeness, symbols, interval, data_dir, required_end_date=end_date,
+                      backend=backend, verify=True)
+        result["complete"] = not (check["missing"] or check["incomplete"] or check["gapped"])
+
+        prices = timed("load", create_prices_dataframe, data_dir, fields=["Open", "Close"], backend=backend, interval=interval)
+        result["load_rows"] = len(prices)
+
+        storage = get_storage(data_dir, backend)
+        frames = [storage.read(symbol, interval) for symbol in symbols]
+        timed("resample", lambda: [resample_to_higher_freq(df, "1h") for df in frames])
+
+        result["requests"] = server.stats["requests"]
+        result["rate_limited"] = server.stats["rate_limited"]
+    return result
+
+
+def run_benchmarks(suite="all", universe_sizes=(10, 50), interval="15m", days=90, latency=0.0, rate_limit_every=0,
+                   retry_after=1, max_workers=10, backend="pickle"):
+    """
+    运行基准测试
+    :param suite: "micro" 只测纯计算 / "offline" 只测基于替身服务的完整流程 / "all"
+    :return: 可以直接写成 JSON 的结果 {"meta": 运行环境, "results": {名称: 指标}}
+    """
+    results = {}
+    if suite in ("micro", "all"):
+        results["page_accumulation"] = bench_page_accumulation()
+        results["kline_parse"] = bench_kline_parse()
+        results["resample"] = bench_resample()
+    if suite in ("offline", "all"):
+        results["kline_fetch"] = bench_kline_fetch(latency=latency)
+        for size in universe_sizes:
+            results[f"offline_universe_{size}"] = bench_offline_universe(size, interval, days, latency, rate_limit_every,
+                                                                         retry_after, max_workers, backend)
+    meta = {"timestamp": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+            "pandas": pd.__version__, "numpy": np.__version__, "platform": platform.platform()}
+    return {"meta": meta, "results": results}
+
+
+def compare_results(current, baseline, tolerance=0.2):
+    """
+    与之前保存的结果比较，找出变慢的指标。
+    名称以 _per_s 结尾的是吞吐量 (越大越好)，其他浮点数是耗时 (越小越好)，整数和其他类型的字段不比较
+    :param current: 本次 run_benchmarks 的结果
+    :param baseline: 基准结果 (相同格式)
+    :param tolerance: 允许的相对变化，默认 20%
+    :return: [(基准名称, 指标, 基准值, 本次值), ...]
+    """
+    regressions = []
+    for name, metrics in current["results"].items():
+        base_metrics = baseline.get("results", {}).get(name, {})
+        for key, value in metrics.items():
+            base = base_metrics.get(key)
+            if not isinstance(value, float) or not isinstance(base, float) or base <= 0:
+                continue
+            if key.endswith("_per_s"):
+                regressed = value < base * (1 - tolerance)
+            else:
+                regressed = value > base * (1 + tolerance)
+            if regressed:
+                regressions.append((name, key, base, value))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="性能基准测试 (离线部分使用本地 Binance 替身服务，不访问真实接口)")
+    parser.add_argument("--suite", choices=["micro", "offline", "all"], default="all", help="运行哪一组测试")
+    parser.add_argument("--universe", type=int, nargs="*", default=[10, 50], help="离线测试的交易对数量")
+    parser.add_argument("--interval", default="15m", help="离线测试的K线周期")
+    parser.add_argument("--days", type=int, default=90, help="离线测试下载的天数")
+    parser.add_argument("--latency", type=float, default=0.0, help="替身服务每个请求的延迟（秒）")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="每隔多少个请求返回一次 429")
+    parser.add_argument("--retry-after", type=float, default=1, help="429 响应中的 Retry-After（秒）")
+    parser.add_argument("--workers", type=int, default=10, help="下载和更新的线程数")
+    parser.add_argument("--backend", default="pickle", help="存储后端")
+    parser.add_argument("--json", help="把结果写入这个 JSON 文件")
+    parser.add_argument("--baseline", help="与这个 JSON 文件中的结果比较，有指标变慢时返回非零退出码")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="比较时允许的相对变化")
+    args = parser.parse_args()
+
+    output = run_benchmarks(args.suite, args.universe, args.interval, args.days, args.latency, args.rate_limit_every,
+                            args.retry_after, args.workers, args.backend)
+    for name, metrics in output["results"].items():
+        print(f"[基准] {name}")
+        for key, value in metrics.items():
+            print(f"  {key}: {value:.4f}" if isinstance(value, float) else f"  {key}: {value}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent=2, ensure_ascii=False)
+        print(f"[完成] 结果已保存到 {args.json}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare_results(output, json.load(f), args.tolerance)
+        for name, key, base, value in regressions:
+            print(f"[回归] {name}.{key}: {base:.4f} -> {value:.4f}")
+        if regressions:
+            sys.exit(1)
+        print("[信息] 没有发现性能回归")
@@ -1,17 +1,30 @@
+import argparse
+import numpy as np
 import pandas as pd
-import os
 
-def check_data_completeness(symbols_list, interval, data_dir="./binance_data", required_start_date=None, required_end_date=None):
+from markets import DEFAULT_MARKET, get_market_storage
+from intervals import INTERVAL_MILLISECONDS, open_times_ms
+from metrics import instrumented, stage
+
+@instrumented("check")
+def check_data_completeness(symbols_list, interval, data_dir="./binance_data", required_start_date=None, required_end_date=None,
+                            backend="pickle", verify=False, market=DEFAULT_MARKET):
     """
     检查指定列表中的标的是否下载完全
     :param symbols_list: 需要检查的交易对列表，例如 ["BTCUSDT", "ETHUSDT"]
     :param interval: 时间间隔，例如 "1h", "1d"
     :param data_dir: 保存的本地数据目录
     :param required_start_date: 数据要求的起始日期 (可选: yyyy-mm-dd)
-    :return: 下载状态列表 (missing 和 incomplete 的标的列表)
+    :param required_end_date: 数据要求的结束日期 (可选: yyyy-mm-dd)
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"
+    :param verify: 是否忽略元数据清单，直接扫描数据文件 (同时刷新清单)
+    :param market: 市场 "spot" / "um" (默认) / "cm"
+    :return: 下载状态列表 (missing 和 incomplete 的标的列表，以及中间有缺口的 gapped 标的列表)
     """
+    storage = get_market_storage(data_dir, backend, market)
     missing_files = []  # 缺失的标的
     incomplete_files = []  # 数据不完整的标的
+    gapped_files = []  # 中间有缺口的标的
 
     # 将 required_start_date 转换为时间戳，如果未指定则为 None
     required_start_timestamp = None
@@ -24,37 +37,110 @@ def check_data_completeness(symbols_list, interval, data_dir="./binance_data", r
     # 遍历所有标的
     for symbol in symbols_list:
         # 构造文件路径
-        file_path = os.path.join(data_dir, f"{symbol}_{interval}.pkl")
+        file_path = storage.path(symbol, interval)
         
-        if not os.path.exists(file_path):
+        if not storage.exists(symbol, interval):
             # 如果文件不存在，则标记为缺失
             missing_files.append(symbol)
             print(f"[缺失] 文件不存在: {file_path}")
         else:
             try:
-                # 尝试读取文件
-                df = pd.read_pickle(file_path)
-                if df.empty:  # 文件存在但没有数据
+                # 优先查询清单，verify 模式或清单过期时扫描文件
+                with stage("summary"):
+                    entry = storage.summary(symbol, interval, verify=verify)
+                if entry is None or entry["rows"] == 0:  # 文件存在但没有数据
                     incomplete_files.append(symbol)
                     print(f"[不完整] 文件为空: {file_path}")
                 else:
                     if required_start_timestamp:
                         # 检查数据的起始时间是否满足要求
-                        file_start_timestamp = int(df["Open time"].iloc[0].timestamp() * 1000)
+                        file_start_timestamp = entry["first"]
                         if file_start_timestamp > required_start_timestamp:
                             incomplete_files.append(symbol)
-                            print(f"[不完整] 文件起始时间不足: {symbol}, 文件起始时间: {df['Open time'].iloc[0]}，要求起始时间: {required_start_date}")
+                            print(f"[不完整] 文件起始时间不足: {symbol}, 文件起始时间: {pd.Timestamp(file_start_timestamp, unit='ms')}，要求起始时间: {required_start_date}")
 
                     if required_end_timestamp:
                         # 检查数据的结束时间是否满足要求
-                        file_end_timestamp = int(df["Open time"].iloc[-1].timestamp() * 1000)
+                        file_end_timestamp = entry["last"]
                         if file_end_timestamp < required_end_timestamp:
                             incomplete_files.append(symbol)
-                            print(f"[不完整] 文件结束时间不足: {symbol}, 文件结束时间: {df['Open time'].iloc[-1]}，要求结束时间: {required_end_date}")
+                            print(f"[不完整] 文件结束时间不足: {symbol}, 文件结束时间: {pd.Timestamp(file_end_timestamp, unit='ms')}，要求结束时间: {required_end_date}")
+
+                    # 检查数据中间是否有缺口 (交易所停机、下载中途失败等)
+                    if entry["gaps"]:
+                        gapped_files.append(symbol)
+                        print(f"[缺口] {symbol} 数据中间有 {entry['gaps']} 处缺口")
                     
             except Exception as e:
                 # 如果文件损坏，标记为不完整
                 incomplete_files.append(symbol)
                 print(f"[错误] 无法读取文件: {file_path}, 错误: {e}")
 
-    return {"missing": missing_files, "incomplete": incomplete_files}
\ No newline at end of file
+    return {"missing": missing_files, "incomplete": incomplete_files, "gapped": gapped_files}
+
+def find_gaps(df, interval):
+    """
+    向量化扫描K线数据中间缺失的时间段
+    :param df: 按 Open time 排序的K线数据
+    :param interval: K线周期，例如 "15m", "1d"
+    :return: [(缺失的第一根K线开始时间, 缺失的最后一根K线开始时间), ...]，毫秒时间戳，两端都包含
+    """
+    step = INTERVAL_MILLISECONDS.get(interval)
+    if step is None:
+        raise ValueError(f"K线周期 {interval} 长度不固定，无法检查缺口")
+    if len(df) < 2:
+        return []
+
+    times = open_times_ms(df)
+    positions = np.flatnonzero(np.diff(times) > step)
+    return [(int(times[i] + step), int(times[i + 1] - step)) for i in positions]
+
+@instrumented("check")
+def scan_gaps(symbols_list, interval, data_dir="./binance_data", backend="pickle", verify=False, market=DEFAULT_MARKET):
+    """
+    列出每个标的数据中间缺失的时间段
+    :param symbols_list: 需要检查的交易对列表
+    :param interval: K线周期
+    :param data_dir: 保存的本地数据目录
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"
+    :param verify: 是否忽略清单中记录的缺口数量，对每个标的都扫描数据
+    :param market: 市场 "spot" / "um" (默认) / "cm"
+    :return: {symbol: [(开始时间, 结束时间), ...]}，只包含有缺口的标的
+    """
+    storage = get_market_storage(data_dir, backend, market)
+    gaps = {}
+    for symbol in symbols_list:
+        with stage("summary"):
+            entry = storage.summary(symbol, interval, verify=verify)
+        # 清单中记录没有缺口的标的不需要读取数据
+        if entry is None or entry["gaps"] == 0:
+            continue
+        with stage("scan"):
+            df = storage.read(symbol, interval, columns=["Open time"])
+            symbol_gaps = find_gaps(df, interval)
+        if symbol_gaps:
+            gaps[symbol] = symbol_gaps
+            print(f"[缺口] {symbol}: {len(symbol_gaps)} 处缺口，共缺少 "
+                  f"{sum((end - start) // INTERVAL_MILLISECONDS[interval] + 1 for start, end in symbol_gaps)} 根K线")
+    return gaps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="检查本地K线数据是否完整")
+    parser.add_argument("data_dir", help="数据目录")
+    parser.add_argument("interval", help="K线周期，例如 15m, 1d")
+    parser.add_argument("symbols", nargs="*", help="交易对列表，默认检查目录中该周期的所有交易对")
+    parser.add_argument("--start", dest="required_start_date", help="要求的起始日期 yyyy-mm-dd")
+    parser.add_argument("--end", dest="required_end_date", help="要求的结束日期 yyyy-mm-dd")
+    parser.add_argument("--backend", default="pickle", help="存储后端 pickle / parquet")
+    parser.add_argument("--verify", action="store_true", help="忽略元数据清单，直接扫描数据文件")
+    parser.add_argument("--market", default=DEFAULT_MARKET, help="市场 spot / um / cm")
+    args = parser.parse_args()
+
+    symbols = args.symbols or [symbol for symbol, interval in get_market_storage(args.data_dir, args.backend, args.market).list_datasets()
+                               if interval == args.interval]
+    check = check_data_completeness(symbols, args.interval, args.data_dir, args.required_start_date, args.required_end_date,
+                                    backend=args.backend, verify=args.verify, market=args.market)
+    print("缺失文件: ", len(check['missing']))
+    print("不完整文件: ", len(check['incomplete']))
+    print("有缺口文件: ", len(check['gapped']))
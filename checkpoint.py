@@ -0,0 +1,178 @@
+import json
+import os
+import pickle
+import threading
+
+import pandas as pd
+
+# 未完成下载的分页记录保存在数据目录下的这个子目录 (以 _ 开头，不会被当作数据集)
+PARTIAL_DIR = "_partial"
+
+# 失败分页的重试队列文件 (在 PARTIAL_DIR 中)
+RETRY_QUEUE_FILE = "retry_queue.json"
+
+
+class DownloadJournal:
+    """
+    单个交易对下载过程中的分页记录。
+    每下载到一页就用追加模式写入一条 pickle 记录并 fsync，进程崩溃或被封禁后最多丢失正在写的那一页；
+    下次以 resume 模式运行时读回已有分页，只下载剩余的部分。
+    文件的第一条记录是下载任务的参数 (开始、结束时间、下载方式)，参数不一致时旧记录作废。
+    """
+
+    def __init__(self, output_dir, symbol, interval):
+        """
+        :param output_dir: 数据目录
+        :param symbol: 交易对
+        :param interval: K线周期
+        """
+        self.path = os.path.join(output_dir, PARTIAL_DIR, f"{symbol}_{interval}.journal")
+        self._lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def start(self, **task):
+        """
+        新建记录文件 (覆盖旧记录)，写入任务参数
+        :param task: 任务参数，例如 start_time=..., end_time=..., sharded=...
+        """
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._lock, open(self.path, "wb") as f:
+            pickle.dump(task, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append(self, df):
+        """
+        追加一页数据并立即落盘，可以被多个分页线程同时调用
+        """
+        if df.empty:
+            return
+        with self._lock, open(self.path, "ab") as f:
+            pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load(self, **task):
+        """
+        读回已记录的分页。最后一条记录可能在写入时中断，读到损坏的记录时截断文件并丢弃它
+        :param task: 本次任务参数，与记录中的参数一致时才读取
+        :return: 分页 DataFrame 列表；记录不存在或任务参数不一致时返回 None
+        """
+        if not self.exists():
+            return None
+
+        pages = []
+        with self._lock, open(self.path, "rb+") as f:
+            try:
+                header = pickle.load(f)
+            except Exception:
+                return None
+            if header != task:
+                return None
+
+            valid_offset = f.tell()
+            while True:
+                try:
+                    pages.append(pickle.load(f))
+                    valid_offset = f.tell()
+                except EOFError:
+                    break
+                except Exception:
+                    print(f"[警告] 下载记录 {self.path} 末尾的分页不完整，已丢弃")
+                    f.truncate(valid_offset)
+                    break
+        return pages
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.path)
+
+
+class RetryQueue:
+    """
+    请求失败 (重试用完后仍失败) 的分页时间段队列，保存在 {数据目录}/_partial/retry_queue.json。
+    下载和更新时失败的分页不再截断后面的数据，而是记入队列，在本次运行结束前重新下载；
+    仍然失败的时间段留在文件中，下一次运行时继续重试。每次修改都会立即写盘，可以被多个线程同时调用。
+    """
+
+    def __init__(self, output_dir):
+        """
+        :param output_dir: 数据目录
+        """
+        self.path = os.path.join(output_dir, PARTIAL_DIR, RETRY_QUEUE_FILE)
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    for entry in json.load(f):
+                        self._entries[self._key(entry)] = entry
+            except Exception as e:
+                print(f"[警告] 无法读取重试队列 {self.path}: {e}")
+
+    @staticmethod
+    def _key(entry):
+        return entry["symbol"], entry["interval"], entry["start_time"], entry["end_time"]
+
+    def _save(self):
+        if not self._entries:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(list(self._entries.values()), f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    def put(self, symbol, interval, start_time, end_time, error=None):
+        """
+        记录一个失败的时间段，已经在队列中时增加失败次数
+        :param start_time: 开始时间，时间戳(毫秒)
+        :param end_time: 结束时间，时间戳(毫秒) (包含)
+        :param error: 失败原因
+        """
+        entry = {"symbol": symbol, "interval": interval, "start_time": int(start_time), "end_time": int(end_time),
+                 "attempts": 1, "error": None if error is None else str(error)}
+        with self._lock:
+            key = self._key(entry)
+            if key in self._entries:
+                entry["attempts"] = self._entries[key]["attempts"] + 1
+            self._entries[key] = entry
+            self._save()
+
+    def remove(self, entry):
+        with self._lock:
+            if self._entries.pop(self._key(entry), None) is not None:
+                self._save()
+
+    def pending(self, interval=None, symbols=None):
+        """
+        :param interval: 只返回该周期的时间段，None 表示全部
+        :param symbols: 只返回这些交易对的时间段，None 表示全部
+        :return: 队列中的时间段列表 (副本)，按交易对和开始时间排序
+        """
+        with self._lock:
+            entries = [dict(entry) for entry in self._entries.values()
+                       if (interval is None or entry["interval"] == interval) and (symbols is None or entry["symbol"] in symbols)]
+        return sorted(entries, key=lambda entry: (entry["symbol"], entry["start_time"]))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def merge_pages(pages):
+    """
+    合并分页并按 Open time 排序去重 (断点前后的分页可能有重叠)
+    """
+    pages = [page for page in pages if not page.empty]
+    if not pages:
+        return pd.DataFrame()
+    df = pd.concat(pages, ignore_index=True)
+    return df.drop_duplicates(subset="Open time", keep="last").sort_values("Open time").reset_index(drop=True)
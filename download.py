@@ -1,29 +1,74 @@
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
-import requests
 import time
 import os
 
-# 如果为现货标的
-spot_kline_url = 'https://api.binance.com/api/v3/klines'
+from rate_limit import rate_limited_get
+from exchange_info import get_exchange_info_index
+from markets import DEFAULT_MARKET, get_market, get_market_storage
+from storage import get_storage
+from intervals import INTERVAL_MILLISECONDS
+from check import find_gaps, scan_gaps
+from resample import materialize_update
+from checkpoint import DownloadJournal, RetryQueue, merge_pages
+from metrics import instrumented, record_symbol, stage
+
+# 各市场 (现货 / U本位合约 / 币本位合约) 的接口地址、权重和限速器见 markets.py
+
+# 单页K线条数上限
+KLINE_LIMIT = 1000
+
+# 更新时从已有数据的最后一根K线往前覆盖5天，修正交易所事后调整过的K线
+UPDATE_OVERLAP_MS = 5 * 24 * 60 * 60 * 1000
+
+# 一次运行结束前最多把重试队列中的时间段重新下载几轮
+RETRY_QUEUE_ROUNDS = 3
+
+# 每轮重新下载之间的等待时间（秒），给交易所和网络恢复的时间
+RETRY_QUEUE_DELAY = 5
+
+
+class KlineRequestError(Exception):
+    """
+    K线请求失败 (网络重试用完后仍然失败)。与"没有更多数据" (返回空 DataFrame) 区分开，
+    分页下载遇到它时不能当作下载结束
+    """
 
-# 如果为合约标的
-swap_kline_url = 'https://fapi.binance.com/fapi/v1/klines'
 
 # 多线程版的下载K线数据方法
-def download_historical_data_multi_threads(symbols, interval, start_date, end_date, output_dir="./binance_data", max_workers=10):
+@instrumented("download")
+def download_historical_data_multi_threads(symbols, interval, start_date, end_date, output_dir="./binance_data", max_workers=10,
+                                           sharded=False, page_workers=None, backend="pickle", resume=False, market=DEFAULT_MARKET):
     """
-    批量下载多个交易对的历史数据并保存为pkl文件（多线程版本）
+    批量下载多个交易对的历史数据并保存（多线程版本）
     :param symbols: 要下载的交易对列表。例如 ["BTCUSDT", "ETHUSDT"]
     :param interval: K线周期
     :param start_date: 开始日期。例如 2023-01-01
     :param end_date: 结束日期。例如 2023-10-01
     :param output_dir: 数据保存的目录
     :param max_workers: 并发线程数
+    :param sharded: 是否把单个交易对的时间范围切成整页窗口并发下载 (适合 BTC/ETH 这类历史很长的标的)
+    :param page_workers: 分片模式下共享的分页下载线程数，默认与 max_workers 相同
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"
+    :param resume: 是否从上次中断的地方继续：已下载完成的交易对直接跳过，未完成的从记录的分页之后继续下载
+    :param market: 市场 "spot" / "um" (默认，U本位合约) / "cm" (币本位合约)，现货和币本位合约保存在数据目录的子目录中
     """
+    market = get_market(market)
+    output_dir = market.data_dir(output_dir)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
+    storage = get_storage(output_dir, backend)
+
+    if sharded and interval not in INTERVAL_MILLISECONDS:
+        print(f"[提示] K线周期 {interval} 长度不固定，不支持分片下载，改为顺序分页下载")
+        sharded = False
+
+    # 分片模式下所有交易对共享同一个分页线程池
+    page_executor = ThreadPoolExecutor(max_workers=page_workers or max_workers) if sharded else None
+    # 失败的分页记入重试队列，所有交易对下载完后重新下载
+    retry_queue = RetryQueue(output_dir)
 
     # 转换开始和结束日期为时间戳
     start_time = int(datetime.strptime(start_date, "%Y-%m-%d").timestamp() * 1000)
@@ -35,36 +80,49 @@ def download_historical_data_multi_threads(symbols, interval, start_date, end_da
         """
         try:
             print(f"[信息] 开始下载 {symbol} 的数据...")
-            listing_time = get_symbol_listing_time(symbol)
-            if not listing_time:
-                print(f"[跳过] 无法获取 {symbol} 的上市时间，跳过...")
+            symbol_start = time.perf_counter()
+            current_start_time = resolve_download_start_time(symbol, start_time, end_time, market)
+            if current_start_time is None:
                 return symbol, False
-            
-            if listing_time > end_time:
-                print(f"[跳过] {symbol} 上市时间晚于结束时间 {end_date}，跳过...")
-                return symbol, False
-
-            # 如果上市时间晚于开始时间，则调整为上市时间
-            if listing_time > start_time:
-                print(f"[提示] {symbol} 上市时间晚于起始时间 {start_date}，使用上市时间 {datetime.fromtimestamp(listing_time / 1000).strftime('%Y-%m-%d')} 作为开始时间。")
-            current_start_time = max(start_time, listing_time)
-
-            all_data = pd.DataFrame()
-
-            while current_start_time < end_time:
-                df = get_binance_kline_data(symbol, interval, current_start_time, end_time)
-                if df.empty:
-                    print(f"[提示] {symbol} 数据已下载完成")
-                    break
-
-                all_data = pd.concat([all_data, df], ignore_index=True)
-                current_start_time = int(df["Open time"].iloc[-1].timestamp() * 1000) + 1
-                # 日级别可以设置为0.2
-                time.sleep(1)  # 避免触发API频率限制
 
-            # 保存数据
-            output_file = os.path.join(output_dir, f"{symbol}_{interval}.pkl")
-            all_data.to_pickle(output_file)
+            journal = DownloadJournal(output_dir, symbol, interval)
+            if resume and not journal.exists() and is_download_complete(storage, symbol, interval, end_time):
+                print(f"[跳过] {symbol} 数据已下载完成")
+                return symbol, True
+
+            # 每下载到一页就写入分页记录，中断后可以从记录处继续
+            task = {"start_time": current_start_time, "end_time": end_time, "sharded": sharded}
+            pages = journal.load(**task) if resume else None
+            if pages is None:
+                journal.start(**task)
+                pages = []
+            elif pages:
+                print(f"[信息] {symbol} 从下载记录恢复 {sum(len(page) for page in pages)} 根K线")
+
+            if sharded:
+                # 跳过已经记录过的整页窗口
+                span = INTERVAL_MILLISECONDS[interval] * market.kline_limit(interval)
+                done_windows = {current_start_time + (int(page["Open time"].iloc[0].timestamp() * 1000) - current_start_time) // span * span
+                                for page in pages}
+                new_data = fetch_klines_sharded(symbol, interval, current_start_time, end_time, page_executor,
+                                                on_page=journal.append, skip_windows=done_windows,
+                                                on_failure=retry_queue_callback(retry_queue, symbol, interval), market=market)
+            else:
+                resume_time = int(pages[-1]["Open time"].iloc[-1].timestamp() * 1000) + 1 if pages else current_start_time
+                new_data = fetch_klines(symbol, interval, resume_time, end_time, on_page=journal.append,
+                                        on_failure=retry_queue_callback(retry_queue, symbol, interval), market=market)
+            if pages:
+                with stage("concat"):
+                    all_data = merge_pages(pages + [new_data])
+            else:
+                all_data = new_data
+            print(f"[提示] {symbol} 数据已下载完成")
+
+            # 保存数据，保存成功后才删除分页记录
+            with stage("write"):
+                output_file = storage.write(symbol, interval, all_data)
+            journal.remove()
+            record_symbol(symbol, len(all_data), time.perf_counter() - symbol_start)
             print(f"[完成] {symbol} 数据已保存到 {output_file}")
             return symbol, True
 
@@ -76,98 +134,313 @@ def download_historical_data_multi_threads(symbols, interval, start_date, end_da
     successful_symbols = []
     failed_symbols = []
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(download_symbol_data, symbol): symbol for symbol in symbols}
-
-        for future in as_completed(futures):
-            symbol = futures[future]
-            try:
-                result_symbol, success = future.result()
-                if success:
-                    successful_symbols.append(result_symbol)
-                else:
-                    failed_symbols.append(result_symbol)
-            except Exception as e:
-                print(f"[错误] 处理 {symbol} 结果时出错: {e}")
-                failed_symbols.append(symbol)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(download_symbol_data, symbol): symbol for symbol in symbols}
+
+            for future in as_completed(futures):
+                symbol = futures[future]
+                try:
+                    result_symbol, success = future.result()
+                    if success:
+                        successful_symbols.append(result_symbol)
+                    else:
+                        failed_symbols.append(result_symbol)
+                except Exception as e:
+                    print(f"[错误] 处理 {symbol} 结果时出错: {e}")
+                    failed_symbols.append(symbol)
+    finally:
+        if page_executor is not None:
+            page_executor.shutdown()
+
+    drain_retry_queue(retry_queue, storage, interval, max_workers, market=market)
 
     print(f"[总结] 成功下载 {len(successful_symbols)} 个交易对数据，失败 {len(failed_symbols)} 个。")
     if failed_symbols:
         print(f"[失败列表]: {failed_symbols}")
 
+# 顺序分页下载一段时间范围的K线
+def fetch_klines(symbol, interval, start_time, end_time, float32=False, on_page=None, on_failure=None, market=DEFAULT_MARKET):
+    """
+    从 start_time 开始逐页下载直到 end_time 或没有更多数据。
+    每页的 DataFrame 先放进列表，最后只合并一次，避免每页都复制整张累积表。
+    某一页请求失败时，如果提供了 on_failure，就把这一页的时间段交给它 (例如记入重试队列) 并从下一页继续，
+    否则抛出 KlineRequestError；失败不会被当作没有更多数据而截断后面的历史。
+    :param symbol: 交易对。例如 BTCUSDT
+    :param interval: K线周期。例如1m, 5m, 1h, 1d
+    :param start_time: 开始时间，时间戳(毫秒)
+    :param end_time: 结束时间，时间戳(毫秒)
+    :param float32: 价格和成交量是否使用 float32
+    :param on_page: 每下载到一页时的回调，例如写入分页记录
+    :param on_failure: 某一页请求失败时的回调 on_failure(开始时间, 结束时间, 异常)，只支持固定长度的周期
+    :param market: 市场 "spot" / "um" / "cm"
+    :return: 按 Open time 排序的 DataFrame
+    """
+    market = get_market(market)
+    step = INTERVAL_MILLISECONDS.get(interval)
+    pages = []
+    current_start_time = start_time
+
+    while current_start_time < end_time:
+        # 币本位合约限制了单次查询的时间跨度
+        request_end_time = end_time if market.max_window_ms is None else min(end_time, current_start_time + market.max_window_ms - 1)
+        try:
+            df = get_binance_kline_data(symbol, interval, current_start_time, request_end_time, float32=float32, market=market)
+        except KlineRequestError as e:
+            # 长度不固定的周期无法确定下一页的起点，只能放弃
+            if on_failure is None or step is None:
+                raise
+            failed_end_time = min(request_end_time, current_start_time + step * market.kline_limit(interval) - 1)
+            on_failure(current_start_time, failed_end_time, e)
+            current_start_time = failed_end_time + 1
+            continue
+        if df.empty:
+            break
+
+        pages.append(df)
+        if on_page is not None:
+            with stage("journal"):
+                on_page(df)
+        # 更新起始时间 (下次从最后的时间开始)
+        current_start_time = int(df["Open time"].iloc[-1].timestamp() * 1000) + 1
+
+    if not pages:
+        return pd.DataFrame()
+    with stage("concat"):
+        return pd.concat(pages, ignore_index=True)
+
+# 判断交易对是否已经下载到结束时间
+def is_download_complete(storage, symbol, interval, end_time):
+    """
+    根据元数据清单判断已保存的数据是否已经覆盖到 end_time (断点续传时跳过已完成的交易对)
+    :return: bool
+    """
+    entry = storage.summary(symbol, interval)
+    if entry is None or not entry["rows"]:
+        return False
+    return entry["last"] + INTERVAL_MILLISECONDS.get(interval, 0) > end_time
+
+# 把时间范围切成整页窗口
+def split_time_range(start_time, end_time, interval, limit=KLINE_LIMIT):
+    """
+    把 [start_time, end_time) 切成每个最多包含 limit 根K线的窗口
+    :param start_time: 开始时间，时间戳(毫秒)
+    :param end_time: 结束时间，时间戳(毫秒)
+    :param interval: K线周期。例如1m, 5m, 1h, 1d
+    :param limit: 每页K线条数
+    :return: [(窗口开始, 窗口结束), ...]，窗口为左闭右开
+    """
+    step = INTERVAL_MILLISECONDS[interval] * limit
+    return [(window_start, min(window_start + step, end_time)) for window_start in range(start_time, end_time, step)]
+
+# 分片并发下载单个交易对
+def fetch_klines_sharded(symbol, interval, start_time, end_time, executor, float32=False, on_page=None, skip_windows=(),
+                         on_failure=None, market=DEFAULT_MARKET):
+    """
+    把单个交易对的时间范围切成整页窗口，提交到共享线程池并发下载，再按时间顺序拼接
+    :param symbol: 交易对。例如 BTCUSDT
+    :param interval: K线周期。例如1m, 5m, 1h, 1d
+    :param start_time: 开始时间，时间戳(毫秒)
+    :param end_time: 结束时间，时间戳(毫秒)，与 get_binance_kline_data 一样包含该时刻
+    :param executor: 共享的分页下载线程池
+    :param float32: 价格和成交量是否使用 float32
+    :param on_page: 每下载到一页时的回调 (在分页线程中调用，完成顺序不固定)
+    :param skip_windows: 不需要再下载的窗口开始时间集合 (断点续传时使用)
+    :param on_failure: 窗口请求失败时的回调 on_failure(开始时间, 结束时间, 异常)，None 表示抛出 KlineRequestError
+    :param market: 市场 "spot" / "um" / "cm"
+    :return: 按 Open time 排序的 DataFrame
+    """
+    market = get_market(market)
+
+    def fetch_window(window_start, window_end):
+        # Binance 的 endTime 是闭区间，所以窗口结束时间减 1 毫秒，避免相邻窗口重复
+        try:
+            df = get_binance_kline_data(symbol, interval, window_start, window_end - 1, float32, market=market)
+        except KlineRequestError as e:
+            if on_failure is None:
+                raise
+            on_failure(window_start, window_end - 1, e)
+            return pd.DataFrame()
+        if on_page is not None and not df.empty:
+            with stage("journal"):
+                on_page(df)
+        return df
+
+    windows = split_time_range(start_time, end_time + 1, interval, limit=market.kline_limit(interval))
+    futures = [executor.submit(fetch_window, window_start, window_end)
+               for window_start, window_end in windows if window_start not in skip_windows]
+
+    pages = [future.result() for future in futures]
+    pages = [page for page in pages if not page.empty]
+    if not pages:
+        return pd.DataFrame()
+    with stage("concat"):
+        return pd.concat(pages, ignore_index=True)
+
+# 失败分页记入重试队列的回调
+def retry_queue_callback(retry_queue, symbol, interval):
+    """
+    生成 fetch_klines / fetch_klines_sharded 的 on_failure 回调，把失败的分页时间段记入重试队列
+    """
+    def on_failure(start_time, end_time, error):
+        print(f"[警告] {symbol} 从 {datetime.fromtimestamp(start_time / 1000)} 开始的分页下载失败，已记入重试队列")
+        retry_queue.put(symbol, interval, start_time, end_time, error)
+    return on_failure
+
+# 重新下载重试队列中的时间段
+def drain_retry_queue(retry_queue, storage, interval, max_workers=5, rounds=RETRY_QUEUE_ROUNDS, symbols=None, materialize=None,
+                      market=DEFAULT_MARKET):
+    """
+    把重试队列中失败的分页时间段重新下载并追加到已有数据，最多 rounds 轮，每轮之间等待 RETRY_QUEUE_DELAY 秒。
+    上一次运行留下的时间段也会一起重试；还没有数据文件的交易对跳过 (下一次完整下载时处理)。
+    数据写入成功后才从队列中删除，中途退出不会丢失失败记录。
+    :param retry_queue: RetryQueue
+    :param storage: 存储对象
+    :param interval: K线周期
+    :param max_workers: 并发线程数
+    :param rounds: 最多重试几轮
+    :param symbols: 只重试这些交易对，None 表示队列中该周期的所有交易对
+    :param materialize: 同时维护的高级别周期列表
+    :param market: 市场 "spot" / "um" / "cm"
+    :return: 仍然失败的时间段列表 (保留在队列文件中，下次运行时继续重试)
+    """
+    def retry_entry(entry):
+        failures = []
+        try:
+            df = fetch_klines(entry["symbol"], interval, entry["start_time"], entry["end_time"],
+                              on_failure=lambda start, end, error: failures.append((start, end, error)), market=market)
+        except Exception as e:
+            return pd.DataFrame(), [(entry["start_time"], entry["end_time"], e)]
+        return df, failures
+
+    for round_index in range(rounds):
+        entries = [entry for entry in retry_queue.pending(interval, symbols) if storage.exists(entry["symbol"], interval)]
+        if not entries:
+            break
+        if round_index > 0:
+            time.sleep(RETRY_QUEUE_DELAY)
+        print(f"[信息] 第 {round_index + 1} 轮重试: {len(entries)} 个失败的时间段")
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(retry_entry, entry): entry for entry in entries}
+            for future in as_completed(futures):
+                entry = futures[future]
+                results.setdefault(entry["symbol"], []).append((entry, *future.result()))
+
+        for symbol, symbol_results in results.items():
+            df = merge_pages([df for _, df, _ in symbol_results])
+            if not df.empty:
+                storage.append(symbol, interval, df)
+                if materialize:
+                    materialize_update(storage, symbol, interval, materialize, int(df["Open time"].iloc[0].timestamp() * 1000))
+                print(f"[完成] {symbol} 重试补回 {len(df)} 根K线")
+
+            # 数据写入之后再更新队列：成功的时间段删除，仍然失败的部分重新记入 (同一时间段累加失败次数)
+            for entry, _, failures in symbol_results:
+                for start, end, error in failures:
+                    retry_queue.put(symbol, interval, start, end, error)
+                if not any(start == entry["start_time"] and end == entry["end_time"] for start, end, _ in failures):
+                    retry_queue.remove(entry)
+
+    remaining = [entry for entry in retry_queue.pending(interval, symbols) if storage.exists(entry["symbol"], interval)]
+    if remaining:
+        print(f"[警告] 仍有 {len(remaining)} 个时间段下载失败，已保存在 {retry_queue.path}，下次运行时会继续重试")
+        print(f"[失败列表]: {sorted({entry['symbol'] for entry in remaining})}")
+    return remaining
+
+# 保留的K线字段 (顺序即输出列顺序)
+KLINE_COLUMNS = [
+    "Open time", "Close time", "Open", "High", "Low", "Close", "Volume", "Quote asset volume",
+    "Number of trades", "Taker buy base asset volume", "Taker buy quote asset volume"
+]
+
+# 原始K线数组中各浮点字段的位置
+KLINE_FLOAT_FIELDS = {
+    "Open": 1, "High": 2, "Low": 3, "Close": 4, "Volume": 5, "Quote asset volume": 7,
+    "Taker buy base asset volume": 9, "Taker buy quote asset volume": 10
+}
+
+# 把原始K线数组解析为DataFrame
+def parse_kline_rows(data, float32=False):
+    """
+    把 klines 接口返回的 12 字段数组一次性解析成带类型的列，不经过字符串 DataFrame
+    :param data: response.json() 得到的二维列表
+    :param float32: 价格和成交量是否使用 float32 (默认 float64)
+    :return: 列为 KLINE_COLUMNS 的 DataFrame
+    """
+    if len(data) == 0:
+        return pd.DataFrame()
+
+    # 按列转置后直接转换为 NumPy 数组 (数值字段为字符串，由 NumPy 一次性解析)
+    fields = list(zip(*data))
+    float_dtype = np.float32 if float32 else np.float64
+
+    columns = {
+        "Open time": np.array(fields[0], dtype=np.int64).astype("datetime64[ms]"),
+        "Close time": np.array(fields[6], dtype=np.int64).astype("datetime64[ms]"),
+    }
+    for name, i in KLINE_FLOAT_FIELDS.items():
+        columns[name] = np.array(fields[i], dtype=float_dtype)
+    columns["Number of trades"] = np.array(fields[8], dtype=np.int64)
+
+    return pd.DataFrame({name: columns[name] for name in KLINE_COLUMNS})
+
 # 获取K线数据的函数
-def get_binance_kline_data(symbol, interval, start_time, end_time):
+def get_binance_kline_data(symbol, interval, start_time, end_time, float32=False, market=DEFAULT_MARKET):
     """
     从Binance获取历史K线数据
     :param symbol: 交易对。例如 BTCUSDT
     :param interval: K线周期。例如1m, 5m, 1h, 1d
     :param start_time: 开始时间，时间戳(毫秒)
     :param end_time: 结束时间，时间戳(毫秒)
-    :return: 返回DataFrame格式的历史K线数据
+    :param float32: 价格和成交量是否使用 float32
+    :param market: 市场 "spot" / "um" / "cm"，决定接口地址、请求权重和使用的限速器
+    :return: 返回DataFrame格式的历史K线数据；这段时间没有数据时为空 DataFrame
+    :raises KlineRequestError: 请求失败 (rate_limited_get 的重试用完后仍然失败)
     """
-    url = f"https://fapi.binance.com/fapi/v1/klines"
+    market = get_market(market)
+    limit = market.kline_limit(interval)
     params = {
         "symbol": symbol,
         "interval": interval,
         "startTime": start_time,
         "endTime": end_time,
-        "limit": 1000  # 每次最大返回1000条数据
+        "limit": limit  # 每次最大返回1000条数据
     }
 
     try:
-        response = requests.get(url, params=params)
+        response = rate_limited_get(market.kline_url, params=params, weight=market.kline_weight(limit), limiter=market.limiter)
         response.raise_for_status()  # 如果响应状态码不是200，会抛出HTTPError
-
-        # 响应解析为JSON
         data = response.json()
-
-        if len(data) == 0:
-            # print(f"[警告] 获取不到数据，可能是时间范围过小")
-            return pd.DataFrame()
-
-        # 将数据格式化为DataFrame
-        columns = [
-            "Open time", "Open", "High", "Low", "Close", "Volume",
-            "Close time", "Quote asset volume", "Number of trades",
-            "Taker buy base asset volume", "Taker buy quote asset volume", "Ignore"
-        ]
-        df = pd.DataFrame(data, columns=columns)
-
-        # 转换时间戳为可读时间
-        df["Open time"] = pd.to_datetime(df["Open time"], unit="ms")
-        df["Close time"] = pd.to_datetime(df["Close time"], unit="ms")
-
-        # 转换数值列为浮点型
-        numeric_columns = ["Open", "High", "Low", "Close", "Volume",
-                           "Quote asset volume", "Taker buy base asset volume", "Taker buy quote asset volume"]
-        for col in numeric_columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-        
-        # 转换交易次数为整数类型
-        df["Number of trades"] = pd.to_numeric(df["Number of trades"], errors='coerce').astype('Int64')
-
-
-        # 保留所需的核心字段
-        df = df[["Open time", "Close time", "Open", "High", "Low", "Close", "Volume", "Quote asset volume", "Number of trades", "Taker buy base asset volume", "Taker buy quote asset volume"]]
-
-        return df
     except Exception as e:
         print(f"[错误] 请求失败: {e}")
-        return pd.DataFrame()
+        raise KlineRequestError(f"{symbol} {interval} {start_time}-{end_time}: {e}") from e
+
+    # 响应解析为JSON，再直接解析为带类型的列
+    with stage("parse"):
+        return parse_kline_rows(data, float32=float32)
 
 # 批量获取历史数据的函数
-def download_historical_data(symbols, interval, start_date, end_date, output_dir="./binance_data"):
+@instrumented("download")
+def download_historical_data(symbols, interval, start_date, end_date, output_dir="./binance_data", backend="pickle",
+                             market=DEFAULT_MARKET):
     """
-    批量下载多个交易对的历史数据并保存为pkl文件
+    批量下载多个交易对的历史数据并保存
     :param symbols: 要下载的交易对列表。例如 ["BTCUSDT", "ETHUSDT"]
     :param interval: K线周期
     :param start_date: 开始日期。例如 2023-01-01
     :param end_date: 结束日期。例如 2023-10-01
     :param output_dir: 数据保存的目录
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"
+    :param market: 市场 "spot" / "um" (默认) / "cm"
     """
-    import os
+    market = get_market(market)
+    output_dir = market.data_dir(output_dir)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
+    storage = get_storage(output_dir, backend)
+    retry_queue = RetryQueue(output_dir)
 
     # 转换开始和结束日期为时间戳
     start_time = int(datetime.strptime(start_date, "%Y-%m-%d").timestamp() * 1000)
@@ -177,7 +450,7 @@ def download_historical_data(symbols, interval, start_date, end_date, output_dir
         print(f"正在下载交易对 {symbol} 的数据...")
 
         # 获取交易对的上市时间
-        listing_time = get_symbol_listing_time(symbol)
+        listing_time = get_symbol_listing_time(symbol, market)
         if listing_time is None:  # 若交易对不存在或无法获取时间
             print(f"[跳过] 无法获取交易对 {symbol} 的上市时间，跳过该交易对。")
             continue
@@ -194,56 +467,45 @@ def download_historical_data(symbols, interval, start_date, end_date, output_dir
         else:
             current_start_time = start_time
 
-        all_data = pd.DataFrame()
-        #current_start_time = start_time
-
-        while current_start_time < end_time:
-            # 获取K线数据
-            df = get_binance_kline_data(symbol, interval, current_start_time, end_time)
-
-            if df.empty:
-                print(f"[提示] {symbol} 数据已下载完成")
-                break
+        # 分页下载，所有页在最后一次性合并，失败的分页记入重试队列
+        all_data = fetch_klines(symbol, interval, current_start_time, end_time,
+                                on_failure=retry_queue_callback(retry_queue, symbol, interval), market=market)
+        print(f"[提示] {symbol} 数据已下载完成")
 
-            all_data = pd.concat([all_data, df], ignore_index=True) # 把多次下载的数据合并起来
-
-            # 更新起始时间 (下次从最后的时间开始)
-            current_start_time = int(df["Open time"].iloc[-1].timestamp() * 1000) + 1
-
-            # 每次请求等一小会儿，避免触发币安限频
-            time.sleep(0.2)
-
-        # 保存为pkl文件
-        output_file = os.path.join(output_dir, f"{symbol}_{interval}.pkl")
-        all_data.to_pickle(output_file)  # 保存为pkl格式
+        # 保存数据
+        output_file = storage.write(symbol, interval, all_data)
         print(f"[完成] {symbol} 数据已保存到 {output_file}")
 
+    drain_retry_queue(retry_queue, storage, interval, max_workers=1, market=market)
+
 # 补充或下载数据的函数
-def update_historical_data(symbol, interval, output_dir="/Users/zhoupeng/Desktop/tiger_quant/data", update_start_time=None):
+@instrumented("update")
+def update_historical_data(symbol, interval, output_dir="/Users/zhoupeng/Desktop/tiger_quant/data", update_start_time=None,
+                           backend="pickle", market=DEFAULT_MARKET):
     """
-    补充下载指定交易对的数据，保存为pkl格式
+    补充下载指定交易对的数据并保存
     :param symbol: 交易对名称，例如 BTCUSDT
     :param interval: 时间间隔（K线周期）
     :param output_dir: 数据保存文件夹
     :param update_start_time: 从指定时间开始更新，以 "yyyy-mm-dd" 格式
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"
+    :param market: 市场 "spot" / "um" (默认) / "cm"
     """
-    # 数据保存路径
-    output_file = os.path.join(output_dir, f"{symbol}_{interval}.pkl")
+    storage = get_market_storage(output_dir, backend, market)
 
-    # 如果文件存在，则加载现有数据
-    if os.path.exists(output_file):
-        print(f"[信息] 已发现数据文件 {output_file}")
-        existing_data = pd.read_pickle(output_file)
-        print(f"[信息] 当前数据从 {existing_data['Open time'].iloc[0]} 到 {existing_data['Open time'].iloc[-1]}")
-        last_timestamp = existing_data['Open time'].iloc[-1]
+    # 如果文件存在，则只读取现有数据的时间范围
+    time_range = storage.time_range(symbol, interval)
+    if time_range is not None:
+        print(f"[信息] 已发现数据文件 {storage.path(symbol, interval)}")
+        print(f"[信息] 当前数据从 {time_range[0]} 到 {time_range[1]}")
+        last_timestamp = time_range[1]
 
         # 从最后时间点的前五天开始覆盖数据
         last_timestamp = int(last_timestamp.timestamp() * 1000)  # 转换为毫秒时间戳
-        last_timestamp = last_timestamp - 5 * 24 * 60 * 60 * 1000  # 往前减去5天（毫秒单位）
+        last_timestamp = last_timestamp - UPDATE_OVERLAP_MS  # 往前减去5天（毫秒单位）
 
     else:
         print(f"[信息] 未发现现有数据，准备从头下载 {symbol} 的数据")
-        existing_data = pd.DataFrame()
         last_timestamp = None
 
     # 如果指定了补充开始时间，则覆盖默认的最后时间戳
@@ -254,133 +516,240 @@ def update_historical_data(symbol, interval, output_dir="/Users/zhoupeng/Desktop
     # 获取当前时间作为结束时间
     end_time = int(datetime.now().timestamp() * 1000)
 
-    # 累积新增数据
-    all_new_data = pd.DataFrame()
     current_start_time = last_timestamp
 
     print(f"[信息] 开始从 {datetime.fromtimestamp(current_start_time / 1000)} 补充数据")
-    while current_start_time < end_time:
-        # 获取K线数据
-        df = get_binance_kline_data(symbol, interval, current_start_time, end_time)
+    retry_queue = RetryQueue(storage.root)
+    all_new_data = fetch_klines(symbol, interval, current_start_time, end_time,
+                                on_failure=retry_queue_callback(retry_queue, symbol, interval), market=market)
+    print(f"[提示] 数据下载完成")
 
-        if df.empty:
-            print(f"[提示] 数据下载完成")
-            break
+    # 追加新数据，与已有数据重叠的部分以新数据为准 (根据时间去重)
+    output_file = storage.append(symbol, interval, all_new_data)
+    print(f"[完成] {symbol} 数据已更新并保存到 {output_file}")
 
-        # 累积
-        all_new_data = pd.concat([all_new_data, df], ignore_index=True)
+    drain_retry_queue(retry_queue, storage, interval, max_workers=1, symbols=[symbol], market=market)
 
-        # 更新下一次请求的时间戳
-        current_start_time = int(df["Open time"].iloc[-1].timestamp() * 1000) + 1
+# 确定下载的起始时间
+def resolve_download_start_time(symbol, start_time, end_time, market=DEFAULT_MARKET):
+    """
+    根据上市时间确定单个交易对的下载起始时间
+    :param symbol: 交易对
+    :param start_time: 要求的开始时间，时间戳(毫秒)
+    :param end_time: 要求的结束时间，时间戳(毫秒)
+    :param market: 市场 "spot" / "um" / "cm"
+    :return: 实际的开始时间，时间戳(毫秒)；需要跳过该交易对时返回 None
+    """
+    listing_time = get_symbol_listing_time(symbol, market)
+    if not listing_time:
+        print(f"[跳过] 无法获取 {symbol} 的上市时间，跳过...")
+        return None
 
-        time.sleep(0.2)  # 避免触发API频率限制
+    if listing_time > end_time:
+        print(f"[跳过] {symbol} 上市时间晚于结束时间 {datetime.fromtimestamp(end_time / 1000).strftime('%Y-%m-%d')}，跳过...")
+        return None
 
-    # 合并新老数据
-    all_data = pd.concat([existing_data, all_new_data], ignore_index=True)
+    # 如果上市时间晚于开始时间，则调整为上市时间
+    if listing_time > start_time:
+        print(f"[提示] {symbol} 上市时间晚于起始时间 {datetime.fromtimestamp(start_time / 1000).strftime('%Y-%m-%d')}，使用上市时间 {datetime.fromtimestamp(listing_time / 1000).strftime('%Y-%m-%d')} 作为开始时间。")
+    return max(start_time, listing_time)
 
-    # 删除重复行（根据时间去重）
-    all_data = all_data.drop_duplicates(subset=["Open time"], keep="last")
-    all_data = all_data.sort_values(by="Open time")  # 按时间排序
+# 确定更新的起始时间
+def resolve_update_start_time(storage, symbol, interval, update_start_time=None, market=DEFAULT_MARKET):
+    """
+    确定单个交易对的更新起始时间：已有数据时从最后一根K线往前 UPDATE_OVERLAP_MS 开始覆盖，
+    没有数据时从上市时间开始，指定了 update_start_time 时以它为准
+    :param storage: 存储对象
+    :param symbol: 交易对
+    :param interval: K线周期
+    :param update_start_time: 起始更新时间，例如 "yyyy-mm-dd"
+    :param market: 市场 "spot" / "um" / "cm"
+    :return: 开始时间，时间戳(毫秒)；无法确定时返回 None
+    """
+    # 如果指定了补充开始时间，则覆盖默认的最后时间戳
+    if update_start_time:
+        return int(datetime.strptime(update_start_time, "%Y-%m-%d").timestamp() * 1000)
+
+    # 如果文件存在，则只读取现有数据的时间范围，不加载全部历史
+    time_range = storage.time_range(symbol, interval)
+    if time_range is not None:
+        last_timestamp = int(time_range[1].timestamp() * 1000)  # 转换为毫秒时间戳
+        return last_timestamp - UPDATE_OVERLAP_MS
+
+    # 如果文件不存在，则获取交易对的上市时间
+    listing_time = get_symbol_listing_time(symbol, market)
+    if listing_time is None:
+        print(f"[错误] 无法获取 {symbol} 的上市时间，跳过该交易对。")
+        return None
 
-    # 保存为pkl文件
-    all_data.to_pickle(output_file)
-    print(f"[完成] {symbol} 数据已更新并保存到 {output_file}")
+    print(f"[信息] 未发现现有数据，使用上市时间 {datetime.fromtimestamp(listing_time / 1000)} 作为开始时间进行补充")
+    return listing_time
 
 # 多线程版更新数据
-def update_historical_data_multi_threaded(symbols, interval, output_dir, update_start_time=None, max_workers=5):
+@instrumented("update")
+def update_historical_data_multi_threaded(symbols, interval, output_dir, update_start_time=None, max_workers=5, backend="pickle",
+                                          materialize=None, market=DEFAULT_MARKET):
     """
-    使用多线程补充下载指定交易对的数据，保存为pkl格式。
+    使用多线程补充下载指定交易对的数据并保存。
     :param symbols: 交易对列表，例如 ["BTCUSDT", "ETHUSDT"]
     :param interval: K线周期，例如 "1h", "1d"
     :param output_dir: 数据保存文件夹
     :param update_start_time: 起始更新时间，例如 "yyyy-mm-dd"
     :param max_workers: 并发线程数
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"
+    :param materialize: 同时维护的高级别周期列表，例如 ["1h", "4h", "1d"]，只重新计算被新数据影响的K线
+    :param market: 市场 "spot" / "um" (默认) / "cm"
     """
+    storage = get_market_storage(output_dir, backend, market)
+    retry_queue = RetryQueue(storage.root)
+
     def update_single_symbol(symbol):
         """处理单个交易对的数据更新"""
-        # 数据保存路径
-        output_file = os.path.join(output_dir, f"{symbol}_{interval}.pkl")
-
-        # 如果文件存在，则加载现有数据
-        if os.path.exists(output_file):
-            existing_data = pd.read_pickle(output_file)
-            last_timestamp = existing_data['Open time'].iloc[-1]
-            last_timestamp = int(last_timestamp.timestamp() * 1000)  # 转换为毫秒时间戳
-            last_timestamp = last_timestamp - 5 * 24 * 60 * 60 * 1000  # 往前减去5天（毫秒单位）
-        else:
-            # 如果文件不存在，则获取交易对的上市时间
-            listing_time = get_symbol_listing_time(symbol)
-            if listing_time is None:
-                print(f"[错误] 无法获取 {symbol} 的上市时间，跳过该交易对。")
-                return
-
-            print(f"[信息] 未发现现有数据，使用上市时间 {datetime.fromtimestamp(listing_time / 1000)} 作为开始时间进行补充")
-            last_timestamp = listing_time
-            existing_data = pd.DataFrame()
-
-        # 如果指定了补充开始时间，则覆盖默认的最后时间戳
-        if update_start_time:
-            last_timestamp = int(datetime.strptime(update_start_time, "%Y-%m-%d").timestamp() * 1000)
+        symbol_start = time.perf_counter()
+        current_start_time = resolve_update_start_time(storage, symbol, interval, update_start_time, market)
+        if current_start_time is None:
+            return
 
         # 获取当前时间作为结束时间
         end_time = int(datetime.now().timestamp() * 1000)
+        rows = update_symbol_range(storage, symbol, interval, current_start_time, end_time, retry_queue, materialize, market)
+        record_symbol(symbol, rows, time.perf_counter() - symbol_start)
 
-        # 累积新增数据
-        all_new_data = pd.DataFrame()
-        current_start_time = last_timestamp
-
-        if current_start_time is None:
-            if update_start_time:
-                current_start_time = int(datetime.strptime(update_start_time, "%Y-%m-%d").timestamp() * 1000)
-            else:
-                raise ValueError(f"无法确定{symbol}开始时间, 请提供update_start_time参数或确保数据文件存在。")
+    # 创建线程池执行器
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(update_single_symbol, symbol) for symbol in symbols]
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"[错误] 数据下载时出错: {e}")
 
+    drain_retry_queue(retry_queue, storage, interval, max_workers, materialize=materialize, market=market)
 
-        print(f"[信息] {symbol}: 开始从 {datetime.fromtimestamp(current_start_time / 1000)} 补充数据")
-        while current_start_time < end_time:
-            df = get_binance_kline_data(symbol, interval, current_start_time, end_time)
-            if df.empty:
-                break
-            all_new_data = pd.concat([all_new_data, df], ignore_index=True)
-            current_start_time = int(df["Open time"].iloc[-1].timestamp() * 1000) + 1
-            time.sleep(0.2)  # 避免API频率限制
+# 更新单个交易对的一段时间
+def update_symbol_range(storage, symbol, interval, start_time, end_time, retry_queue, materialize=None, market=DEFAULT_MARKET):
+    """
+    下载一段时间的K线并追加到已有数据，同时更新高级别周期
+    :param storage: 存储对象
+    :param symbol: 交易对
+    :param interval: K线周期
+    :param start_time: 开始时间，时间戳(毫秒)
+    :param end_time: 结束时间，时间戳(毫秒)
+    :param retry_queue: 失败的分页记入的 RetryQueue
+    :param materialize: 同时维护的高级别周期列表
+    :param market: 市场 "spot" / "um" / "cm"
+    :return: 下载的行数
+    """
+    print(f"[信息] {symbol}: 开始从 {datetime.fromtimestamp(start_time / 1000)} 补充数据")
+    all_new_data = fetch_klines(symbol, interval, start_time, end_time,
+                                on_failure=retry_queue_callback(retry_queue, symbol, interval), market=market)
 
-        # 合并新老数据并去重
-        all_data = pd.concat([existing_data, all_new_data], ignore_index=True)
-        all_data = all_data.drop_duplicates(subset=["Open time"], keep="last").sort_values(by="Open time")
+    # 只追加新的尾部数据，重叠窗口在存储层合并去重
+    with stage("write"):
+        output_file = storage.append(symbol, interval, all_new_data)
+    print(f"[完成] {symbol} 数据已更新并保存到 {output_file}")
 
-        # 保存数据
-        all_data.to_pickle(output_file)
-        print(f"[完成] {symbol} 数据已更新并保存到 {output_file}")
+    if materialize and not all_new_data.empty:
+        since = int(all_new_data["Open time"].iloc[0].timestamp() * 1000)
+        with stage("materialize"):
+            written = materialize_update(storage, symbol, interval, materialize, since)
+        print(f"[完成] {symbol} 高级别周期已更新: {written}")
+    return len(all_new_data)
 
-    # 创建线程池执行器
+# 只补下载数据中间的缺口
+@instrumented("repair")
+def repair_gaps(symbols, interval, output_dir, max_workers=5, backend="pickle", verify=False, market=DEFAULT_MARKET):
+    """
+    扫描每个交易对数据中间缺失的时间段，只并发下载这些时间段并拼接回已有数据，
+    不需要整段重新下载。
+    :param symbols: 交易对列表，例如 ["BTCUSDT", "ETHUSDT"]
+    :param interval: K线周期，例如 "15m", "1d"
+    :param output_dir: 数据保存文件夹
+    :param max_workers: 并发线程数
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"
+    :param verify: 是否忽略清单中记录的缺口数量，对每个交易对都扫描数据
+    :param market: 市场 "spot" / "um" (默认) / "cm"
+    :return: {symbol: 仍然无法补全的缺口列表}，交易所停机造成的缺口无法补全
+    """
+    market = get_market(market)
+    storage = get_market_storage(output_dir, backend, market)
+    gaps = scan_gaps(symbols, interval, output_dir, backend=backend, verify=verify, market=market)
+    if not gaps:
+        print("[信息] 没有发现缺口")
+        return {}
+
+    # 缺口按整页窗口切分，所有交易对的窗口共享同一个线程池并发下载
+    tasks = [(symbol, window_start, window_end - 1)
+             for symbol, symbol_gaps in gaps.items() for start, end in symbol_gaps
+             for window_start, window_end in split_time_range(start, end + 1, interval, limit=market.kline_limit(interval))]
+    print(f"[信息] 共 {len(gaps)} 个交易对、{sum(map(len, gaps.values()))} 处缺口 ({len(tasks)} 页) 需要补下载")
+
+    filled = {symbol: [] for symbol in gaps}
+    retry_queue = RetryQueue(storage.root)
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(update_single_symbol, symbol) for symbol in symbols]
+        futures = {executor.submit(fetch_klines, symbol, interval, start, end,
+                                   on_failure=retry_queue_callback(retry_queue, symbol, interval), market=market): symbol
+                   for symbol, start, end in tasks}
         for future in as_completed(futures):
+            symbol = futures[future]
             try:
-                future.result()
+                df = future.result()
+                if not df.empty:
+                    filled[symbol].append(df)
             except Exception as e:
-                print(f"[错误] 数据下载时出错: {e}")
+                print(f"[错误] 补下载 {symbol} 缺口时出错: {e}")
+
+    # 拼接回已有数据，失败的窗口再重试几轮
+    for symbol, pages in filled.items():
+        if pages:
+            storage.append(symbol, interval, pd.concat(pages, ignore_index=True))
+    drain_retry_queue(retry_queue, storage, interval, max_workers, symbols=list(gaps), market=market)
+
+    # 重新扫描清单 (中间插入的数据无法从追加前的清单推算)
+    remaining = {}
+    for symbol in filled:
+        entry = storage.summary(symbol, interval, verify=True)
+        if entry["gaps"]:
+            remaining[symbol] = find_gaps(storage.read(symbol, interval, columns=["Open time"]), interval)
+            print(f"[提示] {symbol} 仍有 {entry['gaps']} 处缺口无法补全 (可能是交易所停机)")
+        else:
+            print(f"[完成] {symbol} 缺口已全部补全")
+
+    return remaining
+
+# 通过第一根K线确定的上市时间缓存: {(市场, symbol): 时间戳}
+_first_kline_times = {}
 
 # 获取币安交易对上市时间的函数
-def get_symbol_listing_time(symbol):
+def get_symbol_listing_time(symbol, market=DEFAULT_MARKET):
     """
-    获取交易对的上市时间 (Binance Futures)
+    获取交易对的上市时间。合约从共享的 exchangeInfo 缓存中读取 onboardDate，
+    现货的 exchangeInfo 没有上市时间，改为查询第一根日K线的开始时间 (每个交易对只查询一次)
     :param symbol: 交易对名称 (如 BTCUSDT)
+    :param market: 市场 "spot" / "um" (默认) / "cm"
     :return: 上市时间的时间戳 (毫秒)，如果交易对不存在返回 None
     """
-    try:
-        url = "https://fapi.binance.com/fapi/v1/exchangeInfo"  # Binance Futures Exchange Info API
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
+    market = get_market(market)
+    index = get_exchange_info_index(market=market)
+    if index is None:
+        print(f"[错误] 无法获取交易对 {symbol} 的上市时间: exchangeInfo 不可用")
+        return None
 
-        for sym in data["symbols"]:
-            if sym["symbol"] == symbol:
-                # print(datetime.fromtimestamp(sym["onboardDate"] / 1000))
-                return sym["onboardDate"]  # Binance 的上市时间是毫秒时间戳
+    sym = index.get(symbol)
+    if sym is None:
         print(f"[警告] 未找到交易对 {symbol} 的上市时间！可能交易对不存在。")
         return None
-    except Exception as e:
-        print(f"[错误] 无法获取交易对 {symbol} 的上市时间: {e}")
-        return None
\ No newline at end of file
+    if market.listing_time_source == "onboardDate":
+        return sym["onboardDate"]  # Binance 的上市时间是毫秒时间戳
+
+    key = (market.name, symbol)
+    if key not in _first_kline_times:
+        try:
+            df = get_binance_kline_data(symbol, "1d", 0, int(time.time() * 1000), market=market)
+        except KlineRequestError:
+            return None
+        if df.empty:
+            print(f"[警告] 无法获取交易对 {symbol} 的第一根K线")
+            return None
+        _first_kline_times[key] = int(df["Open time"].iloc[0].timestamp() * 1000)
+    return _first_kline_times[key]
@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+import time
+
+from markets import DEFAULT_MARKET, get_market
+from rate_limit import rate_limited_get
+
+# 磁盘快照的默认有效期（秒）
+EXCHANGE_INFO_TTL = 6 * 60 * 60
+
+# 进程内缓存，每个市场一份: {市场名称: {"index": {symbol: info}, "fetched_at": 时间戳}}
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _load_snapshot(cache_file, ttl):
+    """
+    读取未过期的磁盘快照
+    :return: (symbols 列表, 快照时间) 或 None
+    """
+    if not cache_file or not os.path.exists(cache_file):
+        return None
+    if time.time() - os.path.getmtime(cache_file) > ttl:
+        return None
+    try:
+        with open(cache_file, "r") as f:
+            data = json.load(f)
+        return data["symbols"], os.path.getmtime(cache_file)
+    except Exception as e:
+        print(f"[警告] 无法读取 exchangeInfo 快照 {cache_file}: {e}")
+        return None
+
+
+def _save_snapshot(cache_file, data):
+    """
+    写入磁盘快照 (先写临时文件再替换，避免多进程读到半个文件)
+    """
+    directory = os.path.dirname(cache_file)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_file = f"{cache_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_file, cache_file)
+
+
+def get_exchange_info_index(cache_file=None, ttl=EXCHANGE_INFO_TTL, refresh=False, market=DEFAULT_MARKET):
+    """
+    获取以 symbol 为键的交易对元数据索引，每个市场整个进程只请求一次 exchangeInfo
+    :param cache_file: 可选的磁盘快照路径 (json)，在 ttl 内直接读取快照，不发请求
+    :param ttl: 缓存有效期（秒），同时作用于进程内缓存和磁盘快照
+    :param refresh: 是否强制重新请求
+    :param market: 市场 "spot" / "um" (默认) / "cm"
+    :return: {symbol: 交易对信息 dict}，获取失败时返回 None
+    """
+    market = get_market(market)
+    with _cache_lock:
+        cache = _cache.setdefault(market.name, {"index": None, "fetched_at": 0.0})
+        if not refresh and cache["index"] is not None and time.time() - cache["fetched_at"] <= ttl:
+            return cache["index"]
+
+        snapshot = None if refresh else _load_snapshot(cache_file, ttl)
+        if snapshot is not None:
+            symbols, fetched_at = snapshot
+        else:
+            try:
+                response = rate_limited_get(market.exchange_info_url, weight=market.exchange_info_weight, limiter=market.limiter)
+                response.raise_for_status()
+                data = response.json()
+            except Exception as e:
+                print(f"[错误] 无法获取 {market.name} exchangeInfo: {e}")
+                return cache["index"]
+
+            symbols = data["symbols"]
+            fetched_at = time.time()
+            if cache_file:
+                try:
+                    _save_snapshot(cache_file, {"symbols": symbols})
+                except Exception as e:
+                    print(f"[警告] 无法写入 exchangeInfo 快照 {cache_file}: {e}")
+
+        cache["index"] = {sym["symbol"]: sym for sym in symbols}
+        cache["fetched_at"] = fetched_at
+        return cache["index"]
+
+
+def symbol_status(info):
+    """
+    :param info: exchangeInfo 中单个交易对的信息
+    :return: 交易状态，例如 "TRADING"；现货和U本位合约用 status 字段，币本位合约用 contractStatus 字段
+    """
+    return info.get("status", info.get("contractStatus"))
+
+
+def get_24h_quote_volumes(market=DEFAULT_MARKET):
+    """
+    一次请求获取所有交易对最近24小时的成交额，用于按交易活跃度排序 (行情变化快，不缓存)
+    :param market: 市场 "spot" / "um" (默认) / "cm"
+    :return: {symbol: 成交额}，币本位合约没有计价资产成交额，使用标的资产成交量；获取失败时返回空字典
+    """
+    market = get_market(market)
+    try:
+        response = rate_limited_get(market.ticker_url, weight=market.ticker_weight, limiter=market.limiter)
+        response.raise_for_status()
+        return {item["symbol"]: float(item.get("quoteVolume", item.get("baseVolume", 0))) for item in response.json()}
+    except Exception as e:
+        print(f"[警告] 无法获取 {market.name} 24小时行情: {e}")
+        return {}
+
+
+def clear_exchange_info_cache():
+    """
+    清空进程内缓存，下次调用会重新读取快照或请求
+    """
+    with _cache_lock:
+        _cache.clear()
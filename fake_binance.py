@@ -0,0 +1,521 @@
+import argparse
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from exchange_info import clear_exchange_info_cache
+from intervals import INTERVAL_MILLISECONDS
+from markets import MARKETS
+from rate_limit import RETRY_AFTER_HEADER, USED_WEIGHT_HEADER, WeightRateLimiter, kline_request_weight
+from storage import get_storage
+
+# websockets 为可选依赖，只有 WebSocket 组合流替身 (FakeKlineStream) 需要
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+# 合成数据默认的上市时间 (2020-01-01 UTC)
+FAKE_LISTING_TIME = 1577836800000
+
+# 交易中的永续合约在 exchangeInfo 中的 deliveryDate (币安使用 2100-12-25 作为占位值)
+FAKE_DELIVERY_DATE = 4133404800000
+
+# 合成数据的价格以这个K线数量为周期重复，每个交易对的数值字符串只需要格式化一次
+SYNTHETIC_PERIOD = 1000
+
+_synthetic_tables = {}
+
+
+def _synthetic_table(symbol):
+    """
+    预先格式化一个周期内每根K线的数值字段 (字符串)，生成响应时只需要按位置查表
+    """
+    if symbol not in _synthetic_tables:
+        seed = sum(map(ord, symbol))
+        index = np.arange(SYNTHETIC_PERIOD)
+        close = 100 + seed % 50 + np.sin(2 * np.pi * index / SYNTHETIC_PERIOD) * 10 + (index % 7) * 0.1
+        volume = 1000 + (index % 100) * 3.0
+        _synthetic_tables[symbol] = [
+            (f"{c - 0.05:.4f}", f"{c + 0.2:.4f}", f"{c - 0.3:.4f}", f"{c:.4f}", f"{v:.3f}", f"{v * c:.4f}", int(v) // 10,
+             f"{v / 2:.3f}", f"{v * c / 2:.4f}")
+            for c, v in zip(close, volume)]
+    return _synthetic_tables[symbol]
+
+
+def synthetic_kline_rows(symbol, interval, open_times):
+    """
+    生成确定性的合成K线 (同一个交易对、同一根K线每次请求的内容都相同)，格式与 klines 接口一致
+    :param open_times: K线开始时间数组，时间戳(毫秒)
+    """
+    step = INTERVAL_MILLISECONDS[interval]
+    table = _synthetic_table(symbol)
+    positions = (open_times // step % SYNTHETIC_PERIOD).tolist()
+    return [[t, o, h, l, c, v, t + step - 1, q, n, tb, tq, "0"]
+            for t, (o, h, l, c, v, q, n, tb, tq) in zip(open_times.tolist(), (table[k] for k in positions))]
+
+
+class FakeBinanceServer:
+    """
+    本地的 Binance 替身，用于离线测试和基准测试，不会消耗真实的请求权重。
+    提供 klines、exchangeInfo 和 ticker/24hr 接口 (所有市场共用)，数据可以是合成的，也可以来自本地已下载的数据目录 (回放)。
+    可以配置每个请求的延迟、服务端的权重上限 (超出时返回 429 + Retry-After)，以及每隔 N 个请求强制返回一次 429 或 500。
+    """
+
+    def __init__(self, symbols=("BTCUSDT", "ETHUSDT"), listing_time=FAKE_LISTING_TIME, latency=0.0, weight_limit=None,
+                 rate_limit_every=0, retry_after=1, error_every=0, data_dir=None, backend="pickle", exchange_info_file=None,
+                 delisted=None, port=0):
+        """
+        :param symbols: 合成数据的交易对列表
+        :param listing_time: 合成数据的上市时间，时间戳(毫秒)
+        :param latency: 每个请求的额外延迟（秒）
+        :param weight_limit: 服务端每分钟的权重上限，超出时返回 429；None 表示不限制
+        :param rate_limit_every: 每隔多少个请求强制返回一次 429，0 表示不返回
+        :param retry_after: 429 响应中的 Retry-After（秒）
+        :param error_every: 每隔多少个K线请求返回一次 500 (模拟服务端暂时不可用)，0 表示不返回
+        :param data_dir: 回放模式的数据目录，K线从这里读取 (只返回已有的数据)
+        :param backend: 回放数据目录的存储后端
+        :param exchange_info_file: 回放用的 exchangeInfo 响应 (json 文件，例如 get_exchange_info_index 写入的快照)
+        :param delisted: 已下市的交易对 {symbol: 下市时间戳(毫秒)}，exchangeInfo 中的状态为 SETTLING，K线只到下市时间为止
+        :param port: 监听端口，0 表示随机端口
+        """
+        self.symbols = list(symbols)
+        self.listing_time = listing_time
+        self.latency = latency
+        self.weight_limit = weight_limit
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.error_every = error_every
+        self.storage = get_storage(data_dir, backend) if data_dir else None
+        self.delisted = dict(delisted or {})
+        self.port = port
+        self.stats = {"requests": 0, "klines": 0, "rows": 0, "rate_limited": 0, "errors": 0}
+
+        self._exchange_info = None
+        if exchange_info_file:
+            with open(exchange_info_file, "r") as f:
+                self._exchange_info = json.load(f)
+        self._recorded = {}
+        self._lock = threading.Lock()
+        self._minute = 0
+        self._used_weight = 0
+        self._server = None
+        self._installed = None
+
+    # 响应内容 ----------
+
+    def exchange_info(self):
+        if self._exchange_info is not None:
+            return self._exchange_info
+        symbols = self.symbols
+        listing_times = {symbol: self.listing_time for symbol in symbols}
+        if self.storage is not None:
+            # 回放模式：交易对和上市时间取自数据目录
+            symbols = sorted({symbol for symbol, _ in self.storage.list_datasets()})
+            for symbol in symbols:
+                time_ranges = [self.storage.time_range(symbol, interval) for s, interval in self.storage.list_datasets() if s == symbol]
+                listing_times[symbol] = min(int(r[0].timestamp() * 1000) for r in time_ranges if r is not None)
+        return {"symbols": [{
+            "symbol": symbol, "pair": symbol, "status": status, "contractStatus": status, "contractType": "PERPETUAL",
+            "baseAsset": symbol[:-4], "quoteAsset": symbol[-4:], "onboardDate": listing_times[symbol],
+            "deliveryDate": self.delisted.get(symbol, FAKE_DELIVERY_DATE),
+        } for symbol in symbols for status in ["SETTLING" if symbol in self.delisted else "TRADING"]]}
+
+    def ticker_24h(self):
+        """
+        合成的24小时成交额，由交易对名称决定 (不同交易对不同，每次请求相同)
+        """
+        symbols = self.symbols if self.storage is None else sorted({symbol for symbol, _ in self.storage.list_datasets()})
+        return [{"symbol": symbol, "quoteVolume": f"{sum(map(ord, symbol)) % 97 * 1e6:.2f}"} for symbol in symbols]
+
+    def _recorded_rows(self, symbol, interval):
+        key = (symbol, interval)
+        with self._lock:
+            if key not in self._recorded:
+                df = self.storage.read(symbol, interval)
+                self._recorded[key] = (df["Open time"].values.astype("datetime64[ms]").astype(np.int64) if not df.empty
+                                       else np.empty(0, dtype=np.int64), df)
+            return self._recorded[key]
+
+    def klines(self, symbol, interval, start_time, end_time, limit):
+        step = INTERVAL_MILLISECONDS[interval]
+        end_time = min(end_time, int(time.time() * 1000), self.delisted.get(symbol, FAKE_DELIVERY_DATE))
+        if self.storage is not None:
+            open_times, df = self._recorded_rows(symbol, interval)
+            first = np.searchsorted(open_times, start_time)
+            last = min(np.searchsorted(open_times, end_time, side="right"), first + limit)
+            page = df.iloc[first:last]
+            return [[int(t), str(o), str(h), str(l), str(c), str(v), int(t) + step - 1, str(q), int(n), str(tb), str(tq), "0"]
+                    for t, o, h, l, c, v, q, n, tb, tq in zip(
+                        open_times[first:last], page["Open"], page["High"], page["Low"], page["Close"], page["Volume"],
+                        page["Quote asset volume"], page["Number of trades"], page["Taker buy base asset volume"],
+                        page["Taker buy quote asset volume"])]
+
+        if symbol not in self.symbols:
+            return None
+        first = max(start_time, self.listing_time)
+        first += (-first) % step
+        open_times = np.arange(first, end_time + 1, step, dtype=np.int64)[:limit]
+        return synthetic_kline_rows(symbol, interval, open_times)
+
+    def _charge(self, weight):
+        """
+        按分钟统计服务端权重，返回 (本分钟已用权重, 是否超限)
+        """
+        with self._lock:
+            self.stats["requests"] += 1
+            minute = int(time.time() // 60)
+            if minute != self._minute:
+                self._minute, self._used_weight = minute, 0
+            self._used_weight += weight
+            forced = self.rate_limit_every and self.stats["requests"] % self.rate_limit_every == 0
+            limited = forced or (self.weight_limit is not None and self._used_weight > self.weight_limit)
+            if limited:
+                self.stats["rate_limited"] += 1
+            return self._used_weight, limited
+
+    def _fail(self):
+        """
+        是否让这个请求返回 500
+        """
+        with self._lock:
+            if not self.error_every or self.stats["requests"] % self.error_every:
+                return False
+            self.stats["errors"] += 1
+            return True
+
+    # 服务 ----------
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # 响应头和响应体分两次写入，关闭 Nagle 算法避免每个请求多等一个延迟确认
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, headers=None):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, str(value))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+                if url.path.endswith("/exchangeInfo"):
+                    used, limited = fake._charge(1)
+                    if limited:
+                        return self._send(429, {"code": -1003, "msg": "Too many requests."},
+                                          {USED_WEIGHT_HEADER: used, RETRY_AFTER_HEADER: fake.retry_after})
+                    return self._send(200, fake.exchange_info(), {USED_WEIGHT_HEADER: used})
+
+                if url.path.endswith("/ticker/24hr"):
+                    used, limited = fake._charge(40)
+                    if limited:
+                        return self._send(429, {"code": -1003, "msg": "Too many requests."},
+                                          {USED_WEIGHT_HEADER: used, RETRY_AFTER_HEADER: fake.retry_after})
+                    return self._send(200, fake.ticker_24h(), {USED_WEIGHT_HEADER: used})
+
+                if url.path.endswith("/klines"):
+                    limit = min(int(query.get("limit", 500)), 1500)
+                    used, limited = fake._charge(kline_request_weight(limit))
+                    if limited:
+                        return self._send(429, {"code": -1003, "msg": "Too many requests."},
+                                          {USED_WEIGHT_HEADER: used, RETRY_AFTER_HEADER: fake.retry_after})
+                    if fake._fail():
+                        return self._send(500, {"code": -1000, "msg": "An unknown error occurred."}, {USED_WEIGHT_HEADER: used})
+                    interval = query.get("interval")
+                    if interval not in INTERVAL_MILLISECONDS:
+                        return self._send(400, {"code": -1120, "msg": "Invalid interval."}, {USED_WEIGHT_HEADER: used})
+                    rows = fake.klines(query.get("symbol"), interval, int(query.get("startTime", 0)),
+                                       int(query.get("endTime", time.time() * 1000)), limit)
+                    if rows is None:
+                        return self._send(400, {"code": -1121, "msg": "Invalid symbol."}, {USED_WEIGHT_HEADER: used})
+                    with fake._lock:
+                        fake.stats["klines"] += 1
+                        fake.stats["rows"] += len(rows)
+                    return self._send(200, rows, {USED_WEIGHT_HEADER: used})
+
+                self._send(404, {"code": -1, "msg": "Not found."})
+
+        return Handler
+
+    def start(self):
+        """
+        在后台线程启动服务
+        :return: 服务地址，例如 http://127.0.0.1:12345
+        """
+        self._server = ThreadingHTTPServer(("127.0.0.1", self.port), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.url
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def install(self, client_weight_limit=None):
+        """
+        把所有市场的K线、exchangeInfo 和 ticker/24hr 地址指向本服务，并清空 exchangeInfo 缓存；stop 时恢复
+        :param client_weight_limit: 替换客户端限速器的每分钟权重上限 (基准测试时可以调大，只测量代码本身的吞吐)；
+                                    None 表示保留原来的限速器
+        """
+        self._installed = {name: (market.kline_url, market.exchange_info_url, market.ticker_url, market.limiter)
+                           for name, market in MARKETS.items()}
+        for market in MARKETS.values():
+            market.kline_url = f"{self.url}/{market.name}/klines"
+            market.exchange_info_url = f"{self.url}/{market.name}/exchangeInfo"
+            market.ticker_url = f"{self.url}/{market.name}/ticker/24hr"
+            if client_weight_limit is not None:
+                market.limiter = WeightRateLimiter(client_weight_limit)
+        clear_exchange_info_cache()
+
+    def stop(self):
+        if self._installed is not None:
+            for name, (kline_url, exchange_info_url, ticker_url, limiter) in self._installed.items():
+                market = MARKETS[name]
+                market.kline_url, market.exchange_info_url, market.ticker_url, market.limiter = \
+                    kline_url, exchange_info_url, ticker_url, limiter
+            self._installed = None
+            clear_exchange_info_cache()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakeKlineStream:
+    """
+    本地的 Binance WebSocket 组合流替身，用于离线测试 live.py。
+    连接地址的格式与真实的组合流相同 ({url}?streams=btcusdt@kline_1m/ethusdt@kline_1m)，
+    推送 {"stream": ..., "data": {"e": "kline", "k": {...}}} 事件，K线内容与 FakeBinanceServer 的合成数据一致，
+    所以 WebSocket 收到的K线和 REST 补下载的K线可以直接比较。
+    测试可以推送任意一根K线 (包括乱序的)，也可以强制断开所有连接模拟断线；realtime=True 时每根K线收盘后自动推送。
+    """
+
+    def __init__(self, realtime=False, port=0):
+        """
+        :param realtime: 是否在每根K线收盘后自动推送给订阅了它的连接
+        :param port: 监听端口，0 表示随机端口
+        """
+        if websockets is None:
+            raise ImportError("WebSocket 替身需要安装 websockets: pip install websockets")
+        self.realtime = realtime
+        self.port = port
+        self.stats = {"connections": 0, "messages": 0, "disconnects": 0}
+
+        # 当前连接 -> 订阅的流名称集合，只在服务的事件循环中访问
+        self._connections = {}
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._clock = None
+
+    @staticmethod
+    def kline_event(symbol, interval, open_time, closed=True):
+        """
+        生成一条组合流 kline 消息，数值与 synthetic_kline_rows 相同
+        :param open_time: K线开始时间，时间戳(毫秒)
+        :param closed: K线是否已收盘 (k.x)
+        """
+        t, o, h, l, c, v, close_time, q, n, taker_base, taker_quote, _ = \
+            synthetic_kline_rows(symbol, interval, np.array([open_time], dtype=np.int64))[0]
+        return json.dumps({"stream": f"{symbol.lower()}@kline_{interval}", "data": {
+            "e": "kline", "E": int(time.time() * 1000), "s": symbol, "k": {
+                "t": t, "T": close_time, "s": symbol, "i": interval, "o": o, "c": c, "h": h, "l": l, "v": v, "n": n,
+                "x": closed, "q": q, "V": taker_base, "Q": taker_quote, "B": "0"}}})
+
+    # 服务 (在后台线程的事件循环中运行) ----------
+
+    async def _handler(self, connection):
+        # websockets 新版本的连接对象通过 request.path 取路径，旧版本为 path
+        request = getattr(connection, "request", None)
+        path = request.path if request is not None else connection.path
+        streams = parse_qs(urlparse(path).query).get("streams", [""])[0]
+        self._connections[connection] = set(streams.split("/")) - {""}
+        self.stats["connections"] += 1
+        try:
+            await connection.wait_closed()
+        finally:
+            self._connections.pop(connection, None)
+
+    async def _send(self, stream, message):
+        recipients = [connection for connection, streams in self._connections.items() if stream in streams]
+        for connection in recipients:
+            try:
+                await connection.send(message)
+                self.stats["messages"] += 1
+            except Exception:
+                pass
+        return len(recipients)
+
+    async def _disconnect(self):
+        connections = list(self._connections)
+        # 非正常的关闭代码，客户端会当作连接异常断开处理
+        await asyncio.gather(*(connection.close(code=1011, reason="forced disconnect") for connection in connections),
+                             return_exceptions=True)
+        self.stats["disconnects"] += len(connections)
+        return len(connections)
+
+    async def _realtime_clock(self):
+        """
+        每根K线收盘后推送给订阅了它的连接
+        """
+        sent = {}
+        while True:
+            now = int(time.time() * 1000)
+            for stream in {stream for streams in self._connections.values() for stream in streams}:
+                symbol, interval = stream.split("@kline_")
+                step = INTERVAL_MILLISECONDS[interval]
+                open_time = now // step * step - step
+                if sent.get(stream) != open_time:
+                    sent[stream] = open_time
+                    await self._send(stream, self.kline_event(symbol.upper(), interval, open_time))
+            await asyncio.sleep(0.2)
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    # 测试接口 ----------
+
+    def push(self, symbol, interval, open_time, closed=True):
+        """
+        向订阅了 {symbol}@kline_{interval} 的所有连接推送一根K线
+        :return: 收到消息的连接数
+        """
+        return self._call(self._send(f"{symbol.lower()}@kline_{interval}", self.kline_event(symbol, interval, open_time, closed)))
+
+    def disconnect(self):
+        """
+        强制断开所有当前连接 (客户端收到异常关闭，模拟网络中断)
+        :return: 断开的连接数
+        """
+        return self._call(self._disconnect())
+
+    def wait_for_connections(self, count, timeout=10):
+        """
+        等待累计建立 count 个连接 (包括重连)
+        :return: 是否在超时前达到
+        """
+        deadline = time.time() + timeout
+        while self.stats["connections"] < count or len(self._connections) == 0:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def start(self):
+        """
+        在后台线程启动服务
+        :return: 组合流地址，例如 ws://127.0.0.1:12345/stream，传给 LiveKlineIngestor 的 stream_url 或 live.py 的 --url
+        """
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+        errors = []
+
+        async def listen():
+            # websockets 的服务需要在运行中的事件循环里创建
+            self._server = await websockets.serve(self._handler, "127.0.0.1", self.port)
+            if self.realtime:
+                self._clock = asyncio.create_task(self._realtime_clock())
+
+        def serve():
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._loop.run_until_complete(listen())
+            except Exception as e:
+                errors.append(e)
+                return
+            finally:
+                started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            self._loop.close()
+            self._loop = None
+            raise errors[0]
+        return self.url
+
+    @property
+    def url(self):
+        return f"ws://127.0.0.1:{self._server.sockets[0].getsockname()[1]}/stream"
+
+    def stop(self):
+        if self._loop is None:
+            return
+
+        async def shutdown():
+            if self._clock is not None:
+                self._clock.cancel()
+            await self._disconnect()
+            self._server.close()
+            await self._server.wait_closed()
+
+        self._call(shutdown())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地 Binance 替身服务 (klines / exchangeInfo)")
+    parser.add_argument("--port", type=int, default=8000, help="监听端口")
+    parser.add_argument("--symbols", nargs="*", default=["BTCUSDT", "ETHUSDT"], help="合成数据的交易对")
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求的延迟（秒）")
+    parser.add_argument("--weight-limit", type=int, help="每分钟权重上限，超出返回 429")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="每隔多少个请求返回一次 429")
+    parser.add_argument("--data-dir", help="回放模式的数据目录")
+    parser.add_argument("--backend", default="pickle", help="回放数据目录的存储后端")
+    parser.add_argument("--exchange-info", help="回放用的 exchangeInfo json 文件")
+    parser.add_argument("--ws-port", type=int, help="同时启动 WebSocket 组合流替身的端口，每根K线收盘后自动推送")
+    args = parser.parse_args()
+
+    server = FakeBinanceServer(args.symbols, latency=args.latency, weight_limit=args.weight_limit,
+                               rate_limit_every=args.rate_limit_every, data_dir=args.data_dir, backend=args.backend,
+                               exchange_info_file=args.exchange_info, port=args.port)
+    print(f"[信息] 服务地址 {server.start()}，K线接口 /um/klines，exchangeInfo 接口 /um/exchangeInfo")
+    stream = None
+    if args.ws_port is not None:
+        stream = FakeKlineStream(realtime=True, port=args.ws_port)
+        print(f"[信息] 组合流地址 {stream.start()} (live.py --url)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+        if stream is not None:
+            stream.stop()
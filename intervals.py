@@ -0,0 +1,41 @@
+import numpy as np
+
+# 各K线周期对应的毫秒数 (1M 长度不固定，不在表中)
+INTERVAL_MILLISECONDS = {
+    "1m": 60 * 1000,
+    "3m": 3 * 60 * 1000,
+    "5m": 5 * 60 * 1000,
+    "15m": 15 * 60 * 1000,
+    "30m": 30 * 60 * 1000,
+    "1h": 60 * 60 * 1000,
+    "2h": 2 * 60 * 60 * 1000,
+    "4h": 4 * 60 * 60 * 1000,
+    "6h": 6 * 60 * 60 * 1000,
+    "8h": 8 * 60 * 60 * 1000,
+    "12h": 12 * 60 * 60 * 1000,
+    "1d": 24 * 60 * 60 * 1000,
+    "3d": 3 * 24 * 60 * 60 * 1000,
+    "1w": 7 * 24 * 60 * 60 * 1000,
+}
+
+
+def open_times_ms(df):
+    """
+    把 Open time 列转换为毫秒时间戳数组
+    :param df: K线 DataFrame
+    :return: int64 数组
+    """
+    return df["Open time"].values.astype("datetime64[ms]").astype(np.int64)
+
+
+def count_gaps(times_ms, interval):
+    """
+    统计相邻K线之间的缺口数量 (间隔大于一个周期即视为缺口)
+    :param times_ms: 已排序的毫秒时间戳数组
+    :param interval: K线周期。例如1m, 15m, 1d
+    :return: 缺口数量，周期长度不固定时返回 None
+    """
+    step = INTERVAL_MILLISECONDS.get(interval)
+    if step is None:
+        return None
+    return int(np.count_nonzero(np.diff(times_ms) > step))
@@ -0,0 +1,245 @@
+import argparse
+import asyncio
+import heapq
+import json
+import time
+
+import numpy as np
+
+from checkpoint import merge_pages
+from download import fetch_klines, parse_kline_rows
+from intervals import INTERVAL_MILLISECONDS
+from markets import DEFAULT_MARKET, get_market, get_market_storage
+from resample import materialize_update
+from tools import get_binance_u_based_futures, get_market_symbols
+
+# websockets 为可选依赖，只有使用实时订阅时才需要安装
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+# 单个连接最多订阅的流数量
+MAX_STREAMS_PER_CONNECTION = 200
+
+# 默认每隔多少秒把缓存的K线写入存储
+FLUSH_INTERVAL = 60
+
+# 断线重连的最长等待时间（秒）
+MAX_RECONNECT_DELAY = 60
+
+
+def kline_event_to_row(kline):
+    """
+    把 WebSocket kline 事件中的 k 字段转换成与 klines 接口相同格式的数组，方便复用 parse_kline_rows
+    """
+    return [kline["t"], kline["o"], kline["h"], kline["l"], kline["c"], kline["v"], kline["T"], kline["q"], kline["n"],
+            kline["V"], kline["Q"], "0"]
+
+
+class LiveKlineIngestor:
+    """
+    通过 WebSocket 组合流实时接收已收盘的K线，在内存中缓存并定期批量写入存储。
+    每个连接最多订阅 MAX_STREAMS_PER_CONNECTION 个交易对；每次 (重新) 连接后用 REST 补下载
+    断线期间缺失的K线，除此之外不再轮询 REST 接口。
+    """
+
+    def __init__(self, symbols, interval, output_dir, backend="pickle", stream_url=None,
+                 flush_interval=FLUSH_INTERVAL, materialize=None, market=DEFAULT_MARKET):
+        """
+        :param symbols: 交易对列表
+        :param interval: K线周期，例如 "1m", "15m"
+        :param output_dir: 数据保存文件夹 (需要先用下载方法下载历史数据)
+        :param backend: 存储后端，"pickle" (默认) 或 "parquet"，推荐 parquet (追加只写入新的分段)
+        :param stream_url: 组合流地址，默认使用市场对应的地址，测试时可以指向本地服务
+        :param flush_interval: 写入存储的间隔（秒）
+        :param materialize: 同时维护的高级别周期列表，例如 ["1h", "4h", "1d"]
+        :param market: 市场 "spot" / "um" (默认) / "cm"
+        """
+        if websockets is None:
+            raise ImportError("实时订阅需要安装 websockets: pip install websockets")
+        self.symbols = list(symbols)
+        self.interval = interval
+        self.market = get_market(market)
+        self.storage = get_market_storage(output_dir, backend, self.market)
+        self.stream_url = stream_url or self.market.stream_url
+        self.flush_interval = flush_interval
+        self.materialize = materialize
+        # 尚未写入存储的数据：已收盘K线的原始数组，以及 REST 补下载的 DataFrame
+        self._rows = {}
+        self._frames = {}
+        # 每个交易对已经连续覆盖到的最后一根K线的开始时间，重连后从这里开始补下载
+        self._last_open_time = {}
+        # 与覆盖位置还不连续的已收盘K线的开始时间 (小顶堆)，补下载填上中间的缺口后并入覆盖位置
+        self._ahead = {}
+
+    def run(self, duration=None):
+        """
+        启动订阅，阻塞运行直到 duration 秒后或 Ctrl+C，退出前写入所有缓存数据
+        :param duration: 运行时长（秒），None 表示一直运行
+        """
+        try:
+            asyncio.run(self._run(duration))
+        except KeyboardInterrupt:
+            print("[信息] 收到中断信号，已停止订阅")
+
+    async def _run(self, duration):
+        loop = asyncio.get_running_loop()
+        # 先从存储中读取每个交易对的最后时间，作为第一次连接时补下载的起点
+        for symbol in self.symbols:
+            time_range = await loop.run_in_executor(None, self.storage.time_range, symbol, self.interval)
+            if time_range is not None:
+                self._last_open_time[symbol] = int(time_range[1].timestamp() * 1000)
+
+        groups = [self.symbols[i:i + MAX_STREAMS_PER_CONNECTION] for i in range(0, len(self.symbols), MAX_STREAMS_PER_CONNECTION)]
+        tasks = [asyncio.create_task(self._connection(group)) for group in groups]
+        tasks.append(asyncio.create_task(self._flush_loop()))
+        print(f"[信息] 开始订阅 {len(self.symbols)} 个交易对的 {self.interval} K线 ({len(groups)} 个连接)")
+        try:
+            await asyncio.wait(tasks, timeout=duration)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await loop.run_in_executor(None, self._write, *self._take_buffers())
+
+    async def _connection(self, symbols):
+        """
+        维护一个组合流连接，断线后按指数退避重连，每次连接成功后补下载断线期间的数据
+        """
+        streams = "/".join(f"{symbol.lower()}@kline_{self.interval}" for symbol in symbols)
+        url = f"{self.stream_url}?streams={streams}"
+        delay = 1
+        while True:
+            backfill = None
+            try:
+                async with websockets.connect(url, ping_interval=60, max_size=None) as connection:
+                    delay = 1
+                    backfill = asyncio.create_task(self._backfill(symbols))
+                    async for message in connection:
+                        self._on_message(message)
+                    await backfill
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[警告] 连接断开: {e}，{delay} 秒后重连...")
+            finally:
+                # 连接断开时停止这次的补下载，下次连接会从覆盖位置重新补，避免两个补下载同时进行
+                if backfill is not None and not backfill.done():
+                    backfill.cancel()
+                    await asyncio.gather(backfill, return_exceptions=True)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _on_message(self, message):
+        event = json.loads(message).get("data", {})
+        kline = event.get("k")
+        # 只保留已收盘的K线，未收盘的更新直接丢弃
+        if event.get("e") != "kline" or not kline["x"]:
+            return
+        symbol = event["s"]
+        self._rows.setdefault(symbol, []).append(kline_event_to_row(kline))
+
+        # 只有与已有数据连续时才推进覆盖位置，补下载完成前断线的话下次仍从缺口开始补；
+        # 不连续的K线先记下来，补下载填上缺口后再并入
+        step = INTERVAL_MILLISECONDS.get(self.interval)
+        last_open_time = self._last_open_time.get(symbol)
+        if last_open_time is None or step is None or kline["t"] <= last_open_time + step:
+            self._advance(symbol, kline["t"])
+        else:
+            heapq.heappush(self._ahead.setdefault(symbol, []), kline["t"])
+
+    def _advance(self, symbol, open_time):
+        """
+        把覆盖位置推进到 open_time，并把之前收到的、现在已经连续的K线一起并入
+        """
+        step = INTERVAL_MILLISECONDS.get(self.interval)
+        last_open_time = max(self._last_open_time.get(symbol) or 0, open_time)
+        ahead = self._ahead.get(symbol, [])
+        while ahead and (step is None or ahead[0] <= last_open_time + step):
+            last_open_time = max(last_open_time, heapq.heappop(ahead))
+        self._last_open_time[symbol] = last_open_time
+
+    async def _backfill(self, symbols):
+        """
+        用 REST 补下载每个交易对从最后收到的K线到现在之间的已收盘K线
+        """
+        loop = asyncio.get_running_loop()
+        now = int(time.time() * 1000)
+        for symbol in symbols:
+            last_open_time = self._last_open_time.get(symbol)
+            if last_open_time is None:
+                print(f"[提示] {symbol} 没有历史数据，不补下载 (请先使用下载方法下载历史数据)")
+                continue
+            if now - last_open_time < 2 * INTERVAL_MILLISECONDS.get(self.interval, 0):
+                continue
+            try:
+                df = await loop.run_in_executor(
+                    None, lambda: fetch_klines(symbol, self.interval, last_open_time + 1, now, market=self.market))
+            except Exception as e:
+                print(f"[错误] {symbol} 补下载失败: {e}")
+                continue
+            # 去掉还未收盘的最后一根K线，它会在收盘后从 WebSocket 收到
+            if not df.empty:
+                df = df[df["Close time"].values.astype("datetime64[ms]").astype(np.int64) < now]
+            if df.empty:
+                continue
+            self._frames.setdefault(symbol, []).append(df)
+            # 补下载期间从 WebSocket 收到的K线 (被上面当作未收盘去掉的那根) 在这里一起并入覆盖位置
+            self._advance(symbol, int(df["Open time"].iloc[-1].timestamp() * 1000))
+            print(f"[信息] {symbol} 补下载 {len(df)} 根K线")
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # 在事件循环中取出缓存，写文件放到线程池中执行，不阻塞接收消息
+            await loop.run_in_executor(None, self._write, *self._take_buffers())
+
+    def _take_buffers(self):
+        rows, self._rows = self._rows, {}
+        frames, self._frames = self._frames, {}
+        return rows, frames
+
+    def flush(self):
+        """
+        把缓存的K线批量追加到存储 (订阅运行期间由定时任务在事件循环中调用，这里用于订阅结束后手动写入)
+        :return: 写入的K线数量
+        """
+        return self._write(*self._take_buffers())
+
+    def _write(self, rows, frames):
+        written = 0
+        for symbol in set(rows) | set(frames):
+            # 补下载的数据在前，WebSocket 收到的在后，同一根K线以后者为准
+            df = merge_pages(frames.get(symbol, []) + [parse_kline_rows(rows.get(symbol, []))])
+            if df.empty:
+                continue
+            try:
+                self.storage.append(symbol, self.interval, df)
+                if self.materialize:
+                    materialize_update(self.storage, symbol, self.interval, self.materialize,
+                                       int(df["Open time"].iloc[0].timestamp() * 1000))
+                written += len(df)
+            except Exception as e:
+                print(f"[错误] 写入 {symbol} 数据时出错: {e}")
+        if written:
+            print(f"[完成] 写入 {written} 根K线")
+        return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="通过 WebSocket 实时更新K线数据")
+    parser.add_argument("data_dir", help="数据目录")
+    parser.add_argument("interval", help="K线周期，例如 1m, 15m")
+    parser.add_argument("symbols", nargs="*", help="交易对列表，默认订阅所有U本位永续合约 (其他市场为所有交易中的交易对)")
+    parser.add_argument("--backend", default="pickle", help="存储后端 pickle / parquet")
+    parser.add_argument("--flush-interval", type=int, default=FLUSH_INTERVAL, help="写入存储的间隔（秒）")
+    parser.add_argument("--materialize", nargs="*", help="同时维护的高级别周期，例如 1h 4h 1d")
+    parser.add_argument("--market", default=DEFAULT_MARKET, help="市场 spot / um / cm")
+    parser.add_argument("--url", help="组合流地址，默认使用市场对应的地址")
+    args = parser.parse_args()
+
+    symbols = args.symbols or (get_binance_u_based_futures() if args.market == DEFAULT_MARKET else get_market_symbols(args.market))
+    LiveKlineIngestor(symbols, args.interval, args.data_dir, backend=args.backend, stream_url=args.url,
+                      flush_interval=args.flush_interval, materialize=args.materialize, market=args.market).run()
@@ -12,7 +12,10 @@ from tools import get_binance_u_based_futures
 daily_output_directory = "/Users/zhoupeng/Desktop/crypto_database/data/daily"
 MIN15_output_directory = "/Users/zhoupeng/Desktop/crypto_database/data/15MINS"
 
-usdt_futures_pairs = get_binance_u_based_futures(base_asset="USDT")
+# exchangeInfo 快照，同一次运行内的上市时间查询都复用这份数据
+exchange_info_cache = "/Users/zhoupeng/Desktop/crypto_database/data/exchange_info.json"
+
+usdt_futures_pairs = get_binance_u_based_futures(base_asset="USDT", cache_file=exchange_info_cache)
 print("当前交易所上USDT合约交易对数量: ", len(usdt_futures_pairs))
 
 # 配置文件 ----------
@@ -0,0 +1,159 @@
+import json
+import os
+import threading
+import time
+
+from intervals import INTERVAL_MILLISECONDS, count_gaps, open_times_ms
+
+# 多进程同时更新时用文件锁保护清单 (Windows 上没有 fcntl，只保留线程锁)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 清单文件名，保存在数据目录下
+MANIFEST_FILE = "manifest.json"
+
+# 每个清单文件一把线程锁
+_locks = {}
+_locks_guard = threading.Lock()
+
+# 已读取的清单内容，按文件的 (修改时间, 大小, inode) 判断是否需要重新读取，只读使用
+_cache = {}
+_cache_guard = threading.Lock()
+
+
+def _lock_for(path):
+    with _locks_guard:
+        return _locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+def summarize(df, interval):
+    """
+    计算一个数据集的清单条目 (不含文件指纹)
+    :param df: 按 Open time 排序的K线数据 (至少包含 Open time 列)
+    :param interval: K线周期
+    :return: {"first", "last", "rows", "gaps"}，时间为毫秒时间戳
+    """
+    if df.empty:
+        return {"first": None, "last": None, "rows": 0, "gaps": 0}
+    times = open_times_ms(df)
+    return {"first": int(times[0]), "last": int(times[-1]), "rows": int(len(times)), "gaps": count_gaps(times, interval)}
+
+
+def summarize_append(entry, df, interval):
+    """
+    根据追加前的清单条目和新追加的数据推算新的条目，不需要读取已有历史。
+    没有缺口时，已有范围内的新行一定已经存在 (不增加行数)；如果新行早于第一根K线，
+    或者已有数据有缺口 (或缺口数未知) 而新行落在已有范围内，可能填补了缺口，无法推算。
+    :param entry: 追加前的清单条目
+    :param df: 新追加的数据 (按 Open time 排序)
+    :param interval: K线周期
+    :return: {"first", "last", "rows", "gaps"}，无法推算时返回 None (需要重新扫描数据)
+    """
+    if entry is None or entry["rows"] == 0:
+        return summarize(df, interval)
+    if df.empty:
+        return {key: entry[key] for key in ("first", "last", "rows", "gaps")}
+
+    times = open_times_ms(df)
+    if times[0] < entry["first"] or (entry["gaps"] != 0 and times[0] < entry["last"]):
+        return None
+    new_times = times[times > entry["last"]]
+    gaps = entry["gaps"]
+    if gaps is not None and len(new_times):
+        # 新数据内部的缺口 + 与原有最后一根K线之间的缺口
+        gaps += count_gaps(new_times, interval)
+        if new_times[0] - entry["last"] > INTERVAL_MILLISECONDS[interval]:
+            gaps += 1
+    return {
+        "first": min(entry["first"], int(times[0])),
+        "last": max(entry["last"], int(times[-1])),
+        "rows": entry["rows"] + int(len(new_times)),
+        "gaps": gaps,
+    }
+
+
+class Manifest:
+    """
+    数据目录的元数据清单 (manifest.json)，记录每个数据集的首尾时间、行数、周期、缺口数量和文件指纹。
+    下载和更新写入数据时由存储层自动维护，完整性检查和更新起点只需要查询清单，不用反序列化数据文件。
+    """
+
+    def __init__(self, data_dir):
+        """
+        :param data_dir: 数据目录
+        """
+        self.path = os.path.join(data_dir, MANIFEST_FILE)
+        self._lock = _lock_for(self.path)
+
+    @staticmethod
+    def key(symbol, interval):
+        return f"{symbol}_{interval}"
+
+    def load(self):
+        """
+        文件没有变化时直接返回上次读取的内容，完整性检查逐个查询时不会每次都重新解析整个清单
+        :return: {数据集名称: 条目} (只读，修改前先复制)，清单不存在或损坏时返回空字典
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return {}
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        with _cache_guard:
+            cached = _cache.get(os.path.abspath(self.path))
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except Exception as e:
+            print(f"[警告] 无法读取清单 {self.path}: {e}")
+            return {}
+        with _cache_guard:
+            _cache[os.path.abspath(self.path)] = (signature, entries)
+        return entries
+
+    def get(self, symbol, interval, checksum=None):
+        """
+        查询单个数据集的条目
+        :param checksum: 如果提供，只有与清单中的文件指纹一致时才返回条目
+        :return: 条目 dict 或 None
+        """
+        entry = self.load().get(self.key(symbol, interval))
+        if entry is None or (checksum is not None and entry.get("checksum") != checksum):
+            return None
+        return dict(entry)
+
+    def update(self, symbol, interval, summary, checksum):
+        """
+        写入 (覆盖) 单个数据集的条目
+        :param summary: summarize / summarize_append 的结果
+        :param checksum: 数据文件指纹
+        """
+        entry = dict(summary, symbol=symbol, interval=interval, checksum=checksum, updated=int(time.time() * 1000))
+        self._modify(lambda entries: entries.__setitem__(self.key(symbol, interval), entry))
+        return entry
+
+    def remove(self, symbol, interval):
+        self._modify(lambda entries: entries.pop(self.key(symbol, interval), None))
+
+    def _modify(self, change):
+        """
+        在锁内重新读取清单、修改后原子写回，避免多个线程/进程互相覆盖
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with self._lock, open(f"{self.path}.lock", "w") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = dict(self.load())
+            change(entries)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,134 @@
+import os
+
+from intervals import INTERVAL_MILLISECONDS
+from rate_limit import (coinm_rate_limiter, futures_rate_limiter, kline_request_weight, spot_kline_request_weight,
+                        spot_rate_limiter)
+from storage import get_storage
+
+# 默认市场 (U本位合约)，兼容原有的数据目录
+DEFAULT_MARKET = "um"
+
+# 单页K线条数上限 (三个市场都支持 1000)
+MARKET_KLINE_LIMIT = 1000
+
+
+class Market:
+    """
+    一个 Binance 市场 (现货 / U本位合约 / 币本位合约) 的接口配置。
+    所有市场共用同一个连接池和下载逻辑，只是接口地址、权重规则、限速器、上市时间来源和存储目录不同。
+    """
+
+    def __init__(self, name, kline_url, exchange_info_url, stream_url, agg_trades_url, ticker_url, limiter, kline_weight,
+                 listing_time_source, namespace="", max_window_ms=None, exchange_info_weight=1, agg_trades_weight=20,
+                 ticker_weight=40):
+        """
+        :param name: 市场名称 "spot" / "um" / "cm"
+        :param kline_url: K线接口地址
+        :param exchange_info_url: exchangeInfo 接口地址
+        :param stream_url: WebSocket 组合流地址
+        :param agg_trades_url: 归集成交 (aggTrades) 接口地址
+        :param ticker_url: 24小时行情 (ticker/24hr) 接口地址
+        :param limiter: 该市场的权重限速器
+        :param kline_weight: 计算一次K线请求权重的函数，参数为 limit
+        :param listing_time_source: 上市时间来源，"onboardDate" (exchangeInfo 字段) 或 "first_kline" (第一根K线)
+        :param namespace: 数据目录下的子目录，避免不同市场的同名交易对互相覆盖；空字符串表示直接放在数据目录下
+        :param max_window_ms: 单次请求 startTime 和 endTime 之间允许的最大跨度，None 表示不限制
+        :param exchange_info_weight: exchangeInfo 请求的权重
+        :param agg_trades_weight: aggTrades 请求的权重
+        :param ticker_weight: 不带 symbol 参数 (所有交易对) 的 ticker/24hr 请求的权重
+        """
+        self.name = name
+        self.kline_url = kline_url
+        self.exchange_info_url = exchange_info_url
+        self.stream_url = stream_url
+        self.agg_trades_url = agg_trades_url
+        self.ticker_url = ticker_url
+        self.limiter = limiter
+        self.kline_weight = kline_weight
+        self.listing_time_source = listing_time_source
+        self.namespace = namespace
+        self.max_window_ms = max_window_ms
+        self.exchange_info_weight = exchange_info_weight
+        self.agg_trades_weight = agg_trades_weight
+        self.ticker_weight = ticker_weight
+
+    def kline_limit(self, interval):
+        """
+        每页请求的K线条数：不超过 MARKET_KLINE_LIMIT，并保证一页的时间跨度不超过 max_window_ms
+        """
+        step = INTERVAL_MILLISECONDS.get(interval)
+        if self.max_window_ms is None or step is None:
+            return MARKET_KLINE_LIMIT
+        return max(1, min(MARKET_KLINE_LIMIT, self.max_window_ms // step))
+
+    def data_dir(self, output_dir):
+        """
+        该市场在数据目录下实际使用的目录
+        """
+        return os.path.join(output_dir, self.namespace) if self.namespace else output_dir
+
+    def __repr__(self):
+        return f"Market({self.name})"
+
+
+MARKETS = {
+    "spot": Market(
+        name="spot",
+        kline_url="https://api.binance.com/api/v3/klines",
+        exchange_info_url="https://api.binance.com/api/v3/exchangeInfo",
+        stream_url="wss://stream.binance.com:9443/stream",
+        agg_trades_url="https://api.binance.com/api/v3/aggTrades",
+        ticker_url="https://api.binance.com/api/v3/ticker/24hr",
+        limiter=spot_rate_limiter,
+        kline_weight=spot_kline_request_weight,
+        listing_time_source="first_kline",
+        namespace="spot",
+        exchange_info_weight=20,
+        agg_trades_weight=4,
+        ticker_weight=80,
+    ),
+    "um": Market(
+        name="um",
+        kline_url="https://fapi.binance.com/fapi/v1/klines",
+        exchange_info_url="https://fapi.binance.com/fapi/v1/exchangeInfo",
+        stream_url="wss://fstream.binance.com/stream",
+        agg_trades_url="https://fapi.binance.com/fapi/v1/aggTrades",
+        ticker_url="https://fapi.binance.com/fapi/v1/ticker/24hr",
+        limiter=futures_rate_limiter,
+        kline_weight=kline_request_weight,
+        listing_time_source="onboardDate",
+    ),
+    "cm": Market(
+        name="cm",
+        kline_url="https://dapi.binance.com/dapi/v1/klines",
+        exchange_info_url="https://dapi.binance.com/dapi/v1/exchangeInfo",
+        stream_url="wss://dstream.binance.com/stream",
+        agg_trades_url="https://dapi.binance.com/dapi/v1/aggTrades",
+        ticker_url="https://dapi.binance.com/dapi/v1/ticker/24hr",
+        limiter=coinm_rate_limiter,
+        kline_weight=kline_request_weight,
+        listing_time_source="onboardDate",
+        namespace="coinm",
+        # 币本位合约的K线接口一次最多查询200天
+        max_window_ms=200 * 24 * 60 * 60 * 1000,
+    ),
+}
+
+
+def get_market(market=DEFAULT_MARKET):
+    """
+    :param market: 市场名称 "spot" / "um" / "cm"，也可以直接传入 Market 对象
+    :return: Market 对象
+    """
+    if isinstance(market, Market):
+        return market
+    if market not in MARKETS:
+        raise ValueError(f"未知的市场 {market}，可选: {', '.join(MARKETS)}")
+    return MARKETS[market]
+
+
+def get_market_storage(data_dir, backend="pickle", market=DEFAULT_MARKET):
+    """
+    获取某个市场在数据目录下的存储对象 (现货和币本位合约保存在各自的子目录中)
+    """
+    return get_storage(get_market(market).data_dir(data_dir), backend)
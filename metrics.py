@@ -0,0 +1,244 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+
+# 全局配置：结构化日志文件 (JSON Lines，每个事件一行) 和是否在运行结束时打印汇总
+_config = {"log_file": None, "summary": True}
+
+# 当前正在进行的运行；没有运行时所有记录函数都直接返回
+_active = None
+_active_lock = threading.Lock()
+
+# 最近一次运行结束时的汇总
+_last_summary = None
+
+# 汇总中各阶段的显示名称 (结构化日志中使用英文名称)
+STAGE_LABELS = {
+    "network": "网络",
+    "limiter_wait": "限速等待",
+    "parse": "解析",
+    "concat": "合并",
+    "journal": "分页记录",
+    "write": "写入",
+    "materialize": "高级别周期",
+    "summary": "查询清单",
+    "scan": "扫描缺口",
+}
+
+
+class RunMetrics:
+    """
+    一次下载 / 更新 / 检查运行的指标，所有线程共享一个实例。
+    记录每个请求的延迟、权重、状态码和限速等待时间，各阶段 (解析、合并、写入等) 的累计耗时，
+    以及每个交易对的行数和速度，结束时汇总，用于根据数据调整 max_workers 等参数。
+    """
+
+    def __init__(self, name, log_file=None):
+        """
+        :param name: 运行名称，例如 "download"
+        :param log_file: 结构化日志文件路径，None 表示不写日志
+        """
+        self.name = name
+        self.started = time.perf_counter()
+        self.latencies = []
+        self.weight = 0
+        self.statuses = {}
+        self.retries = 0
+        self.limiter_wait = 0.0
+        self.peak_used_weight = 0
+        self.weight_limit = None
+        self.stages = {}
+        self.symbols = {}
+        self._lock = threading.Lock()
+        self._log = open(log_file, "a") if log_file else None
+
+    def log(self, event, **fields):
+        """
+        写入一条结构化日志
+        """
+        if self._log is None:
+            return
+        line = json.dumps({"time": time.time(), "run": self.name, "event": event, **fields}, ensure_ascii=False)
+        with self._lock:
+            self._log.write(line + "\n")
+
+    def record_request(self, url, latency, weight, status, wait=0.0, used_weight=None, weight_limit=None, attempt=0):
+        """
+        :param url: 请求地址
+        :param latency: 请求耗时（秒），不包含限速等待
+        :param weight: 请求权重
+        :param status: HTTP 状态码，请求异常时为 None
+        :param wait: 请求前在限速器中等待的时间（秒）
+        :param used_weight: 响应头中服务器统计的本分钟已用权重
+        :param weight_limit: 限速器的每分钟权重上限
+        :param attempt: 第几次尝试 (0 表示第一次)
+        """
+        with self._lock:
+            self.latencies.append(latency)
+            self.weight += weight
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.retries += attempt > 0
+            self.limiter_wait += wait
+            if used_weight is not None:
+                self.peak_used_weight = max(self.peak_used_weight, int(used_weight))
+            if weight_limit is not None:
+                self.weight_limit = weight_limit
+        self.log("request", url=url, latency=latency, weight=weight, status=status, wait=wait, used_weight=used_weight,
+                 attempt=attempt)
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            count, total = self.stages.get(name, (0, 0.0))
+            self.stages[name] = (count + 1, total + seconds)
+
+    def record_symbol(self, symbol, rows, seconds):
+        """
+        :param symbol: 交易对
+        :param rows: 下载 / 更新的行数
+        :param seconds: 该交易对的总耗时（秒）
+        """
+        with self._lock:
+            self.symbols[symbol] = {"rows": rows, "seconds": seconds}
+        self.log("symbol", symbol=symbol, rows=rows, seconds=seconds, rows_per_s=rows / seconds if seconds else None)
+
+    def summary(self):
+        """
+        :return: 汇总指标 dict (耗时单位为秒)
+        """
+        with self._lock:
+            latencies = np.array(self.latencies)
+            rows = sum(item["rows"] for item in self.symbols.values())
+            elapsed = time.perf_counter() - self.started
+            return {
+                "name": self.name,
+                "elapsed": elapsed,
+                "requests": len(latencies),
+                "failed_requests": sum(count for status, count in self.statuses.items() if status is None or status >= 400),
+                "rate_limited": self.statuses.get(429, 0) + self.statuses.get(418, 0),
+                "retries": self.retries,
+                "weight": self.weight,
+                "weight_per_minute": self.weight / elapsed * 60 if elapsed else 0.0,
+                "peak_used_weight": self.peak_used_weight,
+                "weight_limit": self.weight_limit,
+                "latency_p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "latency_p95": float(np.percentile(latencies, 95)) if len(latencies) else None,
+                "latency_max": float(latencies.max()) if len(latencies) else None,
+                "network": float(latencies.sum()),
+                "limiter_wait": self.limiter_wait,
+                "stages": {name: total for name, (_, total) in self.stages.items()},
+                "rows": rows,
+                "rows_per_s": rows / elapsed if elapsed else 0.0,
+                "symbols": dict(self.symbols),
+            }
+
+    def print_summary(self, summary=None):
+        summary = summary or self.summary()
+        print(f"[总结] {summary['name']}: 耗时 {summary['elapsed']:.1f}s，请求 {summary['requests']} 次 "
+              f"(失败 {summary['failed_requests']}，限频 {summary['rate_limited']}，重试 {summary['retries']})，"
+              f"权重 {summary['weight']} (平均每分钟 {summary['weight_per_minute']:.0f})")
+        if summary["requests"]:
+            limit = f" / {summary['weight_limit']}" if summary["weight_limit"] else ""
+            print(f"[总结] 请求延迟 p50 {summary['latency_p50']:.3f}s / p95 {summary['latency_p95']:.3f}s / "
+                  f"最大 {summary['latency_max']:.3f}s，服务器统计的最高分钟权重 {summary['peak_used_weight']}{limit}")
+        # 各阶段是所有线程的累计时间，可以超过总耗时
+        stages = {"network": summary["network"], "limiter_wait": summary["limiter_wait"], **summary["stages"]}
+        print("[总结] 各阶段累计耗时: " + "，".join(f"{STAGE_LABELS.get(name, name)} {seconds:.2f}s"
+                                            for name, seconds in stages.items() if seconds))
+        if summary["symbols"]:
+            slowest = sorted(((item["rows"] / item["seconds"] if item["seconds"] else 0.0, symbol)
+                              for symbol, item in summary["symbols"].items() if item["rows"]))[:3]
+            print(f"[总结] 共 {summary['rows']} 行，平均 {summary['rows_per_s']:.0f} 行/秒；最慢的交易对: "
+                  + "，".join(f"{symbol} ({speed:.0f} 行/秒)" for speed, symbol in slowest))
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+def configure(log_file=None, summary=True):
+    """
+    设置之后所有运行的结构化日志文件和是否打印汇总
+    :param log_file: JSON Lines 日志文件路径 (追加写入)，None 表示不写日志
+    :param summary: 运行结束时是否打印汇总
+    """
+    _config["log_file"] = log_file
+    _config["summary"] = summary
+
+
+def current_run():
+    """
+    :return: 正在进行的 RunMetrics，没有时返回 None
+    """
+    return _active
+
+
+def last_summary():
+    """
+    :return: 最近一次运行结束时的汇总 dict，没有时返回 None
+    """
+    return _last_summary
+
+
+def record_request(*args, **kwargs):
+    run = _active
+    if run is not None:
+        run.record_request(*args, **kwargs)
+
+
+def record_symbol(symbol, rows, seconds):
+    run = _active
+    if run is not None:
+        run.record_symbol(symbol, rows, seconds)
+
+
+@contextmanager
+def stage(name):
+    """
+    统计一个阶段的耗时，例如 with stage("parse"): ...，没有正在进行的运行时不计时
+    """
+    run = _active
+    if run is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        run.add_stage(name, time.perf_counter() - start)
+
+
+def instrumented(name):
+    """
+    装饰器：调用时如果没有正在进行的运行，就开始一次新的运行，结束时汇总；
+    已经在运行中 (例如下载方法内部调用了检查方法) 时指标记入外层运行
+    :param name: 运行名称
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            global _active, _last_summary
+            with _active_lock:
+                owner = _active is None
+                if owner:
+                    _active = RunMetrics(name, _config["log_file"])
+            if not owner:
+                return function(*args, **kwargs)
+
+            run = _active
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with _active_lock:
+                    _active = None
+                _last_summary = run.summary()
+                run.log("summary", **{key: value for key, value in _last_summary.items() if key != "symbols"})
+                run.close()
+                if _config["summary"]:
+                    run.print_summary(_last_summary)
+        return wrapper
+    return decorator
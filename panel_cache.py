@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from intervals import INTERVAL_MILLISECONDS
+from storage import get_storage
+from tools import build_prices_memmap
+
+# 缓存目录名，默认放在数据目录下 (以 . 开头，不会被当作数据集)
+PANEL_CACHE_DIR = ".panel_cache"
+
+
+def _cache_key(data_dir, interval, fields, start_date, end_date, backend):
+    """
+    根据数据目录、周期、字段、时间段和存储后端生成缓存文件名 (多个数据目录共用 cache_dir 时互不覆盖)
+    """
+    description = json.dumps([os.path.abspath(data_dir), interval, list(fields), str(start_date), str(end_date), backend])
+    return f"{interval}_{hashlib.sha1(description.encode()).hexdigest()[:16]}"
+
+
+def _fingerprints(storage, interval):
+    """
+    目录中该周期所有数据集的文件指纹 (只调用 stat)，任何文件被写入、追加或删除都会改变指纹
+    :return: {symbol: checksum}
+    """
+    return {symbol: storage.checksum(symbol, interval)
+            for symbol, dataset_interval in storage.list_datasets() if dataset_interval == interval}
+
+
+def _load_index(index_path):
+    if not os.path.exists(index_path):
+        return None
+    try:
+        with open(index_path, "r") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"[警告] 无法读取缓存索引 {index_path}: {e}")
+        return None
+
+
+def load_prices_panel(data_dir, interval, start_date=None, end_date=None, fields=['Open', 'Close'], backend="pickle",
+                      cache_dir=None, dtype="float64", max_workers=4, refresh=False):
+    """
+    读取对齐好的价格面板 (时间 × 标的 × 字段)，结果缓存为 .npy 文件和一个索引文件。
+    缓存按 数据目录 + 周期 + 字段 + 时间段 + 后端 区分，数据文件指纹 (与 manifest.json 中记录的相同) 不变时
+    直接 mmap 打开缓存，不需要再读取和对齐任何数据文件；有文件变化时自动重建。
+
+    :param data_dir: 本地文件夹路径，包含各标的数据。
+    :param interval: K线周期，例如 "15m"。
+    :param start_date: 数据的开始日期 "yyyy-mm-dd"，None 表示所有标的中最早的K线。
+    :param end_date: 数据的结束日期 "yyyy-mm-dd" (包含)，None 表示所有标的中最晚的K线。
+    :param fields: 要提取的字段列表，默认 ['Open', 'Close']。
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"。
+    :param cache_dir: 缓存目录，默认 {data_dir}/.panel_cache
+    :param dtype: 数组类型，"float64" 或 "float32"。
+    :param max_workers: 重建缓存时并行读取文件的线程数。
+    :param refresh: 是否忽略已有缓存强制重建。
+    :return: (只读 memmap 数组, 时间轴 DatetimeIndex, 标的列表, 字段列表)，没有数据时返回 None
+    """
+    cache_dir = cache_dir or os.path.join(data_dir, PANEL_CACHE_DIR)
+    storage = get_storage(data_dir, backend)
+    key = _cache_key(data_dir, interval, fields, start_date, end_date, backend)
+    array_path = os.path.join(cache_dir, f"{key}.npy")
+    index_path = os.path.join(cache_dir, f"{key}.json")
+    fingerprints = _fingerprints(storage, interval)
+
+    index = None if refresh else _load_index(index_path)
+    if (index is not None and index["fingerprints"] == fingerprints and index["dtype"] == np.dtype(dtype).name
+            and os.path.exists(array_path)):
+        values = np.load(array_path, mmap_mode="r")
+        times = pd.to_datetime(index["start"] + INTERVAL_MILLISECONDS[interval] * np.arange(len(values), dtype=np.int64), unit="ms")
+        return values, times, index["symbols"], index["fields"]
+
+    print(f"[信息] 重建价格面板缓存 {array_path}")
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # 先写临时文件，完成后再替换，中途失败不会留下半成品缓存
+    tmp_path = os.path.join(cache_dir, f"{key}.tmp.npy")
+    result = build_prices_memmap(data_dir, tmp_path, interval, start_date, end_date, fields, backend,
+                                 dtype=dtype, max_workers=max_workers)
+    if result is None:
+        return None
+    values, times, symbols, fields = result
+    values.flush()
+    # 替换文件前释放所有对 memmap 的引用，让映射关闭 (Windows 上仍被映射的文件不能被替换)
+    del result, values
+    os.replace(tmp_path, array_path)
+
+    index = {
+        "interval": interval,
+        "fields": fields,
+        "symbols": symbols,
+        "start": int(times[0].timestamp() * 1000) if len(times) else 0,
+        "dtype": np.dtype(dtype).name,
+        "fingerprints": fingerprints,
+    }
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(f"{index_path}.tmp", index_path)
+
+    return np.load(array_path, mmap_mode="r"), times, symbols, fields
+
+
+def panel_to_dataframe(values, times, symbols, fields):
+    """
+    把面板转换成 create_prices_dataframe 格式的大表 (列为 (symbol, field) 多级索引)
+    整个面板会读进内存，只适合需要 DataFrame 接口的场景。
+    """
+    columns = pd.MultiIndex.from_product([symbols, fields])
+    df = pd.DataFrame(np.asarray(values).reshape(len(times), -1), index=pd.DatetimeIndex(times, name="trade_date"), columns=columns)
+    # 去掉所有标的都没有数据的时间点，与 create_prices_dataframe 的结果一致
+    return df.dropna(how="all")
+
+
+def clear_panel_cache(data_dir, cache_dir=None):
+    """
+    删除数据目录下的所有面板缓存
+    """
+    cache_dir = cache_dir or os.path.join(data_dir, PANEL_CACHE_DIR)
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,337 @@
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime
+
+import pandas as pd
+
+from checkpoint import PARTIAL_DIR, RetryQueue
+from download import (KlineRequestError, drain_retry_queue, parse_kline_rows, resolve_download_start_time, resolve_update_start_time,
+                      retry_queue_callback, split_time_range)
+from exchange_info import get_exchange_info_index
+from intervals import INTERVAL_MILLISECONDS
+from markets import DEFAULT_MARKET, get_market
+from metrics import instrumented, record_symbol
+from rate_limit import rate_limited_get
+from resample import materialize_update
+from storage import get_storage
+
+# 网络阶段和处理阶段之间的队列长度 (按分块计)，队列满时网络线程暂停下载
+PIPELINE_QUEUE_SIZE = 8
+
+# 每个分块包含的原始分页数，网络线程每下载这么多页就交给处理阶段，内存占用不随交易对的历史长度增长
+PIPELINE_CHUNK_PAGES = 50
+
+
+def fetch_raw_kline_page(symbol, interval, start_time, end_time, market=DEFAULT_MARKET):
+    """
+    下载一页K线，返回未解析的响应内容 (bytes)，解析留给处理进程
+    :raises KlineRequestError: 请求失败 (rate_limited_get 的重试用完后仍然失败)
+    """
+    market = get_market(market)
+    limit = market.kline_limit(interval)
+    params = {
+        "symbol": symbol,
+        "interval": interval,
+        "startTime": start_time,
+        "endTime": end_time,
+        "limit": limit
+    }
+    try:
+        response = rate_limited_get(market.kline_url, params=params, weight=market.kline_weight(limit), limiter=market.limiter)
+        response.raise_for_status()
+    except Exception as e:
+        print(f"[错误] 请求失败: {e}")
+        raise KlineRequestError(f"{symbol} {interval} {start_time}-{end_time}: {e}") from e
+    return response.content
+
+
+def fetch_raw_kline_pages(symbol, interval, start_time, end_time, on_failure=None, market=DEFAULT_MARKET):
+    """
+    逐页下载一段时间范围的原始分页。固定长度的周期按整页窗口切分，不需要解析响应；
+    1M 这类长度不固定的周期只能解析每页的最后一根K线来确定下一页的起点
+    :param on_failure: 窗口请求失败时的回调 on_failure(开始时间, 结束时间, 异常)，跳过这个窗口继续下载；
+                       只支持固定长度的周期，None 表示抛出 KlineRequestError
+    :return: 逐页生成 bytes 的生成器
+    """
+    market = get_market(market)
+    if interval in INTERVAL_MILLISECONDS:
+        for window_start, window_end in split_time_range(start_time, end_time + 1, interval, limit=market.kline_limit(interval)):
+            # Binance 的 endTime 是闭区间，窗口结束时间减 1 毫秒，避免相邻窗口重复
+            try:
+                yield fetch_raw_kline_page(symbol, interval, window_start, window_end - 1, market)
+            except KlineRequestError as e:
+                if on_failure is None:
+                    raise
+                on_failure(window_start, window_end - 1, e)
+        return
+
+    current_start_time = start_time
+    while current_start_time < end_time:
+        request_end_time = end_time if market.max_window_ms is None else min(end_time, current_start_time + market.max_window_ms - 1)
+        page = fetch_raw_kline_page(symbol, interval, current_start_time, request_end_time, market)
+        rows = json.loads(page)
+        if not rows:
+            break
+        yield page
+        current_start_time = rows[-1][0] + 1
+
+
+def _chunk_path(data_dir, symbol, interval, index):
+    return os.path.join(data_dir, PARTIAL_DIR, f"{symbol}_{interval}.pipeline.{index}.pkl")
+
+
+def parse_raw_chunk(data_dir, symbol, interval, index, raw_pages, float32=False):
+    """
+    处理进程中执行：解析一个分块的原始分页，结果暂存到 {数据目录}/_partial，等这个交易对的所有分块都解析完后再一起写入
+    :param data_dir: 数据目录
+    :param symbol: 交易对
+    :param interval: K线周期
+    :param index: 分块序号
+    :param raw_pages: 原始分页 [bytes, ...]
+    :param float32: 价格和成交量是否使用 float32
+    :return: 暂存文件路径
+    """
+    # 分块内所有分页的行拼在一起只解析一次
+    rows = [row for page in raw_pages for row in json.loads(page)]
+    path = _chunk_path(data_dir, symbol, interval, index)
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    parse_kline_rows(rows, float32=float32).to_pickle(path)
+    return path
+
+
+def write_parsed_chunks(data_dir, backend, symbol, interval, chunk_paths, mode="write", materialize=None):
+    """
+    处理进程中执行：合并一个交易对所有已解析的分块、去重排序并写入存储，然后删除暂存文件
+    :param data_dir: 数据目录
+    :param backend: 存储后端
+    :param symbol: 交易对
+    :param interval: K线周期
+    :param chunk_paths: parse_raw_chunk 的结果 (按分块顺序)
+    :param mode: "write" 覆盖写入 (下载) / "append" 追加 (更新)
+    :param materialize: append 模式下同时维护的高级别周期列表
+    :return: (保存路径, 行数)
+    """
+    frames = [frame for frame in (pd.read_pickle(path) for path in chunk_paths) if not frame.empty]
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if not df.empty:
+        df = df.drop_duplicates(subset="Open time", keep="last").sort_values("Open time").reset_index(drop=True)
+
+    storage = get_storage(data_dir, backend)
+    output_file = _write_frame(storage, symbol, interval, df, mode, materialize)
+    remove_chunks(chunk_paths)
+    return output_file, len(df)
+
+
+def remove_chunks(chunk_paths):
+    for path in chunk_paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _write_frame(storage, symbol, interval, df, mode, materialize):
+    if mode == "write":
+        return storage.write(symbol, interval, df)
+
+    output_file = storage.append(symbol, interval, df)
+    if materialize and not df.empty:
+        materialize_update(storage, symbol, interval, materialize, int(df["Open time"].iloc[0].timestamp() * 1000))
+    return output_file
+
+
+def run_pipeline(jobs, interval, data_dir, backend="pickle", mode="write", io_workers=10, process_workers=None,
+                 queue_size=PIPELINE_QUEUE_SIZE, materialize=None, float32=False, chunk_pages=PIPELINE_CHUNK_PAGES,
+                 market=DEFAULT_MARKET):
+    """
+    分阶段执行下载：网络线程只下载原始分页，每 chunk_pages 页作为一个分块放进有界队列，进程池负责解析、合并和写入。
+    解析和写文件不再占用网络线程的 GIL；处理跟不上时队列被填满，网络线程自动暂停 (背压)。
+    队列和处理阶段中最多同时存在 queue_size + 2 × process_workers 个分块的原始数据，与交易对的历史长度无关；
+    每个分块解析后暂存到 {数据目录}/_partial，交易对的最后一个分块解析完后再合并写入存储。
+    :param jobs: [(symbol, 开始时间, 结束时间), ...]，时间戳(毫秒)
+    :param interval: K线周期
+    :param data_dir: 数据目录
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"
+    :param mode: "write" 覆盖写入 (下载) / "append" 追加 (更新)
+    :param io_workers: 网络阶段的线程数
+    :param process_workers: 处理阶段的进程数，默认等于 CPU 核数
+    :param queue_size: 两个阶段之间最多缓存多少个分块的原始数据
+    :param materialize: append 模式下同时维护的高级别周期列表
+    :param float32: 价格和成交量是否使用 float32
+    :param chunk_pages: 每个分块包含的原始分页数
+    :param market: 市场 "spot" / "um" / "cm" (data_dir 应为该市场实际使用的目录)
+    :return: (成功的交易对列表, 失败的交易对列表)；失败的分页记入 data_dir 的重试队列，由调用方用 drain_retry_queue 重试
+    """
+    raw_queue = queue.Queue(maxsize=queue_size)
+    retry_queue = RetryQueue(data_dir)
+    process_workers = process_workers or os.cpu_count()
+    # 处理阶段最多同时提交的解析任务数，超过时不再从队列取数据
+    process_slots = threading.BoundedSemaphore(process_workers * 2)
+
+    # 每个交易对开始下载的时间，处理完成时计算整体速度
+    started = {}
+
+    def fetch_stage(symbol, start_time, end_time):
+        # 队列中的每条记录为 (交易对, 原始分页, 异常, 是否为最后一条)
+        try:
+            started[symbol] = time.perf_counter()
+            print(f"[信息] 开始下载 {symbol} 的数据...")
+            chunk = []
+            for page in fetch_raw_kline_pages(symbol, interval, start_time, end_time,
+                                              on_failure=retry_queue_callback(retry_queue, symbol, interval), market=market):
+                chunk.append(page)
+                if len(chunk) >= chunk_pages:
+                    raw_queue.put((symbol, chunk, None, False))
+                    chunk = []
+            raw_queue.put((symbol, chunk, None, True))
+            print(f"[提示] {symbol} 数据已下载完成，等待处理")
+        except Exception as e:
+            raw_queue.put((symbol, None, e, True))
+
+    successful_symbols = []
+    failed_symbols = []
+    lock = threading.Lock()
+
+    def finish_symbol(process_executor, symbol, chunk_futures, error):
+        """
+        等交易对的所有分块解析完成后合并写入，任何一步失败时删除暂存的分块
+        """
+        wait(chunk_futures)
+        chunk_paths = [future.result() for future in chunk_futures if future.exception() is None]
+
+        def fail(message):
+            remove_chunks(chunk_paths)
+            print(f"[错误] {message}")
+            with lock:
+                failed_symbols.append(symbol)
+
+        errors = [future.exception() for future in chunk_futures if future.exception() is not None]
+        if error is not None:
+            return fail(f"下载 {symbol} 数据时出错: {error}")
+        if errors:
+            return fail(f"处理 {symbol} 数据时出错: {errors[0]}")
+        try:
+            output_file, rows = process_executor.submit(write_parsed_chunks, data_dir, backend, symbol, interval,
+                                                        chunk_paths, mode, materialize).result()
+        except Exception as e:
+            return fail(f"处理 {symbol} 数据时出错: {e}")
+
+        record_symbol(symbol, rows, time.perf_counter() - started[symbol])
+        print(f"[完成] {symbol} 数据 ({rows} 行) 已保存到 {output_file}")
+        with lock:
+            successful_symbols.append(symbol)
+
+    # 退出时按相反顺序关闭：先等所有交易对写入完成，再关闭进程池和网络线程池
+    with ThreadPoolExecutor(max_workers=io_workers) as io_executor, \
+            ProcessPoolExecutor(max_workers=process_workers) as process_executor, \
+            ThreadPoolExecutor(max_workers=process_workers) as finish_executor:
+        for symbol, start_time, end_time in jobs:
+            io_executor.submit(fetch_stage, symbol, start_time, end_time)
+
+        # 每个交易对的分块按下载顺序编号，最后一条记录到达后提交合并写入
+        chunk_futures = {symbol: [] for symbol, _, _ in jobs}
+        finished = 0
+        while finished < len(jobs):
+            symbol, raw_pages, error, last = raw_queue.get()
+            if raw_pages:
+                process_slots.acquire()
+                future = process_executor.submit(parse_raw_chunk, data_dir, symbol, interval, len(chunk_futures[symbol]),
+                                                 raw_pages, float32)
+                future.add_done_callback(lambda _: process_slots.release())
+                chunk_futures[symbol].append(future)
+            if last:
+                finished += 1
+                finish_executor.submit(finish_symbol, process_executor, symbol, chunk_futures.pop(symbol), error)
+
+    return successful_symbols, failed_symbols
+
+
+# 流水线版的下载K线数据方法
+@instrumented("download")
+def download_historical_data_pipeline(symbols, interval, start_date, end_date, output_dir="./binance_data", io_workers=10,
+                                      process_workers=None, queue_size=PIPELINE_QUEUE_SIZE, backend="pickle",
+                                      chunk_pages=PIPELINE_CHUNK_PAGES, market=DEFAULT_MARKET):
+    """
+    批量下载多个交易对的历史数据并保存 (网络线程 + 处理进程的流水线版本，参数与 download_historical_data_multi_threads 对应)
+    :param symbols: 要下载的交易对列表。例如 ["BTCUSDT", "ETHUSDT"]
+    :param interval: K线周期
+    :param start_date: 开始日期。例如 2023-01-01
+    :param end_date: 结束日期。例如 2023-10-01
+    :param output_dir: 数据保存的目录
+    :param io_workers: 网络阶段的线程数
+    :param process_workers: 处理阶段的进程数，默认等于 CPU 核数
+    :param queue_size: 两个阶段之间最多缓存多少个分块的原始数据
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"
+    :param chunk_pages: 每个分块包含的原始分页数
+    :param market: 市场 "spot" / "um" (默认) / "cm"
+    """
+    market = get_market(market)
+    output_dir = market.data_dir(output_dir)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # 转换开始和结束日期为时间戳
+    start_time = int(datetime.strptime(start_date, "%Y-%m-%d").timestamp() * 1000)
+    end_time = int(datetime.strptime(end_date, "%Y-%m-%d").timestamp() * 1000)
+
+    get_exchange_info_index(market=market)
+    jobs = []
+    for symbol in symbols:
+        current_start_time = resolve_download_start_time(symbol, start_time, end_time, market)
+        if current_start_time is not None:
+            jobs.append((symbol, current_start_time, end_time))
+
+    successful_symbols, failed_symbols = run_pipeline(jobs, interval, output_dir, backend, "write", io_workers,
+                                                      process_workers, queue_size, chunk_pages=chunk_pages, market=market)
+    failed_symbols += [symbol for symbol in symbols if symbol not in successful_symbols and symbol not in failed_symbols]
+    drain_retry_queue(RetryQueue(output_dir), get_storage(output_dir, backend), interval, io_workers, market=market)
+
+    print(f"[总结] 成功下载 {len(successful_symbols)} 个交易对数据，失败 {len(failed_symbols)} 个。")
+    if failed_symbols:
+        print(f"[失败列表]: {failed_symbols}")
+
+
+# 流水线版更新数据
+@instrumented("update")
+def update_historical_data_pipeline(symbols, interval, output_dir, update_start_time=None, io_workers=5, process_workers=None,
+                                    queue_size=PIPELINE_QUEUE_SIZE, backend="pickle", materialize=None, chunk_pages=PIPELINE_CHUNK_PAGES,
+                                    market=DEFAULT_MARKET):
+    """
+    补充下载指定交易对的数据并保存 (流水线版本，参数与 update_historical_data_multi_threaded 对应)
+    :param symbols: 交易对列表，例如 ["BTCUSDT", "ETHUSDT"]
+    :param interval: K线周期，例如 "1h", "1d"
+    :param output_dir: 数据保存文件夹
+    :param update_start_time: 起始更新时间，例如 "yyyy-mm-dd"
+    :param io_workers: 网络阶段的线程数
+    :param process_workers: 处理阶段的进程数，默认等于 CPU 核数
+    :param queue_size: 两个阶段之间最多缓存多少个分块的原始数据
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"
+    :param materialize: 同时维护的高级别周期列表，例如 ["1h", "4h", "1d"]
+    :param chunk_pages: 每个分块包含的原始分页数
+    :param market: 市场 "spot" / "um" (默认) / "cm"
+    """
+    market = get_market(market)
+    output_dir = market.data_dir(output_dir)
+    storage = get_storage(output_dir, backend)
+    get_exchange_info_index(market=market)
+
+    # 获取当前时间作为结束时间
+    end_time = int(datetime.now().timestamp() * 1000)
+    jobs = []
+    for symbol in symbols:
+        current_start_time = resolve_update_start_time(storage, symbol, interval, update_start_time, market)
+        if current_start_time is not None:
+            print(f"[信息] {symbol}: 开始从 {datetime.fromtimestamp(current_start_time / 1000)} 补充数据")
+            jobs.append((symbol, current_start_time, end_time))
+
+    successful_symbols, failed_symbols = run_pipeline(jobs, interval, output_dir, backend, "append", io_workers,
+                                                      process_workers, queue_size, materialize, chunk_pages=chunk_pages,
+                                                      market=market)
+    drain_retry_queue(RetryQueue(output_dir), storage, interval, io_workers, materialize=materialize, market=market)
+    print(f"[总结] 成功更新 {len(successful_symbols)} 个交易对数据，失败 {len(failed_symbols)} 个。")
+    if failed_symbols:
+        print(f"[失败列表]: {failed_symbols}")
@@ -0,0 +1,206 @@
+import random
+import threading
+import time
+import requests
+
+from metrics import record_request
+
+# Binance U本位合约接口的IP权重上限（每分钟）
+FUTURES_WEIGHT_LIMIT_1M = 2400
+
+# 币本位合约接口 (dapi) 的IP权重上限（每分钟），与 U本位分开计算
+COINM_WEIGHT_LIMIT_1M = 2400
+
+# 现货接口的IP权重上限（每分钟）
+SPOT_WEIGHT_LIMIT_1M = 6000
+
+# 响应头中的已用权重与封禁等待时间
+USED_WEIGHT_HEADER = "X-MBX-USED-WEIGHT-1m"
+RETRY_AFTER_HEADER = "Retry-After"
+
+# 被限频 (429/418)、服务端错误 (5xx) 或网络异常时的最大重试次数
+REQUEST_RETRIES = 5
+
+# 重试等待时间：第 n 次重试在 [0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2^n)] 秒内随机选择 (指数退避 + 全抖动)
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_MAX = 30.0
+
+# 单个请求的超时时间（秒）
+REQUEST_TIMEOUT = 30
+
+# 共享连接池大小，应不小于同时发请求的线程数
+HTTP_POOL_SIZE = 32
+
+
+def kline_request_weight(limit):
+    """
+    计算一次K线请求消耗的权重 (Binance U本位/币本位合约规则)
+    :param limit: 请求的K线条数
+    :return: 请求权重
+    """
+    if limit < 100:
+        return 1
+    if limit < 500:
+        return 2
+    if limit <= 1000:
+        return 5
+    return 10
+
+
+def spot_kline_request_weight(limit):
+    """
+    计算一次现货K线请求消耗的权重 (现货接口不按条数计算)
+    :param limit: 请求的K线条数
+    :return: 请求权重
+    """
+    return 2
+
+
+def backoff_delay(attempt):
+    """
+    第 attempt 次重试前的等待时间 (指数退避 + 全抖动，避免多个线程在同一时刻一起重试)
+    :param attempt: 重试次数，从 0 开始
+    :return: 等待秒数
+    """
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+
+
+def is_retryable_status(status_code):
+    """
+    429/418 (限频) 和 5xx (服务端暂时不可用) 可以重试，其他 4xx 是请求本身的问题，重试也不会成功
+    """
+    return status_code in (418, 429) or status_code >= 500
+
+
+class WeightRateLimiter:
+    """
+    按请求权重计算的令牌桶限速器，所有线程共享一个实例。
+    令牌以 max_weight / period 的速度匀速补充，每次请求前扣除对应权重，
+    并根据响应头中的 X-MBX-USED-WEIGHT-1m 和 Retry-After 校正桶内余量。
+    """
+
+    def __init__(self, max_weight=FUTURES_WEIGHT_LIMIT_1M, period=60.0, safety_ratio=0.9):
+        """
+        :param max_weight: 每个周期允许使用的最大权重
+        :param period: 周期长度（秒）
+        :param safety_ratio: 只使用上限的这一比例，给其他程序和时钟误差留余量
+        """
+        self.max_weight = max_weight
+        self.capacity = max_weight * safety_ratio
+        self.rate = self.capacity / period
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, weight):
+        """
+        预占权重，返回调用方需要等待的秒数（不会阻塞）
+        :param weight: 本次请求的权重
+        :return: 需要等待的秒数
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= weight
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._blocked_until - now)
+
+    def acquire(self, weight):
+        """
+        阻塞直到可以发送一个给定权重的请求
+        :param weight: 本次请求的权重
+        """
+        wait = self.reserve(weight)
+        if wait > 0:
+            time.sleep(wait)
+
+    def update_from_headers(self, headers):
+        """
+        根据响应头校正令牌桶
+        :param headers: 响应头 (requests 的 CaseInsensitiveDict 或普通 dict)
+        """
+        used = headers.get(USED_WEIGHT_HEADER)
+        retry_after = headers.get(RETRY_AFTER_HEADER)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if used is not None:
+                try:
+                    # 服务器统计的已用权重更准确，桶内余量不能超过服务器认为的剩余量
+                    self._tokens = min(self._tokens, self.capacity - int(used))
+                except ValueError:
+                    pass
+            if retry_after is not None:
+                try:
+                    self._blocked_until = max(self._blocked_until, now + float(retry_after))
+                except ValueError:
+                    pass
+
+    def block(self, seconds):
+        """
+        在指定秒数内暂停所有请求 (例如收到 429 但没有 Retry-After)
+        :param seconds: 暂停秒数
+        """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+# 所有U本位合约请求共享的限速器
+futures_rate_limiter = WeightRateLimiter()
+
+# 币本位合约和现货各自的权重预算，分别使用独立的限速器
+coinm_rate_limiter = WeightRateLimiter(COINM_WEIGHT_LIMIT_1M)
+spot_rate_limiter = WeightRateLimiter(SPOT_WEIGHT_LIMIT_1M)
+
+# 所有线程共享的 HTTP 会话，复用 keep-alive 连接，避免每页都重新建立 TCP+TLS 连接
+http_session = requests.Session()
+http_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+http_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+
+
+# 经过共享限速器的GET请求
+def rate_limited_get(url, params=None, weight=1, limiter=futures_rate_limiter):
+    """
+    通过共享的权重限速器发送GET请求，所有线程的请求共同受同一个权重预算约束。
+    限频 (429/418) 时按 Retry-After 暂停所有线程后重试；服务端错误 (5xx) 和网络异常 (超时、连接断开)
+    按指数退避 + 抖动重试，最多重试 REQUEST_RETRIES 次
+    :param url: 请求地址
+    :param params: 请求参数
+    :param weight: 本次请求的权重
+    :param limiter: 使用的限速器
+    :return: requests.Response (重试用完后返回最后一次的响应，由调用方检查状态码)
+    :raises requests.RequestException: 重试用完后仍然发生网络异常
+    """
+    for attempt in range(REQUEST_RETRIES + 1):
+        wait_start = time.perf_counter()
+        limiter.acquire(weight)
+        request_start = time.perf_counter()
+        try:
+            response = http_session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+        except requests.RequestException as e:
+            record_request(url, time.perf_counter() - request_start, weight, None, request_start - wait_start,
+                           weight_limit=limiter.max_weight, attempt=attempt)
+            if attempt == REQUEST_RETRIES:
+                raise
+            print(f"[警告] 请求异常: {e}，等待后重试 ({attempt + 1}/{REQUEST_RETRIES})...")
+            time.sleep(backoff_delay(attempt))
+            continue
+        record_request(url, time.perf_counter() - request_start, weight, response.status_code, request_start - wait_start,
+                       response.headers.get(USED_WEIGHT_HEADER), limiter.max_weight, attempt)
+        limiter.update_from_headers(response.headers)
+
+        if not is_retryable_status(response.status_code) or attempt == REQUEST_RETRIES:
+            return response
+        if response.status_code in (418, 429):
+            # 429: 超出频率限制 / 418: IP已被封禁，所有线程一起等待 Retry-After (没有时按退避时间)
+            if RETRY_AFTER_HEADER not in response.headers:
+                limiter.block(backoff_delay(attempt))
+            print(f"[警告] 触发频率限制 (HTTP {response.status_code})，等待后重试...")
+        else:
+            print(f"[警告] 服务端错误 (HTTP {response.status_code})，等待后重试 ({attempt + 1}/{REQUEST_RETRIES})...")
+            time.sleep(backoff_delay(attempt))
@@ -0,0 +1,198 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from intervals import INTERVAL_MILLISECONDS, open_times_ms
+from storage import get_storage
+
+# 周期起点相对 1970-01-01 (周四) 的偏移，币安的周线从周一开始
+INTERVAL_OFFSET_MILLISECONDS = {"1w": 4 * 24 * 60 * 60 * 1000}
+
+# 合并时求和的字段
+SUM_FIELDS = ["Volume", "Quote asset volume", "Number of trades", "Taker buy base asset volume", "Taker buy quote asset volume"]
+
+# 输出的列顺序 (与下载得到的数据一致)
+RESAMPLED_COLUMNS = [
+    "Open time", "Close time", "Open", "High", "Low", "Close", "Volume", "Quote asset volume",
+    "Number of trades", "Taker buy base asset volume", "Taker buy quote asset volume"
+]
+
+
+def aggregate_klines(df, target_interval):
+    """
+    用整数桶编号 + NumPy reduceat 把K线合并成更高级别的周期，不修改输入
+    :param df: 按 Open time 排序的K线数据 (周期需要能整除目标周期)
+    :param target_interval: 目标周期，例如 "1h", "4h", "1d"
+    :return: 合并后的 DataFrame，只包含有数据的周期 (不补空行)
+    """
+    step = INTERVAL_MILLISECONDS[target_interval]
+    offset = INTERVAL_OFFSET_MILLISECONDS.get(target_interval, 0)
+    if df.empty:
+        return pd.DataFrame(columns=[column for column in RESAMPLED_COLUMNS if column in df.columns])
+
+    # 每根K线所属的目标周期编号，相同编号的连续K线组成一段
+    buckets = (open_times_ms(df) - offset) // step
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+    ends = np.concatenate((starts[1:], [len(buckets)])) - 1
+    open_times = buckets[starts] * step + offset
+
+    columns = {
+        "Open time": open_times.astype("datetime64[ms]"),
+        "Close time": (open_times + step - 1).astype("datetime64[ms]"),
+        "Open": df["Open"].to_numpy()[starts],
+        "High": np.maximum.reduceat(df["High"].to_numpy(), starts),
+        "Low": np.minimum.reduceat(df["Low"].to_numpy(), starts),
+        "Close": df["Close"].to_numpy()[ends],
+    }
+    for field in SUM_FIELDS:
+        if field in df.columns:
+            columns[field] = np.add.reduceat(df[field].to_numpy(), starts)
+
+    return pd.DataFrame({column: columns[column] for column in RESAMPLED_COLUMNS if column in columns})
+
+
+def _resample_plan(base_interval, target_intervals):
+    """
+    确定每个目标周期从哪个周期合并得到：优先使用已经算好的、能整除它的最大周期，
+    例如 15m → 1h → 4h → 1d，每一级只需要处理上一级的数据量
+    :return: [(目标周期, 来源周期), ...]，按周期从小到大排列
+    """
+    plan = []
+    available = [base_interval]
+    for target in sorted(set(target_intervals), key=lambda interval: INTERVAL_MILLISECONDS[interval]):
+        step = INTERVAL_MILLISECONDS[target]
+        offset = INTERVAL_OFFSET_MILLISECONDS.get(target, 0)
+        sources = [source for source in available
+                   if step % INTERVAL_MILLISECONDS[source] == 0
+                   and (offset - INTERVAL_OFFSET_MILLISECONDS.get(source, 0)) % INTERVAL_MILLISECONDS[source] == 0]
+        if target == base_interval or not sources:
+            raise ValueError(f"无法从 {base_interval} 合并得到 {target}")
+        plan.append((target, max(sources, key=lambda interval: INTERVAL_MILLISECONDS[interval])))
+        available.append(target)
+    return plan
+
+
+def resample_klines(df, base_interval, target_intervals):
+    """
+    一次计算多个目标周期
+    :param df: 按 Open time 排序的基础周期K线
+    :param base_interval: 基础周期，例如 "15m"
+    :param target_intervals: 目标周期列表，例如 ["1h", "4h", "1d"]
+    :return: {目标周期: DataFrame}
+    """
+    results = {base_interval: df}
+    for target, source in _resample_plan(base_interval, target_intervals):
+        results[target] = aggregate_klines(results[source], target)
+    del results[base_interval]
+    return results
+
+
+def bucket_start(time_ms, interval):
+    """
+    计算时间戳所在的目标周期的开始时间
+    :param time_ms: 时间戳(毫秒)
+    :param interval: 周期，例如 "4h"
+    :return: 周期开始时间，时间戳(毫秒)
+    """
+    step = INTERVAL_MILLISECONDS[interval]
+    offset = INTERVAL_OFFSET_MILLISECONDS.get(interval, 0)
+    return (time_ms - offset) // step * step + offset
+
+
+def materialize_update(storage, symbol, base_interval, target_intervals, since=None):
+    """
+    增量维护高级别周期数据：只重新计算包含 since 之后基础K线的那些周期，并追加 (覆盖) 到存储中。
+    最后一根未走完的高级别K线也会写入，下次更新时随新的基础K线重新计算，直到它完整为止。
+    :param storage: 存储对象 (基础周期和目标周期在同一个存储中)
+    :param symbol: 交易对
+    :param base_interval: 基础周期，例如 "15m"
+    :param target_intervals: 目标周期列表，例如 ["1h", "4h", "1d"]
+    :param since: 本次新写入的第一根基础K线的开始时间，时间戳(毫秒)；None 表示全量计算
+    :return: {目标周期: 写入的K线数量}
+    """
+    # 目标周期还没有数据时需要从头计算
+    starts = {}
+    for target in target_intervals:
+        full = since is None or storage.time_range(symbol, target) is None
+        starts[target] = None if full else bucket_start(since, target)
+
+    # 从最早受影响的周期开始读取基础数据，保证每个受影响的周期都是完整计算的
+    read_start = None
+    if all(start is not None for start in starts.values()):
+        read_start = pd.Timestamp(min(starts.values()), unit="ms")
+    df = storage.read(symbol, base_interval, start=read_start)
+
+    written = {}
+    for target, bars in resample_klines(df, base_interval, target_intervals).items():
+        if starts[target] is None:
+            storage.write(symbol, target, bars)
+        else:
+            # 读取起点可能不是这个周期的边界，只保留从受影响的第一个完整周期开始的K线
+            bars = bars[bars["Open time"] >= pd.Timestamp(starts[target], unit="ms")].reset_index(drop=True)
+            storage.append(symbol, target, bars)
+        written[target] = len(bars)
+    return written
+
+
+def _resample_symbol(data_dir, output_dir, backend, symbol, base_interval, target_intervals):
+    """
+    进程池中执行：读取一个标的的基础周期数据，计算所有目标周期并写回存储
+    """
+    try:
+        df = get_storage(data_dir, backend).read(symbol, base_interval)
+        output_storage = get_storage(output_dir, backend)
+        for target, resampled in resample_klines(df, base_interval, target_intervals).items():
+            output_storage.write(symbol, target, resampled)
+        return symbol, True
+    except Exception as e:
+        print(f"[错误] 合并 {symbol} 数据时出错: {e}")
+        return symbol, False
+
+
+def resample_dataset(data_dir, base_interval, target_intervals, symbols=None, output_dir=None, backend="pickle",
+                     max_workers=None):
+    """
+    把目录中所有标的的基础周期数据批量合并成多个高级别周期，并写回存储
+    :param data_dir: 数据目录
+    :param base_interval: 基础周期，例如 "15m"
+    :param target_intervals: 目标周期列表，例如 ["1h", "4h", "1d"]
+    :param symbols: 交易对列表，默认处理目录中该周期的所有交易对
+    :param output_dir: 结果保存目录，默认与 data_dir 相同
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"
+    :param max_workers: 进程数，默认等于 CPU 核数
+    """
+    # 提前检查目标周期，避免每个进程各自报错
+    _resample_plan(base_interval, target_intervals)
+    output_dir = output_dir or data_dir
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    if symbols is None:
+        symbols = [symbol for symbol, interval in get_storage(data_dir, backend).list_datasets() if interval == base_interval]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_resample_symbol, data_dir, output_dir, backend, symbol, base_interval, list(target_intervals))
+                   for symbol in symbols]
+        results = [future.result() for future in futures]
+
+    failed_symbols = [symbol for symbol, success in results if not success]
+    print(f"[总结] 成功合并 {len(results) - len(failed_symbols)} 个交易对数据 ({base_interval} → {', '.join(target_intervals)})，"
+          f"失败 {len(failed_symbols)} 个。")
+    if failed_symbols:
+        print(f"[失败列表]: {failed_symbols}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="把低级别K线批量合并成高级别周期")
+    parser.add_argument("data_dir", help="数据目录")
+    parser.add_argument("base_interval", help="基础周期，例如 15m")
+    parser.add_argument("target_intervals", nargs="+", help="目标周期，例如 1h 4h 1d")
+    parser.add_argument("--output", dest="output_dir", help="结果保存目录，默认与数据目录相同")
+    parser.add_argument("--backend", default="pickle", help="存储后端 pickle / parquet")
+    parser.add_argument("--workers", dest="max_workers", type=int, help="进程数")
+    args = parser.parse_args()
+
+    resample_dataset(args.data_dir, args.base_interval, args.target_intervals, output_dir=args.output_dir,
+                     backend=args.backend, max_workers=args.max_workers)
@@ -0,0 +1,257 @@
+import argparse
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from checkpoint import RetryQueue
+from download import RETRY_QUEUE_ROUNDS, drain_retry_queue, resolve_update_start_time, update_symbol_range
+from exchange_info import get_24h_quote_volumes, get_exchange_info_index, symbol_status
+from intervals import INTERVAL_MILLISECONDS
+from markets import DEFAULT_MARKET, get_market, get_market_storage
+from metrics import instrumented, record_symbol
+from tools import get_binance_u_based_futures, get_market_symbols
+
+# 预计超过这个页数的任务视为补历史 (新上市或很久没有更新)，其余为尾部增量更新
+BACKFILL_PAGES = 10
+
+# 补历史任务每下载这么多页写入一次存储并检查截止时间和预算，中途停止时已下载的部分不会丢失
+BACKFILL_CHUNK_PAGES = 50
+
+# 正常交易的状态；其他状态 (SETTLING / CLOSE / BREAK 等) 只补下载到下市时间为止
+TRADING_STATUS = "TRADING"
+
+
+def estimate_pages(interval, start_time, end_time, market=DEFAULT_MARKET):
+    """
+    估算下载一段时间需要请求的K线页数
+    :return: 页数 (1M 这类长度不固定的周期按 1 页计)
+    """
+    step = INTERVAL_MILLISECONDS.get(interval)
+    if step is None:
+        return 1
+    return max(1, math.ceil((end_time - start_time + 1) / (step * get_market(market).kline_limit(interval))))
+
+
+def plan_updates(symbols, interval, storage, update_start_time=None, now=None, market=DEFAULT_MARKET):
+    """
+    根据 exchangeInfo 中的交易状态、本地数据的最后时间和24小时成交额生成更新任务。
+    已下市 / 已结算并且数据已经覆盖到下市时间的交易对直接跳过。
+    :param symbols: 交易对列表
+    :param interval: K线周期
+    :param storage: 存储对象
+    :param update_start_time: 起始更新时间，例如 "yyyy-mm-dd"，None 表示从已有数据的最后时间开始
+    :param now: 当前时间，时间戳(毫秒)
+    :param market: 市场 "spot" / "um" / "cm"
+    :return: (任务列表 [{"symbol", "start", "end", "pages", "staleness", "volume"}, ...], {跳过的 symbol: 原因})
+    """
+    market = get_market(market)
+    now = now or int(time.time() * 1000)
+    index = get_exchange_info_index(market=market)
+    if index is None:
+        print("[警告] exchangeInfo 不可用，不检查交易状态")
+    volumes = get_24h_quote_volumes(market)
+    step = INTERVAL_MILLISECONDS.get(interval, 0)
+
+    jobs = []
+    skipped = {}
+    for symbol in symbols:
+        end_time = now
+        if index is not None:
+            info = index.get(symbol)
+            if info is None:
+                skipped[symbol] = "exchangeInfo 中不存在 (已下市)"
+                continue
+            status = symbol_status(info)
+            if status != TRADING_STATUS:
+                # 已下市的合约只需要下载到交割 / 结算时间为止
+                delivery_date = info.get("deliveryDate")
+                if not delivery_date or delivery_date > now:
+                    skipped[symbol] = f"状态为 {status}"
+                    continue
+                end_time = delivery_date
+
+        time_range = storage.time_range(symbol, interval)
+        last_time = int(time_range[1].timestamp() * 1000) if time_range is not None else None
+        if last_time is not None and end_time < now and last_time + step >= end_time:
+            skipped[symbol] = f"已于 {datetime.fromtimestamp(end_time / 1000):%Y-%m-%d} 下市，数据已完整"
+            continue
+
+        start_time = resolve_update_start_time(storage, symbol, interval, update_start_time, market)
+        if start_time is None:
+            skipped[symbol] = "无法确定起始时间"
+            continue
+        jobs.append({
+            "symbol": symbol,
+            "start": start_time,
+            "end": end_time,
+            "pages": estimate_pages(interval, start_time, end_time, market),
+            # 没有数据的新交易对从上市时间算起
+            "staleness": now - (last_time if last_time is not None else start_time),
+            "volume": volumes.get(symbol, 0.0),
+        })
+    return jobs, skipped
+
+
+def order_jobs(jobs):
+    """
+    把任务分为尾部更新和补历史两组并排序：
+    尾部更新按24小时成交额从高到低、再按数据陈旧程度排序，最活跃的交易对最先拿到最新数据；
+    补历史按预计页数从少到多排序，同样的预算下能补全更多的交易对
+    :return: (尾部更新列表, 补历史列表)
+    """
+    tails = sorted((job for job in jobs if job["pages"] <= BACKFILL_PAGES), key=lambda job: (-job["volume"], -job["staleness"]))
+    backfills = sorted((job for job in jobs if job["pages"] > BACKFILL_PAGES), key=lambda job: (job["pages"], -job["volume"]))
+    return tails, backfills
+
+
+# 按优先级更新数据
+@instrumented("update")
+def update_historical_data_scheduled(symbols, interval, output_dir, update_start_time=None, max_workers=5, backfill_workers=None,
+                                     deadline=None, max_pages=None, backend="pickle", materialize=None, market=DEFAULT_MARKET):
+    """
+    按优先级更新一批交易对：跳过已下市 / 已结算的交易对，尾部更新按成交额和陈旧程度排序，
+    新上市或长时间没有更新的交易对 (补历史) 最多占用 backfill_workers 个线程，与尾部更新交替进行，
+    不会挡住其他交易对的增量更新。可以限制运行时间和请求页数，适合固定时间窗口的定时任务。
+    :param symbols: 交易对列表，例如 get_binance_u_based_futures() 的结果
+    :param interval: K线周期，例如 "15m"
+    :param output_dir: 数据保存文件夹
+    :param update_start_time: 起始更新时间，例如 "yyyy-mm-dd"
+    :param max_workers: 并发线程数
+    :param backfill_workers: 同时进行补历史的最大线程数，默认为 max_workers 的 1/4 (至少 1 个)；
+                             尾部更新全部开始后，空闲的线程也会用来补历史
+    :param deadline: 运行时间上限（秒），到时间后不再开始新的任务，补历史在下一个分段前停止；None 表示不限制
+    :param max_pages: 本次运行最多请求的K线页数；None 表示不限制
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"
+    :param materialize: 同时维护的高级别周期列表，例如 ["1h", "4h", "1d"]
+    :param market: 市场 "spot" / "um" (默认) / "cm"
+    :return: {"updated": [...], "deferred": [...], "failed": [...], "skipped": {symbol: 原因}}，
+             deferred 是因为截止时间或预算没有开始 / 没有完成的交易对，下次运行时继续
+    """
+    market = get_market(market)
+    storage = get_market_storage(output_dir, backend, market)
+    retry_queue = RetryQueue(storage.root)
+    started = time.monotonic()
+    step = INTERVAL_MILLISECONDS.get(interval)
+
+    jobs, skipped = plan_updates(symbols, interval, storage, update_start_time, market=market)
+    tails, backfills = order_jobs(jobs)
+    for symbol, reason in skipped.items():
+        print(f"[跳过] {symbol}: {reason}")
+    print(f"[信息] 共 {len(jobs)} 个交易对需要更新 (尾部更新 {len(tails)} 个，补历史 {len(backfills)} 个，"
+          f"预计 {sum(job['pages'] for job in jobs)} 页)，跳过 {len(skipped)} 个")
+
+    backfill_workers = backfill_workers or max(1, max_workers // 4)
+    remaining_pages = [max_pages]
+    lock = threading.Lock()
+
+    def out_of_time():
+        return deadline is not None and time.monotonic() - started >= deadline
+
+    def reserve(pages):
+        """从预算中预留页数，超时或预算不足时返回 False"""
+        with lock:
+            if out_of_time():
+                return False
+            if remaining_pages[0] is None:
+                return True
+            if pages > remaining_pages[0]:
+                return False
+            remaining_pages[0] -= pages
+            return True
+
+    def run_job(job):
+        """
+        :return: 是否完成；补历史中途停止时返回 False，已写入的部分下次运行时不会重新下载
+        """
+        symbol_start = time.perf_counter()
+        backfill = job["pages"] > BACKFILL_PAGES
+        # 补历史按分段下载和写入，尾部更新一次完成 (页数已在分配任务时预留)
+        chunk_span = BACKFILL_CHUNK_PAGES * step * market.kline_limit(interval) if backfill and step else None
+        rows = 0
+        finished = True
+        start_time = job["start"]
+        while start_time < job["end"]:
+            end_time = job["end"] if chunk_span is None else min(job["end"], start_time + chunk_span - 1)
+            if backfill and not reserve(estimate_pages(interval, start_time, end_time, market)):
+                finished = False
+                break
+            rows += update_symbol_range(storage, job["symbol"], interval, start_time, end_time, retry_queue, materialize, market)
+            start_time = end_time + 1
+        record_symbol(job["symbol"], rows, time.perf_counter() - symbol_start)
+        return finished
+
+    pending_tails, pending_backfills = deque(tails), deque(backfills)
+    running = {}
+    updated, deferred, failed = [], [], []
+
+    def next_job():
+        """选出下一个任务，没有可以开始的任务时返回 None"""
+        if out_of_time():
+            deferred.extend(job["symbol"] for job in list(pending_tails) + list(pending_backfills))
+            pending_tails.clear()
+            pending_backfills.clear()
+            return None
+        running_backfills = sum(job["pages"] > BACKFILL_PAGES for job in running.values())
+        if pending_backfills and running_backfills < backfill_workers:
+            return pending_backfills.popleft()
+        while pending_tails:
+            job = pending_tails.popleft()
+            if reserve(job["pages"]):
+                return job
+            deferred.append(job["symbol"])
+        return pending_backfills.popleft() if pending_backfills else None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            while len(running) < max_workers:
+                job = next_job()
+                if job is None:
+                    break
+                running[executor.submit(run_job, job)] = job
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                try:
+                    (updated if future.result() else deferred).append(job["symbol"])
+                except Exception as e:
+                    print(f"[错误] 更新 {job['symbol']} 数据时出错: {e}")
+                    failed.append(job["symbol"])
+
+    if out_of_time():
+        print(f"[提示] 已到截止时间，重试队列中的 {len(retry_queue)} 个时间段留到下次运行")
+    else:
+        # 有时间限制时只重试一轮，避免轮次之间的等待超出时间窗口
+        rounds = RETRY_QUEUE_ROUNDS if deadline is None else 1
+        drain_retry_queue(retry_queue, storage, interval, max_workers, rounds=rounds, materialize=materialize, market=market)
+
+    print(f"[总结] 已更新 {len(updated)} 个交易对，{len(deferred)} 个留到下次运行，失败 {len(failed)} 个，跳过 {len(skipped)} 个")
+    if deferred:
+        print(f"[提示] 留到下次运行: {deferred}")
+    return {"updated": updated, "deferred": deferred, "failed": failed, "skipped": skipped}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="按优先级更新K线数据 (适合定时任务)")
+    parser.add_argument("data_dir", help="数据目录")
+    parser.add_argument("interval", help="K线周期，例如 1m, 15m")
+    parser.add_argument("symbols", nargs="*", help="交易对列表，默认所有U本位永续合约 (其他市场为所有交易中的交易对)")
+    parser.add_argument("--workers", type=int, default=5, help="并发线程数")
+    parser.add_argument("--backfill-workers", type=int, help="同时进行补历史的最大线程数")
+    parser.add_argument("--deadline", type=float, help="运行时间上限（秒）")
+    parser.add_argument("--max-pages", type=int, help="最多请求的K线页数")
+    parser.add_argument("--start", help="起始更新时间 yyyy-mm-dd，默认从已有数据的最后时间开始")
+    parser.add_argument("--backend", default="pickle", help="存储后端 pickle / parquet")
+    parser.add_argument("--materialize", nargs="*", help="同时维护的高级别周期，例如 1h 4h 1d")
+    parser.add_argument("--market", default=DEFAULT_MARKET, help="市场 spot / um / cm")
+    args = parser.parse_args()
+
+    symbols = args.symbols or (get_binance_u_based_futures() if args.market == DEFAULT_MARKET else get_market_symbols(args.market))
+    update_historical_data_scheduled(symbols, args.interval, args.data_dir, update_start_time=args.start,
+                                     max_workers=args.workers, backfill_workers=args.backfill_workers, deadline=args.deadline,
+                                     max_pages=args.max_pages, backend=args.backend, materialize=args.materialize,
+                                     market=args.market)
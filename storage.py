@@ -0,0 +1,721 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from intervals import INTERVAL_MILLISECONDS
+from manifest import Manifest, summarize, summarize_append
+
+# Parquet 为可选依赖，只有使用 parquet 后端时才需要安装 pyarrow
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# 每个 row group 的行数，读取时按 row group 的时间统计信息跳过不需要的部分
+PARQUET_ROW_GROUP_SIZE = 8192
+
+# 存储中的时间列统一使用毫秒精度
+TIME_COLUMNS = ["Open time", "Close time"]
+
+# 数据目录的存储格式设置，只有启用了紧凑格式的目录才有这个文件
+SCHEMA_FILE = "schema.json"
+
+# 紧凑格式中价格和成交量字段最多保留的小数位数 (币安的价格和数量精度不超过 8 位小数)
+COMPACT_MAX_DECIMALS = 8
+
+
+def _to_timestamp(value):
+    """
+    把 "yyyy-mm-dd" 字符串 / datetime / Timestamp 统一转换为 Timestamp，None 保持不变
+    """
+    return None if value is None else pd.Timestamp(value)
+
+
+def _filter_time_range(df, start=None, end=None):
+    """
+    按 Open time 过滤 [start, end] 范围内的行 (两端都包含)
+    """
+    if start is not None:
+        df = df[df["Open time"] >= start]
+    if end is not None:
+        df = df[df["Open time"] <= end]
+    return df
+
+
+def _project_columns(df, columns):
+    """
+    只保留 Open time 和指定字段 (不存在的字段直接忽略，由调用方检查)
+    """
+    if columns is None:
+        return df
+    return df[[col for col in _with_open_time(columns) if col in df.columns]]
+
+
+def _merge_frames(frames):
+    """
+    按顺序合并多段数据，Open time 重复时保留后面的数据，并按时间排序
+    """
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return pd.DataFrame()
+    merged = pd.concat(frames, ignore_index=True)
+    merged = merged.drop_duplicates(subset=["Open time"], keep="last").sort_values(by="Open time")
+    return merged.reset_index(drop=True)
+
+
+def _with_open_time(columns):
+    """
+    在字段列表前加上 Open time 并去重
+    """
+    return list(dict.fromkeys(["Open time"] + list(columns)))
+
+
+# 紧凑格式 ----------
+
+def _derive_close_time(open_times, interval):
+    """
+    由 Open time 推算 Close time (下一根K线开始前 1 毫秒)
+    :param open_times: datetime64[ms] 数组
+    :return: datetime64[ms] 数组，周期无法推算时返回 None
+    """
+    if interval in INTERVAL_MILLISECONDS:
+        return open_times + np.timedelta64(INTERVAL_MILLISECONDS[interval] - 1, "ms")
+    if interval == "1M":
+        return (open_times.astype("datetime64[M]") + 1).astype("datetime64[ms]") - np.timedelta64(1, "ms")
+    return None
+
+
+def _column_decimals(values):
+    """
+    找到能精确表示整列数值的最少小数位数
+    :param values: float64 数组
+    :return: 小数位数，超过 COMPACT_MAX_DECIMALS 位时返回 None
+    """
+    values = values[np.isfinite(values)]
+    head = values[:1024]
+    for decimals in range(COMPACT_MAX_DECIMALS + 1):
+        scale = 10.0 ** decimals
+        # 先用开头的一小段数据排除明显不够的位数，再检查整列
+        if np.array_equal(np.round(head * scale) / scale, head) and np.array_equal(np.round(values * scale) / scale, values):
+            return decimals
+    return None
+
+
+def _restore_float32(values, decimals):
+    """
+    把 float32 还原为 float64：按保存时记录的小数位数取整，得到原来的十进制数值
+    (接口返回的价格和成交量都是十进制字符串，直接 astype(float64) 会带上 float32 的二进制误差)
+    """
+    scale = 10.0 ** decimals
+    return np.round(values.astype(np.float64) * scale) / scale
+
+
+def _is_compact(columns):
+    """
+    紧凑格式的文件没有 Close time 列
+    """
+    return "Open time" in columns and "Close time" not in columns
+
+
+def to_compact_schema(df, interval):
+    """
+    转换为紧凑格式：去掉可以由 Open time 推算的 Close time，价格和成交量字段转为 float32，
+    成交笔数转为 int32。每个字段都会检查能否原样还原，不能无损还原的字段保持原类型。
+    :param df: K线数据
+    :param interval: K线周期
+    :return: 紧凑格式的 DataFrame；Close time 不能由 Open time 推算时原样返回
+    """
+    if df.empty or _is_compact(df.columns) or "Open time" not in df.columns:
+        return df
+    close_times = _derive_close_time(df["Open time"].values.astype("datetime64[ms]"), interval)
+    if close_times is None or not np.array_equal(close_times, df["Close time"].values.astype("datetime64[ms]")):
+        return df
+
+    columns = {}
+    decimals = {}
+    for name in df.columns:
+        if name == "Close time":
+            continue
+        values = df[name]
+        if values.dtype == np.float64:
+            array = values.to_numpy()
+            column_decimals = _column_decimals(array)
+            compact = array.astype(np.float32)
+            if column_decimals is not None and np.array_equal(_restore_float32(compact, column_decimals), array, equal_nan=True):
+                values = compact
+                decimals[name] = column_decimals
+        elif pd.api.types.is_integer_dtype(values) and not values.hasnans \
+                and np.iinfo(np.int32).min <= values.min() and values.max() <= np.iinfo(np.int32).max:
+            # 可空的 Int64 也转为普通整数，不再需要额外的掩码数组
+            values = values.to_numpy(dtype=np.int32)
+        columns[name] = values
+    compact = pd.DataFrame(columns, index=df.index)
+    # 每个 float32 字段的小数位数随数据一起保存 (pickle 和 parquet 都会保留 attrs)
+    compact.attrs["decimals"] = decimals
+    return compact
+
+
+def from_compact_schema(df, interval, close_time=True):
+    """
+    把紧凑格式还原为标准格式：float32 字段还原为原来的 float64，int32 字段转为 int64，并推算 Close time
+    :param df: 紧凑格式的K线数据
+    :param interval: K线周期
+    :param close_time: 是否补上 Close time 列 (放在 Open time 之后)
+    :return: 标准格式的 DataFrame
+    """
+    columns = {name: df[name].to_numpy() for name in df.columns}
+    return pd.DataFrame(_expand_columns(columns, df.attrs.get("decimals", {}), interval, close_time), index=df.index)
+
+
+def _expand_columns(columns, decimals, interval, close_time):
+    """
+    from_compact_schema 的实现，按列处理 NumPy 数组，pickle 和 parquet 后端共用
+    :param columns: {字段: 数组}
+    :param decimals: 每个 float32 字段保存时记录的小数位数
+    :return: {字段: 数组}
+    """
+    expanded = {}
+    for name, values in columns.items():
+        if values.dtype == np.float32:
+            values = _restore_float32(values, decimals[name]) if name in decimals else values.astype(np.float64)
+        elif values.dtype == np.int32:
+            values = values.astype(np.int64)
+        expanded[name] = values
+        if name == "Open time" and close_time:
+            expanded["Close time"] = _derive_close_time(values.astype("datetime64[ms]"), interval)
+    return expanded
+
+
+def _same_values(original, restored):
+    """
+    检查还原后的数据与原始数据是否逐值相同 (不比较类型，例如 Int64 还原为 int64、纳秒时间还原为毫秒时间)
+    """
+    if list(original.columns) != list(restored.columns) or len(original) != len(restored):
+        return False
+    for name in original.columns:
+        a, b = original[name], restored[name]
+        if pd.api.types.is_datetime64_any_dtype(a):
+            equal = np.array_equal(a.values.astype("datetime64[ms]"), b.values.astype("datetime64[ms]"))
+        elif pd.api.types.is_numeric_dtype(a):
+            equal = np.array_equal(a.to_numpy(dtype=np.float64, na_value=np.nan), b.to_numpy(dtype=np.float64, na_value=np.nan),
+                                   equal_nan=True)
+        else:
+            equal = a.reset_index(drop=True).equals(b.reset_index(drop=True))
+        if not equal:
+            return False
+    return True
+
+
+def load_schema(data_dir):
+    """
+    :return: 数据目录的存储格式设置 dict，没有设置时返回空字典
+    """
+    path = os.path.join(data_dir, SCHEMA_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+class _BaseStorage:
+    """
+    存储后端的公共部分：通过数据目录下的 manifest.json 维护每个数据集的元数据。
+    清单中记录了数据文件的指纹 (文件名、大小、修改时间)，指纹不一致时自动回退为扫描文件。
+    """
+
+    def __init__(self, root):
+        """
+        :param root: 数据目录
+        """
+        self.root = root
+        self.manifest = Manifest(root)
+        # 目录启用了紧凑格式时，之后写入的数据都使用紧凑格式；读取时总是按文件自动还原
+        self.compact_schema = bool(load_schema(root).get("compact"))
+
+    def _to_schema(self, df, interval):
+        """
+        按目录设置转换写入的数据
+        """
+        return to_compact_schema(df, interval) if self.compact_schema else df
+
+    def files(self, symbol, interval):
+        """
+        :return: 数据集包含的所有文件路径
+        """
+        raise NotImplementedError
+
+    def checksum(self, symbol, interval):
+        """
+        计算数据文件指纹，只调用 stat，不读取文件内容
+        :return: 指纹字符串，没有文件时返回 None
+        """
+        files = sorted(self.files(symbol, interval))
+        if not files:
+            return None
+        digest = hashlib.sha1()
+        for path in files:
+            stat = os.stat(path)
+            digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        return digest.hexdigest()
+
+    def summary(self, symbol, interval, verify=False):
+        """
+        查询数据集的元数据 (首尾时间、行数、缺口数量等)
+        :param verify: 是否忽略清单，直接扫描数据文件并刷新清单
+        :return: 清单条目 dict，数据集不存在时返回 None
+        """
+        checksum = self.checksum(symbol, interval)
+        if checksum is None:
+            return None
+        if not verify:
+            entry = self.manifest.get(symbol, interval, checksum=checksum)
+            if entry is not None:
+                return entry
+
+        # 清单缺失或过期，扫描 Open time 列并写回清单
+        df = self.read(symbol, interval, columns=["Open time"])
+        return self.manifest.update(symbol, interval, summarize(df, interval), checksum)
+
+    def time_range(self, symbol, interval):
+        """
+        :return: (第一根K线的 Open time, 最后一根K线的 Open time)，没有数据时返回 None
+        """
+        entry = self.summary(symbol, interval)
+        if entry is None or entry["rows"] == 0:
+            return None
+        return pd.Timestamp(entry["first"], unit="ms"), pd.Timestamp(entry["last"], unit="ms")
+
+    def _record_write(self, symbol, interval, df):
+        """
+        覆盖写入后根据写入的数据刷新清单
+        """
+        self.manifest.update(symbol, interval, summarize(df, interval), self.checksum(symbol, interval))
+
+    def _record_append(self, symbol, interval, entry, df):
+        """
+        追加写入后根据追加前的条目和新数据推算清单，通常不读取已有历史；
+        新数据可能填补了已有的缺口或早于第一根K线时，重新扫描 Open time 列
+        """
+        summary = summarize_append(entry, df, interval)
+        if summary is None:
+            summary = summarize(self.read(symbol, interval, columns=["Open time"]), interval)
+        self.manifest.update(symbol, interval, summary, self.checksum(symbol, interval))
+
+
+class PickleStorage(_BaseStorage):
+    """
+    原有的存储方式：每个交易对/周期一个 {symbol}_{interval}.pkl 文件。
+    读取时需要反序列化整个文件，列投影和时间过滤在内存中完成。
+    """
+
+    def path(self, symbol, interval):
+        return os.path.join(self.root, f"{symbol}_{interval}.pkl")
+
+    def exists(self, symbol, interval):
+        return os.path.exists(self.path(symbol, interval))
+
+    def files(self, symbol, interval):
+        return [self.path(symbol, interval)] if self.exists(symbol, interval) else []
+
+    def list_datasets(self):
+        """
+        列出目录中已有的数据集
+        :return: [(symbol, interval), ...]
+        """
+        if not os.path.exists(self.root):
+            return []
+        datasets = []
+        for file_name in sorted(os.listdir(self.root)):
+            if file_name.endswith(".pkl"):
+                symbol, _, interval = file_name[:-len(".pkl")].rpartition("_")
+                datasets.append((symbol, interval))
+        return datasets
+
+    def read(self, symbol, interval, columns=None, start=None, end=None):
+        """
+        读取数据
+        :param symbol: 交易对
+        :param interval: K线周期
+        :param columns: 需要的字段，None 表示全部字段 (始终包含 Open time，不存在的字段会被忽略)
+        :param start: 开始时间 (包含)
+        :param end: 结束时间 (包含)
+        :return: DataFrame，文件不存在时返回空 DataFrame
+        """
+        if not self.exists(symbol, interval):
+            return pd.DataFrame()
+        df = pd.read_pickle(self.path(symbol, interval))
+        if df.empty:
+            return df
+        compact = _is_compact(df.columns)
+        df = _project_columns(_filter_time_range(df, _to_timestamp(start), _to_timestamp(end)), columns)
+        if compact:
+            df = _project_columns(from_compact_schema(df, interval, columns is None or "Close time" in columns), columns)
+        return df.reset_index(drop=True)
+
+    def write(self, symbol, interval, df):
+        """
+        覆盖写入整个数据集
+        """
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self._to_schema(df, interval).to_pickle(self.path(symbol, interval))
+        self._record_write(symbol, interval, df)
+        return self.path(symbol, interval)
+
+    def append(self, symbol, interval, df):
+        """
+        追加新数据，与已有数据重叠的部分以新数据为准。
+        pkl 是单文件格式，只能读出全部历史合并后整体重写。
+        """
+        existing_data = self.read(symbol, interval)
+        all_data = _merge_frames([existing_data, df])
+        return self.write(symbol, interval, all_data)
+
+
+class ParquetStorage(_BaseStorage):
+    """
+    列式存储：按交易对和月份分区，布局为 {root}/{symbol}_{interval}/{yyyy-mm}.parquet。
+    读取时先根据文件名跳过不在时间范围内的月份，再由 Parquet 的列投影和 row group 统计信息
+    只读取需要的字段和时间段。
+
+    增量更新只写入新的尾部分段 {yyyy-mm}.{序号}.delta.parquet，读取时与月份主文件合并
+    (Open time 重复时以较新的分段为准)，同一个月的分段数量达到 compact_threshold 后
+    自动合并回主文件。
+    """
+
+    def __init__(self, root, compact_threshold=8):
+        """
+        :param root: 数据目录
+        :param compact_threshold: 单个月份累积多少个增量分段后自动合并
+        """
+        if pq is None:
+            raise ImportError("parquet 存储需要安装 pyarrow: pip install pyarrow")
+        super().__init__(root)
+        self.compact_threshold = compact_threshold
+
+    def path(self, symbol, interval):
+        return os.path.join(self.root, f"{symbol}_{interval}")
+
+    def exists(self, symbol, interval):
+        return bool(self._partitions(symbol, interval))
+
+    def files(self, symbol, interval):
+        return [path for _, base, deltas in self._partitions(symbol, interval) for path in ([base] if base else []) + deltas]
+
+    def list_datasets(self):
+        """
+        列出目录中已有的数据集
+        :return: [(symbol, interval), ...]
+        """
+        if not os.path.exists(self.root):
+            return []
+        datasets = []
+        for dir_name in sorted(os.listdir(self.root)):
+            # 以 . 或 _ 开头的是缓存等内部目录，不是数据集
+            if dir_name.startswith((".", "_")):
+                continue
+            if os.path.isdir(os.path.join(self.root, dir_name)) and "_" in dir_name:
+                symbol, _, interval = dir_name.rpartition("_")
+                datasets.append((symbol, interval))
+        return datasets
+
+    def _partitions(self, symbol, interval):
+        """
+        :return: 按月份排序的 [(月份 Timestamp, 主文件路径或 None, [按写入顺序排列的增量分段路径]), ...]
+        """
+        dataset_dir = self.path(symbol, interval)
+        if not os.path.exists(dataset_dir):
+            return []
+        months = {}
+        for file_name in os.listdir(dataset_dir):
+            if not file_name.endswith(".parquet"):
+                continue
+            parts = file_name.split(".")
+            month = parts[0]
+            base, deltas = months.setdefault(month, [None, []])
+            if len(parts) == 2:
+                months[month][0] = os.path.join(dataset_dir, file_name)
+            else:
+                deltas.append((int(parts[1]), os.path.join(dataset_dir, file_name)))
+        return [(pd.Timestamp(month + "-01"), base, [path for _, path in sorted(deltas)])
+                for month, (base, deltas) in sorted(months.items())]
+
+    @staticmethod
+    def _read_files(paths, interval, columns=None, filters=None):
+        """
+        读取一组 parquet 文件并按顺序合并为一个 DataFrame，紧凑格式的文件还原为标准格式
+        :return: DataFrame，没有文件时返回 None
+        """
+        tables = []
+        compact = []
+        for path in paths:
+            read_columns = None
+            if columns is None:
+                table = pq.read_table(path, filters=filters or None)
+                names = table.column_names
+            else:
+                # 不存在的字段直接忽略，由调用方检查
+                names = pq.read_schema(path).names
+                read_columns = [col for col in _with_open_time(columns) if col in names]
+                table = pq.read_table(path, columns=read_columns, filters=filters or None)
+            tables.append(table)
+            compact.append(_is_compact(names))
+        if not tables:
+            return None
+        if any(compact):
+            close_time = columns is None or "Close time" in columns
+            tables = [ParquetStorage._expand_table(table, interval, columns, close_time) if is_compact else table
+                      for table, is_compact in zip(tables, compact)]
+        return pa.concat_tables(tables, promote_options="permissive").to_pandas()
+
+    @staticmethod
+    def _expand_table(table, interval, columns, close_time):
+        """
+        在 Arrow 中把紧凑格式的文件还原为标准格式，之后与其他文件一起合并、只转换一次 DataFrame
+        """
+        decimals = (table.schema.pandas_metadata or {}).get("attributes", {}).get("decimals", {})
+        expanded = _expand_columns({name: table.column(name).to_numpy() for name in table.column_names},
+                                   decimals, interval, close_time)
+        # 与标准格式文件的字段顺序保持一致
+        order = list(expanded) if columns is None else [col for col in _with_open_time(columns) if col in expanded]
+        return pa.table({name: expanded[name] for name in order})
+
+    def read(self, symbol, interval, columns=None, start=None, end=None):
+        """
+        读取数据，只访问时间范围内的月份文件和 row group
+        :param symbol: 交易对
+        :param interval: K线周期
+        :param columns: 需要的字段，None 表示全部字段 (始终包含 Open time，不存在的字段会被忽略)
+        :param start: 开始时间 (包含)
+        :param end: 结束时间 (包含)
+        :return: DataFrame，数据集不存在时返回空 DataFrame
+        """
+        start, end = _to_timestamp(start), _to_timestamp(end)
+
+        filters = []
+        if start is not None:
+            filters.append(("Open time", ">=", start))
+        if end is not None:
+            filters.append(("Open time", "<=", end))
+
+        paths = []
+        has_deltas = False
+        for month, base, deltas in self._partitions(symbol, interval):
+            if start is not None and month + pd.DateOffset(months=1) <= start:
+                continue
+            if end is not None and month > end:
+                continue
+            paths.extend(([base] if base else []) + deltas)
+            has_deltas = has_deltas or bool(deltas)
+
+        df = self._read_files(paths, interval, columns, filters)
+        if df is None:
+            return pd.DataFrame()
+        # 有增量分段时需要去掉与主文件重叠的旧数据
+        return _merge_frames([df]) if has_deltas else df
+
+    def write(self, symbol, interval, df):
+        """
+        覆盖写入整个数据集 (按月份切分为多个文件)
+        """
+        dataset_dir = self.path(symbol, interval)
+        if not os.path.exists(dataset_dir):
+            os.makedirs(dataset_dir)
+
+        # 先写入新分区 (原子替换同名月份)，再删除不再需要的旧分区和增量分段
+        written = set()
+        for month, part in self._split_by_month(self._to_schema(df, interval)):
+            written.add(self._write_file(os.path.join(dataset_dir, f"{month}.parquet"), part))
+        for path in self.files(symbol, interval):
+            if path not in written:
+                os.remove(path)
+        self._record_write(symbol, interval, df)
+        return dataset_dir
+
+    def append(self, symbol, interval, df):
+        """
+        追加新数据：每个涉及的月份只写入一个新的增量分段，不读取、不重写已有历史。
+        与已有数据重叠的部分在读取 (或合并) 时以新数据为准。
+        """
+        dataset_dir = self.path(symbol, interval)
+        if not os.path.exists(dataset_dir):
+            os.makedirs(dataset_dir)
+
+        entry = self.summary(symbol, interval)
+        partitions = {month.strftime("%Y-%m"): (base, deltas) for month, base, deltas in self._partitions(symbol, interval)}
+        for month, part in self._split_by_month(self._to_schema(df, interval)):
+            if month not in partitions:
+                self._write_file(os.path.join(dataset_dir, f"{month}.parquet"), part)
+                continue
+
+            _, deltas = partitions[month]
+            self._write_file(os.path.join(dataset_dir, f"{month}.{time.time_ns()}.delta.parquet"), part)
+            if len(deltas) + 1 >= self.compact_threshold:
+                self._compact_months(symbol, interval, [month])
+        self._record_append(symbol, interval, entry, df)
+        return dataset_dir
+
+    def compact(self, symbol, interval, months=None):
+        """
+        把增量分段合并回月份主文件
+        :param symbol: 交易对
+        :param interval: K线周期
+        :param months: 只合并这些月份 (yyyy-mm)，None 表示所有有增量分段的月份
+        """
+        entry = self.summary(symbol, interval)
+        self._compact_months(symbol, interval, months)
+        if entry is not None:
+            # 合并不改变数据内容，只需要刷新文件指纹
+            self.manifest.update(symbol, interval, entry, self.checksum(symbol, interval))
+
+    def _compact_months(self, symbol, interval, months=None):
+        dataset_dir = self.path(symbol, interval)
+        for month, base, deltas in self._partitions(symbol, interval):
+            month = month.strftime("%Y-%m")
+            if not deltas or (months is not None and month not in months):
+                continue
+            merged = _merge_frames([self._read_files(([base] if base else []) + deltas, interval)])
+            self._write_file(os.path.join(dataset_dir, f"{month}.parquet"), self._to_schema(merged, interval))
+            for path in deltas:
+                os.remove(path)
+
+    @staticmethod
+    def _split_by_month(df):
+        """
+        把按时间排序的数据切分为每月一块
+        :return: [(月份字符串 yyyy-mm, DataFrame), ...]
+        """
+        if df.empty:
+            return []
+        if not df["Open time"].is_monotonic_increasing:
+            df = df.sort_values(by="Open time")
+        months = df["Open time"].values.astype("datetime64[M]")
+        boundaries = np.flatnonzero(months[1:] != months[:-1]) + 1
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [len(df)]])
+        return [(str(months[s]), df.iloc[s:e]) for s, e in zip(starts, ends)]
+
+    @staticmethod
+    def _write_file(path, df):
+        """
+        写入单个 parquet 文件 (先写临时文件再替换，避免中途失败留下损坏的分区)
+        """
+        df = df.reset_index(drop=True)
+        for col in TIME_COLUMNS:
+            if col in df.columns:
+                df[col] = df[col].astype("datetime64[ms]")
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+        tmp_path = f"{path}.tmp"
+        pq.write_table(table, tmp_path, row_group_size=PARQUET_ROW_GROUP_SIZE)
+        os.replace(tmp_path, path)
+        return path
+
+
+# 可选的存储后端
+STORAGE_BACKENDS = {
+    "pickle": PickleStorage,
+    "parquet": ParquetStorage,
+}
+
+
+def get_storage(data_dir, backend="pickle"):
+    """
+    根据后端名称创建存储对象
+    :param data_dir: 数据目录
+    :param backend: "pickle" (默认，兼容已有的 pkl 文件) 或 "parquet"
+    :return: 存储对象
+    """
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"未知的存储后端 {backend}，可选: {list(STORAGE_BACKENDS)}")
+    return STORAGE_BACKENDS[backend](data_dir)
+
+
+def migrate_pickles(src_dir, dst_dir, backend="parquet"):
+    """
+    把 pkl 目录中的所有数据迁移到新的存储后端
+    :param src_dir: 原 pkl 数据目录
+    :param dst_dir: 新的数据目录
+    :param backend: 目标存储后端
+    :return: 成功迁移的 [(symbol, interval), ...]
+    """
+    source = PickleStorage(src_dir)
+    target = get_storage(dst_dir, backend)
+
+    migrated = []
+    for symbol, interval in source.list_datasets():
+        try:
+            df = source.read(symbol, interval)
+            target.write(symbol, interval, df)
+            migrated.append((symbol, interval))
+            print(f"[完成] {symbol}_{interval} 已迁移，共 {len(df)} 行")
+        except Exception as e:
+            print(f"[错误] 迁移 {symbol}_{interval} 时出错: {e}")
+
+    print(f"[总结] 共迁移 {len(migrated)} 个数据集到 {dst_dir}")
+    return migrated
+
+
+def set_compact_schema(data_dir, backend="pickle", enabled=True):
+    """
+    启用 (或关闭) 数据目录的紧凑格式，并把已有数据集全部转换过去。
+    紧凑格式不保存 Close time (读取时由 Open time 推算)，价格和成交量在能无损还原时使用 float32，
+    成交笔数使用 int32，磁盘占用大约减半。读取时自动还原为原来的类型和数值，调用方不需要任何改动。
+    每个数据集转换后都会重新读取并与原数据逐值比较，不一致时恢复原数据。
+    :param data_dir: 数据目录 (使用市场子目录时为该市场实际使用的目录)
+    :param backend: 存储后端
+    :param enabled: True 启用紧凑格式，False 恢复标准格式
+    :return: 转换失败的 [(symbol, interval), ...]
+    """
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    tmp_path = os.path.join(data_dir, f"{SCHEMA_FILE}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"compact": enabled}, f)
+    os.replace(tmp_path, os.path.join(data_dir, SCHEMA_FILE))
+
+    storage = get_storage(data_dir, backend)
+    failed = []
+    for symbol, interval in storage.list_datasets():
+        try:
+            df = storage.read(symbol, interval)
+            storage.write(symbol, interval, df)
+            if not _same_values(df, storage.read(symbol, interval)):
+                # 不能无损还原时用标准格式写回原数据
+                storage.compact_schema = False
+                storage.write(symbol, interval, df)
+                storage.compact_schema = enabled
+                raise ValueError("转换后的数据与原数据不一致，已恢复原数据")
+        except Exception as e:
+            print(f"[错误] 转换 {symbol}_{interval} 时出错: {e}")
+            failed.append((symbol, interval))
+
+    print(f"[总结] {data_dir} 已{'启用' if enabled else '关闭'}紧凑格式，转换失败 {len(failed)} 个数据集")
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="K线数据存储工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="把 pkl 目录迁移到列式存储")
+    migrate_parser.add_argument("src_dir", help="原 pkl 数据目录")
+    migrate_parser.add_argument("dst_dir", help="新的数据目录")
+    migrate_parser.add_argument("--backend", default="parquet", choices=list(STORAGE_BACKENDS))
+
+    schema_parser = subparsers.add_parser("compact-schema", help="启用紧凑格式并转换目录中已有的数据")
+    schema_parser.add_argument("data_dir", help="数据目录")
+    schema_parser.add_argument("--backend", default="pickle", choices=list(STORAGE_BACKENDS))
+    schema_parser.add_argument("--disable", action="store_true", help="关闭紧凑格式，把数据转换回标准格式")
+
+    args = parser.parse_args()
+    if args.command == "migrate":
+        migrate_pickles(args.src_dir, args.dst_dir, args.backend)
+    elif args.command == "compact-schema":
+        set_compact_schema(args.data_dir, args.backend, enabled=not args.disable)
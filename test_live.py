@@ -0,0 +1,91 @@
+import asyncio
+import threading
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip("websockets")
+
+from download import parse_kline_rows
+from fake_binance import FakeBinanceServer, FakeKlineStream, synthetic_kline_rows
+from live import LiveKlineIngestor
+from storage import get_storage
+
+SYMBOL = "AUSDT"
+STEP = 60 * 1000
+
+
+class _RunningIngestor:
+    """
+    在后台线程的事件循环中运行订阅，stop() 时与 Ctrl+C 一样取消所有任务并写入缓存
+    """
+
+    def __init__(self, ingestor):
+        self.loop = asyncio.new_event_loop()
+        self.task = self.loop.create_task(ingestor._run(None))
+        self.thread = threading.Thread(target=self._main, daemon=True)
+        self.thread.start()
+
+    def _main(self):
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.loop.close()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        self.thread.join(timeout=30)
+        assert not self.thread.is_alive()
+
+
+def _wait_until(condition, timeout=15):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "等待超时"
+        time.sleep(0.01)
+
+
+def test_reconnect_backfill_merges_out_of_order_kline_without_gaps(tmp_path):
+    data_dir = str(tmp_path)
+    last_closed = int(time.time() * 1000) // STEP * STEP - STEP
+    # 本地历史停在 30 分钟前，中间的缺口由重连后的 REST 补下载填上
+    history_start, history_end = last_closed - 130 * STEP, last_closed - 30 * STEP
+    history = parse_kline_rows(synthetic_kline_rows(SYMBOL, "1m", np.arange(history_start, history_end + 1, STEP, dtype=np.int64)))
+    get_storage(data_dir).write(SYMBOL, "1m", history)
+
+    # REST 请求较慢，补下载完成前 WebSocket 就能收到消息
+    with FakeBinanceServer([SYMBOL], latency=0.5) as server, FakeKlineStream() as stream:
+        server.install()
+        ingestor = LiveKlineIngestor([SYMBOL], "1m", data_dir, stream_url=stream.url, flush_interval=3600)
+        running = _RunningIngestor(ingestor)
+        try:
+            # 第一次连接的补下载还没完成就断线：补下载被取消，覆盖位置不变
+            assert stream.wait_for_connections(1)
+            assert stream.disconnect() == 1
+            assert stream.wait_for_connections(2)
+            assert ingestor._last_open_time[SYMBOL] == history_end
+            assert not ingestor._frames
+
+            # 重连后补下载进行中收到一根不连续的K线 (补下载会把它当作未收盘去掉)，先放进 _ahead
+            assert stream.push(SYMBOL, "1m", last_closed + STEP) == 1
+            _wait_until(lambda: ingestor._ahead.get(SYMBOL) == [last_closed + STEP])
+            assert ingestor._last_open_time[SYMBOL] == history_end
+
+            # 补下载填上缺口后并入覆盖位置
+            _wait_until(lambda: ingestor._last_open_time[SYMBOL] == last_closed + STEP)
+            assert ingestor._ahead[SYMBOL] == []
+        finally:
+            running.stop()
+
+    assert stream.stats["connections"] == 2
+    entry = get_storage(data_dir).summary(SYMBOL, "1m", verify=True)
+    assert (entry["first"], entry["last"], entry["gaps"]) == (history_start, last_closed + STEP, 0)
+
+    expected = parse_kline_rows(synthetic_kline_rows(SYMBOL, "1m", np.arange(history_start, last_closed + 2 * STEP, STEP, dtype=np.int64)))
+    df = get_storage(data_dir).read(SYMBOL, "1m")
+    assert len(df) == len(expected)
+    for column in ["Open time", "Close time", "Open", "High", "Low", "Close", "Volume", "Number of trades"]:
+        np.testing.assert_array_equal(df[column].to_numpy(), expected[column].to_numpy())
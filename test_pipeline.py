@@ -0,0 +1,34 @@
+import glob
+import os
+
+import pytest
+
+from checkpoint import PARTIAL_DIR
+from download import download_historical_data_multi_threads
+from fake_binance import FakeBinanceServer
+from pipeline import download_historical_data_pipeline
+from storage import get_storage
+
+SYMBOLS = ["AUSDT", "BUSDT"]
+
+
+@pytest.fixture
+def server():
+    with FakeBinanceServer(SYMBOLS) as fake:
+        fake.install()
+        yield fake
+
+
+@pytest.mark.parametrize("backend", ["pickle", "parquet"])
+def test_chunked_pipeline_matches_threaded_download(tmp_path, server, backend):
+    expected_dir, pipeline_dir = str(tmp_path / "threads"), str(tmp_path / "pipeline")
+    download_historical_data_multi_threads(SYMBOLS, "15m", "2020-01-01", "2020-03-01", expected_dir, backend=backend)
+    # 每个分块只有 2 页，一个交易对会被拆成很多个分块
+    download_historical_data_pipeline(SYMBOLS, "15m", "2020-01-01", "2020-03-01", pipeline_dir, process_workers=2,
+                                      queue_size=1, chunk_pages=2, backend=backend)
+
+    for symbol in SYMBOLS:
+        expected = get_storage(expected_dir, backend).read(symbol, "15m")
+        assert get_storage(pipeline_dir, backend).read(symbol, "15m").equals(expected)
+    # 暂存的分块在写入后删除
+    assert glob.glob(os.path.join(pipeline_dir, PARTIAL_DIR, "*.pipeline.*")) == []
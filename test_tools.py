@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+from download import parse_kline_rows
+from fake_binance import synthetic_kline_rows
+from intervals import INTERVAL_MILLISECONDS
+from storage import get_storage
+from tools import build_prices_memmap
+
+# 2024-01-01 (周一) 00:00 UTC
+MONDAY = 1704067200000
+
+
+def _write_weekly(data_dir, symbol="BTCUSDT", weeks=8):
+    open_times = MONDAY + INTERVAL_MILLISECONDS["1w"] * np.arange(weeks, dtype=np.int64)
+    df = parse_kline_rows(synthetic_kline_rows(symbol, "1w", open_times))
+    get_storage(data_dir).write(symbol, "1w", df)
+    return df
+
+
+def test_build_prices_memmap_weekly_rows_match_open_time(tmp_path):
+    data_dir = str(tmp_path / "data")
+    df = _write_weekly(data_dir)
+
+    values, times, symbols, fields = build_prices_memmap(data_dir, str(tmp_path / "panel.npy"), "1w", backend="pickle")
+
+    assert symbols == ["BTCUSDT"]
+    assert list(times) == list(df["Open time"])
+    assert (times.dayofweek == 0).all()
+    np.testing.assert_array_equal(values[:, 0, :], df[fields].to_numpy())
+
+
+def test_build_prices_memmap_weekly_start_date_snaps_to_next_monday(tmp_path):
+    data_dir = str(tmp_path / "data")
+    df = _write_weekly(data_dir)
+
+    # 周三开始：第一行是下一个周一的周线
+    values, times, _, fields = build_prices_memmap(data_dir, str(tmp_path / "panel.npy"), "1w", start_date="2024-01-03",
+                                                   end_date="2024-02-19", backend="pickle")
+
+    assert times[0] == pd.Timestamp("2024-01-08")
+    assert list(times) == list(df["Open time"].iloc[1:])
+    np.testing.assert_array_equal(values[:, 0, :], df[fields].iloc[1:].to_numpy())
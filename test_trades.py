@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from resample import resample_klines
+from trades import TRADE_COLUMNS, _day_path, agg_trades_dir, build_bars, save_agg_trades_day
+
+DAY = 24 * 60 * 60 * 1000
+
+
+def _write_trades(output_dir, symbol, start_date, days, every=10 * 60 * 1000):
+    """
+    每隔 every 毫秒一笔确定性的合成成交，按天保存
+    """
+    directory = agg_trades_dir(output_dir, symbol)
+    first_day = int(pd.Timestamp(start_date).timestamp() * 1000)
+    for day in range(days):
+        day_start = first_day + day * DAY
+        times = np.arange(day_start, day_start + DAY, every, dtype=np.int64)
+        index = (times - first_day) // every
+        save_agg_trades_day(_day_path(directory, day_start), {
+            "id": index,
+            "time": times,
+            "price": 100 + np.sin(index / 50.0) * 5 + (index % 7) * 0.1,
+            "quantity": 1 + (index % 5) * 0.5,
+            "trades": np.ones(len(times), dtype=TRADE_COLUMNS["trades"]),
+            "buyer_maker": index % 3 == 0,
+        })
+
+
+@pytest.mark.parametrize("size", ["1w", "7D"])
+def test_weekly_time_bars_match_resampled_klines(tmp_path, size):
+    output_dir = str(tmp_path)
+    # 2024-01-03 是周三，第一根和最后一根周线都不完整
+    _write_trades(output_dir, "BTCUSDT", "2024-01-03", days=20)
+
+    weekly = build_bars(output_dir, "BTCUSDT", "time", size, max_workers=2)
+    expected = resample_klines(build_bars(output_dir, "BTCUSDT", "time", "1h", max_workers=2), "1h", ["1w"])["1w"]
+
+    assert (weekly["Open time"].dt.dayofweek == 0).all()
+    assert list(weekly["Open time"]) == list(expected["Open time"])
+    assert list(weekly["Close time"]) == list(expected["Close time"])
+    for column in ["Open", "High", "Low", "Close", "Number of trades"]:
+        np.testing.assert_array_equal(weekly[column].to_numpy(), expected[column].to_numpy())
+    for column in ["Volume", "Quote asset volume", "Taker buy base asset volume", "Taker buy quote asset volume"]:
+        np.testing.assert_allclose(weekly[column].to_numpy(), expected[column].to_numpy())
@@ -1,60 +1,76 @@
-import os
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 
-def create_prices_dataframe(data_dir, start_date=None, end_date=None, fields=['Open', 'Close']):
+from exchange_info import get_exchange_info_index, symbol_status
+from intervals import INTERVAL_MILLISECONDS
+from resample import INTERVAL_OFFSET_MILLISECONDS
+from storage import get_storage
+
+# 读取单个标的指定字段和时间段
+def _read_symbol_fields(storage, symbol, interval, fields, start_date=None, end_date=None):
+    """
+    读取单个标的的指定字段，并以 trade_date 为索引
+    :return: DataFrame；文件无法读取或缺少字段时返回 None
+    """
+    file_name = f"{symbol}_{interval}"
+    try:
+        # 存储层负责列投影和按时间范围过滤
+        df = storage.read(symbol, interval, columns=fields, start=start_date, end=end_date)
+    except Exception as e:
+        print(f"[错误] 无法读取文件 {storage.path(symbol, interval)}: {e}")
+        return None
+
+    # 检查所需字段是否在文件中存在
+    missing_fields = [field for field in fields if field not in df.columns]
+    if missing_fields:
+        print(f"[警告] 文件 {file_name} 缺失必要字段 {missing_fields}，跳过处理！")
+        return None
+
+    # 保留索引为时间列，并重命名为 trade_date
+    if "Open time" not in df.columns:
+        print(f"[警告] 文件 {file_name} 缺失 'Open time' 列，跳过处理！")
+        return None
+
+    df = df.rename(columns={"Open time": "trade_date"})
+    df["trade_date"] = pd.to_datetime(df["trade_date"])
+    return df.set_index("trade_date")[fields]
+
+def _select_datasets(storage, interval=None):
+    """
+    列出目录中的数据集，指定 interval 时只保留该周期
+    :raises ValueError: 没有指定 interval 而目录中有多个周期 (例如 materialize 写入的高级别周期)，
+                        否则同一个标的的不同周期会在按标的合并时互相覆盖
+    """
+    datasets = storage.list_datasets()
+    if interval is None:
+        intervals = sorted({dataset_interval for _, dataset_interval in datasets})
+        if len(intervals) > 1:
+            raise ValueError(f"目录 {storage.root} 中有多个周期 {intervals}，请通过 interval 参数指定要读取的周期")
+        return datasets
+    return [(symbol, dataset_interval) for symbol, dataset_interval in datasets if dataset_interval == interval]
+
+def create_prices_dataframe(data_dir, start_date=None, end_date=None, fields=['Open', 'Close'], backend="pickle",
+                            interval=None, max_workers=4):
     """
-    从指定的目录中提取所有 pkl 文件并生成多索引大表。
+    从指定的目录中提取所有标的数据并生成多索引大表。
     
-    :param data_dir: 本地文件夹路径，包含以 pkl 格式存储的各标的数据。
+    :param data_dir: 本地文件夹路径，包含各标的数据。
     :param start_date: 数据的开始日期，格式为 "yyyy-mm-dd" (字符串类型或 None)。
     :param end_date: 数据的结束日期，格式为 "yyyy-mm-dd" (字符串类型或 None)。
     :param fields: 要提取的字段列表，默认 ['Open', 'Close']。
+    :param backend: 存储后端，"pickle" (默认) 或 "parquet"。parquet 只读取需要的字段和时间段。
+    :param interval: 只读取该周期的数据，默认读取全部；目录中混有多个周期 (例如更新时使用了 materialize) 时必须指定。
+    :param max_workers: 并行读取文件的线程数。
     :return: 格式化后的 Pandas DataFrame。
     """
-    # 初始化一个空的字典，用于拼接数据
-    data_dict = {}
-
-    # 遍历目录中的所有 pkl 文件
-    for file_name in os.listdir(data_dir):
-        # 检查仅处理以 .pkl 结尾的文件
-        if file_name.endswith(".pkl"):
-            # 提取 symbol 名称
-            symbol = file_name.split("_")[0]
-
-            # 读取 pkl 文件
-            file_path = os.path.join(data_dir, file_name)
-            try:
-                df = pd.read_pickle(file_path)
-            except Exception as e:
-                print(f"[错误] 无法读取文件 {file_path}: {e}")
-                continue
-
-            # 检查所需字段是否在文件中存在
-            missing_fields = [field for field in fields if field not in df.columns]
-            if missing_fields:
-                print(f"[警告] 文件 {file_name} 缺失必要字段 {missing_fields}，跳过处理！")
-                continue
-
-            # 保留索引为时间列，并重命名为 trade_date
-            if "Open time" not in df.columns:
-                print(f"[警告] 文件 {file_name} 缺失 'Open time' 列，跳过处理！")
-                continue
-
-            df.rename(columns={"Open time": "trade_date"}, inplace=True)
-            df["trade_date"] = pd.to_datetime(df["trade_date"])
-            df.set_index("trade_date", inplace=True)
-
-            # 按时间范围过滤数据
-            if start_date:
-                start_date_ts = pd.to_datetime(start_date)
-                df = df[df.index >= start_date_ts]
-            if end_date:
-                end_date_ts = pd.to_datetime(end_date)
-                df = df[df.index <= end_date_ts]
-
-            # 提取指定字段并加入字典
-            data_dict[symbol] = df[fields]
+    storage = get_storage(data_dir, backend)
+    datasets = _select_datasets(storage, interval)
+
+    # 并行读取每个标的，只保留需要的字段和时间段
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frames = executor.map(lambda dataset: _read_symbol_fields(storage, *dataset, fields, start_date, end_date), datasets)
+        data_dict = {symbol: df for (symbol, _), df in zip(datasets, frames) if df is not None}
 
     # 合并所有标的数据
     if data_dict:
@@ -65,28 +81,136 @@ def create_prices_dataframe(data_dir, start_date=None, end_date=None, fields=['O
         print("[警告] 未发现有效数据文件！")
         return pd.DataFrame()  # 返回空 DataFrame
 
-def get_binance_u_based_futures(base_asset="USDT"):
+def iter_prices_dataframe(data_dir, start_date, end_date, fields=['Open', 'Close'], backend="parquet", interval=None,
+                          block="30D", max_workers=4):
+    """
+    按时间块逐块生成与 create_prices_dataframe 格式相同的大表，内存中只保留当前块。
+    每个块只读取该时间段的数据，适合 parquet 后端 (pickle 后端每个块都要完整反序列化所有文件)。
+
+    :param data_dir: 本地文件夹路径，包含各标的数据。
+    :param start_date: 数据的开始日期，格式为 "yyyy-mm-dd"。
+    :param end_date: 数据的结束日期，格式为 "yyyy-mm-dd" (包含)。
+    :param fields: 要提取的字段列表，默认 ['Open', 'Close']。
+    :param backend: 存储后端，默认 "parquet"。
+    :param interval: 只读取该周期的数据，默认读取全部；目录中混有多个周期时必须指定。
+    :param block: 每个时间块的长度，pandas 时间间隔字符串，例如 "30D"、"7D"。
+    :param max_workers: 并行读取文件的线程数。
+    :return: 生成器，每次产出 (块开始时间, 块结束时间, DataFrame)，块的时间范围左闭右开。
+    """
+    if backend == "pickle":
+        print("[警告] pickle 后端不支持按时间段读取，每个时间块都会完整读取所有文件，建议先迁移到 parquet")
+
+    storage = get_storage(data_dir, backend)
+    datasets = _select_datasets(storage, interval)
+    block_length = pd.Timedelta(block)
+    end = pd.Timestamp(end_date)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        block_start = pd.Timestamp(start_date)
+        while block_start <= end:
+            block_end = min(block_start + block_length, end + pd.Timedelta(milliseconds=1))
+            # 存储层的 end 是闭区间，减去 1 毫秒得到左闭右开的时间块
+            read_end = block_end - pd.Timedelta(milliseconds=1)
+            frames = executor.map(lambda dataset: _read_symbol_fields(storage, *dataset, fields, block_start, read_end), datasets)
+            data_dict = {symbol: df for (symbol, _), df in zip(datasets, frames) if df is not None and not df.empty}
+            if data_dict:
+                yield block_start, block_end, pd.concat(data_dict, axis=1).sort_index()
+            block_start = block_end
+
+def build_prices_memmap(data_dir, output_path, interval, start_date=None, end_date=None, fields=['Open', 'Close'],
+                        backend="parquet", dtype="float64", max_workers=4):
+    """
+    把目录中所有标的写入一个磁盘上的三维数组 (时间 × 标的 × 字段)，逐个文件填充，
+    内存中同时只保留 max_workers 个标的的数据。缺失的K线为 NaN。
+    返回的数组是 np.memmap，回测框架可以按需切片，不需要把整张表读进内存。
+
+    :param data_dir: 本地文件夹路径，包含各标的数据。
+    :param output_path: 输出的 .npy 文件路径 (可以用 np.load(..., mmap_mode="r") 重新打开)。
+    :param interval: K线周期，例如 "15m"，决定时间轴的步长。
+    :param start_date: 数据的开始日期，None 表示从所有标的中最早的K线开始。
+    :param end_date: 数据的结束日期 (包含)，None 表示到所有标的中最晚的K线为止。
+    :param fields: 要提取的字段列表，默认 ['Open', 'Close']。
+    :param backend: 存储后端，默认 "parquet"。
+    :param dtype: 数组类型，"float64" 或 "float32"。
+    :param max_workers: 并行读取文件的线程数。
+    :return: (memmap 数组, 时间轴 DatetimeIndex, 标的列表, 字段列表)
+    """
+    step = INTERVAL_MILLISECONDS[interval]
+    storage = get_storage(data_dir, backend)
+    datasets = _select_datasets(storage, interval)
+
+    # 未指定时间范围时，从清单中取所有标的的首尾时间，不需要读取数据
+    start_ms = None if start_date is None else int(pd.Timestamp(start_date).timestamp() * 1000)
+    end_ms = None if end_date is None else int(pd.Timestamp(end_date).timestamp() * 1000)
+    if start_ms is None or end_ms is None:
+        entries = [storage.summary(symbol, interval) for symbol, _ in datasets]
+        entries = [entry for entry in entries if entry is not None and entry["rows"]]
+        if not entries:
+            print("[警告] 未发现有效数据文件！")
+            return None
+        start_ms = min(entry["first"] for entry in entries) if start_ms is None else start_ms
+        end_ms = max(entry["last"] for entry in entries) if end_ms is None else end_ms
+
+    # 时间轴对齐到周期的起点，与 resample 相同 (周线从周一开始，不是 1970-01-01 的周四)
+    start_ms += (INTERVAL_OFFSET_MILLISECONDS.get(interval, 0) - start_ms) % step
+    times = np.arange(start_ms, end_ms + 1, step, dtype=np.int64)
+    symbols = [symbol for symbol, _ in datasets]
+
+    panel = np.lib.format.open_memmap(output_path, mode="w+", dtype=dtype, shape=(len(times), len(symbols), len(fields)))
+    panel[:] = np.nan
+
+    def fill_symbol(position):
+        symbol = symbols[position]
+        df = _read_symbol_fields(storage, symbol, interval, fields,
+                                 pd.Timestamp(start_ms, unit="ms"), pd.Timestamp(end_ms, unit="ms"))
+        if df is None or df.empty:
+            return
+        rows = (df.index.values.astype("datetime64[ms]").astype(np.int64) - start_ms) // step
+        panel[rows, position, :] = df.to_numpy(dtype=dtype)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(fill_symbol, range(len(symbols))))
+    panel.flush()
+
+    return panel, pd.to_datetime(times, unit="ms"), symbols, list(fields)
+
+def get_binance_u_based_futures(base_asset="USDT", cache_file=None):
     """
     获取币安所有 U 本位合约交易对并返回为列表
     :param base_asset: Quote asset (默认: USDT, 也可以是 BUSD)
+    :param cache_file: 可选的 exchangeInfo 磁盘快照路径，有效期内不再请求
     :return: 包含所有符合条件合约名称的列表
     """
-    url = "https://fapi.binance.com/fapi/v1/exchangeInfo"
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
-
-        # 筛选出所有符号 (symbol) 且 quoteAsset 为指定的 USDT
-        futures_symbols = [
-            symbol["symbol"] for symbol in data["symbols"]
-            if symbol["quoteAsset"] == base_asset and symbol["contractType"] == "PERPETUAL"
-        ]
-        return futures_symbols
-    except Exception as e:
-        print(f"[错误] 无法获取数据: {e}")
+    index = get_exchange_info_index(cache_file=cache_file)
+    if index is None:
+        print("[错误] 无法获取数据: exchangeInfo 不可用")
         return []
 
+    # 筛选出所有符号 (symbol) 且 quoteAsset 为指定的 USDT
+    futures_symbols = [
+        symbol["symbol"] for symbol in index.values()
+        if symbol["quoteAsset"] == base_asset and symbol["contractType"] == "PERPETUAL"
+    ]
+    return futures_symbols
+
+def get_market_symbols(market="spot", quote_asset=None, cache_file=None):
+    """
+    获取某个市场当前交易中的交易对列表
+    :param market: 市场 "spot" / "um" / "cm"
+    :param quote_asset: 只保留该计价资产的交易对，例如 "USDT"；None 表示全部
+    :param cache_file: 可选的 exchangeInfo 磁盘快照路径
+    :return: 交易对名称列表
+    """
+    index = get_exchange_info_index(cache_file=cache_file, market=market)
+    if index is None:
+        print("[错误] 无法获取数据: exchangeInfo 不可用")
+        return []
+
+    return [
+        symbol["symbol"] for symbol in index.values()
+        if (quote_asset is None or symbol["quoteAsset"] == quote_asset) and symbol_status(symbol) == "TRADING"
+    ]
+
 def resample_to_higher_freq(df, target_freq='1D'):
     """
     将低级别 K线数据合并成高级别数据
@@ -95,8 +219,8 @@ def resample_to_higher_freq(df, target_freq='1D'):
     :return: 合并后的 DataFrame
     """
 
-    # 确保 Open time 为 datetime 类型
-    df['Open time'] = pd.to_datetime(df['Open time'])
+    # 确保 Open time 为 datetime 类型 (在副本上转换，不修改调用方的数据)
+    df = df.assign(**{'Open time': pd.to_datetime(df['Open time'])})
 
     # 设置 Open time 为索引，以便 resample 操作
     df = df.set_index('Open time')
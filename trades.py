@@ -0,0 +1,385 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from download import resolve_download_start_time
+from exchange_info import get_exchange_info_index
+from intervals import INTERVAL_MILLISECONDS
+from markets import DEFAULT_MARKET, get_market
+from rate_limit import rate_limited_get
+from resample import INTERVAL_OFFSET_MILLISECONDS, RESAMPLED_COLUMNS
+
+# 归集成交保存在市场数据目录下的这个子目录，每个交易对一个目录，每天一个文件
+AGG_TRADES_DIR = "aggTrades"
+
+# 单次请求最多返回的成交条数
+AGG_TRADES_LIMIT = 1000
+
+# 按时间查询时 startTime 和 endTime 之间最多1小时
+AGG_TRADES_WINDOW_MS = 60 * 60 * 1000
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+# 每天的成交按列保存，字段和类型固定
+TRADE_COLUMNS = {
+    "id": np.int64,           # 归集成交 ID
+    "time": np.int64,         # 成交时间，时间戳(毫秒)
+    "price": np.float64,      # 成交价
+    "quantity": np.float64,   # 成交量
+    "trades": np.int64,       # 归集的逐笔成交数量
+    "buyer_maker": np.bool_,  # 买方是否为挂单方 (False 表示主动买入)
+}
+
+# 支持的 bar 类型：按时间、按成交量、按成交额切分
+BAR_TYPES = ("time", "volume", "dollar")
+
+
+def agg_trades_dir(output_dir, symbol, market=DEFAULT_MARKET):
+    """
+    某个交易对的归集成交目录
+    """
+    return os.path.join(get_market(market).data_dir(output_dir), AGG_TRADES_DIR, symbol)
+
+
+def _day_path(directory, day_start):
+    return os.path.join(directory, datetime.fromtimestamp(day_start / 1000, timezone.utc).strftime("%Y-%m-%d") + ".npz")
+
+
+def list_agg_trade_days(output_dir, symbol, start_date=None, end_date=None, market=DEFAULT_MARKET):
+    """
+    列出本地已保存的按天分区
+    :param start_date: 开始日期 "yyyy-mm-dd" (包含)，None 表示不限制
+    :param end_date: 结束日期 "yyyy-mm-dd" (包含)，None 表示不限制
+    :return: 按日期排序的 [(当天开始时间戳(毫秒), 文件路径), ...]
+    """
+    directory = agg_trades_dir(output_dir, symbol, market)
+    if not os.path.exists(directory):
+        return []
+    days = []
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith(".npz"):
+            continue
+        day = file_name[:-len(".npz")]
+        if (start_date is None or day >= start_date) and (end_date is None or day <= end_date):
+            day_start = int(datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() * 1000)
+            days.append((day_start, os.path.join(directory, file_name)))
+    return days
+
+
+def parse_agg_trades(rows):
+    """
+    把 aggTrades 接口返回的 JSON 数组转换为按列存放的 NumPy 数组
+    :return: {字段: 数组}，字段见 TRADE_COLUMNS
+    """
+    return {
+        "id": np.array([row["a"] for row in rows], dtype=np.int64),
+        "time": np.array([row["T"] for row in rows], dtype=np.int64),
+        "price": np.array([row["p"] for row in rows], dtype=np.float64),
+        "quantity": np.array([row["q"] for row in rows], dtype=np.float64),
+        "trades": np.array([row["l"] - row["f"] + 1 for row in rows], dtype=np.int64),
+        "buyer_maker": np.array([row["m"] for row in rows], dtype=np.bool_),
+    }
+
+
+def get_agg_trades_page(symbol, from_id=None, start_time=None, end_time=None, market=DEFAULT_MARKET):
+    """
+    请求一页归集成交。与K线不同，失败时直接抛出异常：按天保存的分区必须完整，不能把失败当作没有数据
+    :param from_id: 从这个归集成交 ID 开始 (包含)
+    :param start_time: 开始时间，时间戳(毫秒)，与 end_time 之间最多1小时
+    :param end_time: 结束时间，时间戳(毫秒) (包含)
+    :return: 接口返回的成交列表
+    """
+    market = get_market(market)
+    params = {"symbol": symbol, "limit": AGG_TRADES_LIMIT}
+    if from_id is not None:
+        params["fromId"] = from_id
+    else:
+        params["startTime"] = start_time
+        params["endTime"] = end_time
+    response = rate_limited_get(market.agg_trades_url, params=params, weight=market.agg_trades_weight, limiter=market.limiter)
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_agg_trades_day(symbol, day_start, market=DEFAULT_MARKET):
+    """
+    下载一个 UTC 自然日的全部归集成交：先按1小时窗口找到当天第一笔成交，之后按 fromId 连续翻页
+    (fromId 翻页不受1小时限制，每页都是满的)，直到成交时间超过当天结束
+    :param day_start: 当天开始时间，时间戳(毫秒)
+    :return: {字段: 数组}
+    """
+    day_end = day_start + DAY_MS
+    rows = []
+    window_start = day_start
+    while not rows and window_start < day_end:
+        rows = get_agg_trades_page(symbol, start_time=window_start,
+                                   end_time=min(window_start + AGG_TRADES_WINDOW_MS, day_end) - 1, market=market)
+        window_start += AGG_TRADES_WINDOW_MS
+
+    pages = []
+    while rows:
+        pages.append(parse_agg_trades(rows))
+        if rows[-1]["T"] >= day_end:
+            break
+        rows = get_agg_trades_page(symbol, from_id=rows[-1]["a"] + 1, market=market)
+
+    if not pages:
+        return {field: np.empty(0, dtype=dtype) for field, dtype in TRADE_COLUMNS.items()}
+    columns = {field: np.concatenate([page[field] for page in pages]) for field in TRADE_COLUMNS}
+    keep = columns["time"] < day_end
+    return {field: values[keep] for field, values in columns.items()}
+
+
+def save_agg_trades_day(path, columns):
+    """
+    保存一天的成交 (先写临时文件再改名，中断时不会留下不完整的分区)
+    """
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        np.savez(f, **{field: np.asarray(columns[field], dtype=dtype) for field, dtype in TRADE_COLUMNS.items()})
+    os.replace(temp_path, path)
+
+
+def load_agg_trades_day(path, fields=None):
+    """
+    读取一天的成交，只读取需要的字段
+    :return: {字段: 数组}
+    """
+    with np.load(path) as data:
+        return {field: data[field] for field in (fields or TRADE_COLUMNS)}
+
+
+def load_agg_trades(output_dir, symbol, start_date=None, end_date=None, fields=None, market=DEFAULT_MARKET):
+    """
+    读取一段时间的归集成交
+    :param start_date: 开始日期 "yyyy-mm-dd" (包含)
+    :param end_date: 结束日期 "yyyy-mm-dd" (包含)
+    :param fields: 需要的字段，默认全部
+    :return: DataFrame，time 为毫秒时间戳
+    """
+    fields = list(fields or TRADE_COLUMNS)
+    days = [load_agg_trades_day(path, fields) for _, path in list_agg_trade_days(output_dir, symbol, start_date, end_date, market)]
+    if not days:
+        return pd.DataFrame({field: np.empty(0, dtype=TRADE_COLUMNS[field]) for field in fields})
+    return pd.DataFrame({field: np.concatenate([day[field] for day in days]) for field in fields})
+
+
+def download_agg_trades(symbols, start_date, end_date, output_dir="./binance_data", max_workers=5, market=DEFAULT_MARKET):
+    """
+    按天下载多个交易对的归集成交，每个 (交易对, 日期) 是一个独立任务，已经存在的日期直接跳过。
+    只下载已经结束的 UTC 自然日，当天的数据等第二天再下载。
+    :param symbols: 交易对列表，例如 ["BTCUSDT", "ETHUSDT"]
+    :param start_date: 开始日期，例如 2024-01-01
+    :param end_date: 结束日期 (包含)，例如 2024-01-31
+    :param output_dir: 数据保存的目录 (成交保存在 {目录}/aggTrades/{symbol}/{yyyy-mm-dd}.npz)
+    :param max_workers: 并发线程数 (所有请求共用市场的限速器)
+    :param market: 市场 "spot" / "um" (默认) / "cm"
+    :return: 失败的 [(symbol, 日期), ...]
+    """
+    market = get_market(market)
+    start_time = int(datetime.strptime(start_date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() * 1000)
+    end_time = int(datetime.strptime(end_date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() * 1000)
+    # 最后一个已经结束的自然日
+    last_day = (int(datetime.now(timezone.utc).timestamp() * 1000) // DAY_MS - 1) * DAY_MS
+    end_time = min(end_time, last_day)
+
+    get_exchange_info_index(market=market)
+    jobs = []
+    for symbol in symbols:
+        current_start_time = resolve_download_start_time(symbol, start_time, end_time + DAY_MS - 1, market)
+        if current_start_time is None:
+            continue
+        directory = agg_trades_dir(output_dir, symbol, market)
+        for day_start in range(current_start_time // DAY_MS * DAY_MS, end_time + 1, DAY_MS):
+            path = _day_path(directory, day_start)
+            if not os.path.exists(path):
+                jobs.append((symbol, day_start, path))
+    print(f"[信息] 共 {len(jobs)} 个交易日需要下载")
+
+    def download_day(symbol, day_start, path):
+        columns = fetch_agg_trades_day(symbol, day_start, market)
+        save_agg_trades_day(path, columns)
+        return len(columns["id"])
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download_day, *job): job for job in jobs}
+        for future in as_completed(futures):
+            symbol, _, path = futures[future]
+            day = os.path.basename(path)[:-len(".npz")]
+            try:
+                print(f"[完成] {symbol} {day} 共 {future.result()} 笔归集成交")
+            except Exception as e:
+                print(f"[错误] 下载 {symbol} {day} 成交时出错: {e}")
+                failed.append((symbol, day))
+
+    print(f"[总结] 成功下载 {len(jobs) - len(failed)} 个交易日，失败 {len(failed)} 个。")
+    if failed:
+        print(f"[失败列表]: {failed}")
+    return failed
+
+
+def _bar_size(bar_type, size):
+    """
+    time bar 的周期转换为毫秒：支持币安的周期写法 ("1m", "4h") 以及任意 pandas 时间间隔 ("30s", "7min")
+    """
+    if bar_type not in BAR_TYPES:
+        raise ValueError(f"未知的 bar 类型 {bar_type}，可选: {', '.join(BAR_TYPES)}")
+    if bar_type != "time":
+        return float(size)
+    if isinstance(size, str):
+        return INTERVAL_MILLISECONDS.get(size) or int(pd.Timedelta(size) / pd.Timedelta(milliseconds=1))
+    return int(size)
+
+
+def _time_bar_offset(step):
+    """
+    time bar 起点相对 1970-01-01 的偏移，与 resample 相同：长度为整周的 bar ("1w"、"7d") 从周一开始
+    """
+    for interval, offset in INTERVAL_OFFSET_MILLISECONDS.items():
+        if step % INTERVAL_MILLISECONDS[interval] == 0:
+            return offset
+    return 0
+
+
+def _reduce_bars(bar_ids, columns):
+    """
+    把 bar 编号相同的连续行合并成一根 bar，输入可以是成交，也可以是已经合并过的部分 bar
+    :param bar_ids: 每行所属的 bar 编号 (非递减)
+    :param columns: {字段: 数组}，字段名与 RESAMPLED_COLUMNS 一致，另有 first_time / last_time
+    :return: {字段: 数组}，增加 bar 字段
+    """
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bar_ids)) + 1))
+    ends = np.concatenate((starts[1:], [len(bar_ids)])) - 1
+    bars = {
+        "bar": bar_ids[starts],
+        "first_time": columns["first_time"][starts],
+        "last_time": columns["last_time"][ends],
+        "Open": columns["Open"][starts],
+        "High": np.maximum.reduceat(columns["High"], starts),
+        "Low": np.minimum.reduceat(columns["Low"], starts),
+        "Close": columns["Close"][ends],
+    }
+    for field in ("Volume", "Quote asset volume", "Number of trades", "Taker buy base asset volume", "Taker buy quote asset volume"):
+        bars[field] = np.add.reduceat(columns[field], starts)
+    return bars
+
+
+def trades_to_bars(trades, bar_type="time", size="1m", offset=0.0):
+    """
+    用 NumPy 把成交合并成 bar (不经过 pandas 分组)
+    :param trades: {字段: 数组}，按时间排序
+    :param bar_type: "time" 按时间 / "volume" 按成交量 / "dollar" 按成交额
+    :param size: time bar 的周期 (例如 "1m"、"30s"、毫秒数)；volume / dollar bar 每根的成交量 / 成交额
+    :param offset: volume / dollar bar 在这批成交之前已经累计的成交量 / 成交额，用于多天连续编号
+    :return: 部分 bar 的 {字段: 数组}，bar 字段为编号；没有成交时返回 None
+    """
+    size = _bar_size(bar_type, size)
+    if len(trades["time"]) == 0:
+        return None
+
+    price, quantity = trades["price"], trades["quantity"]
+    quote = price * quantity
+    if bar_type == "time":
+        bar_ids = (trades["time"] - _time_bar_offset(size)) // size
+    else:
+        # 每笔成交之前的累计量决定它属于哪根 bar，跨过阈值的那笔成交计入当前 bar
+        amount = quantity if bar_type == "volume" else quote
+        bar_ids = ((offset + np.cumsum(amount) - amount) // size).astype(np.int64)
+
+    taker_buy = ~trades["buyer_maker"]
+    return _reduce_bars(bar_ids, {
+        "first_time": trades["time"],
+        "last_time": trades["time"],
+        "Open": price,
+        "High": price,
+        "Low": price,
+        "Close": price,
+        "Volume": quantity,
+        "Quote asset volume": quote,
+        "Number of trades": trades["trades"],
+        "Taker buy base asset volume": np.where(taker_buy, quantity, 0.0),
+        "Taker buy quote asset volume": np.where(taker_buy, quote, 0.0),
+    })
+
+
+def _day_total(path, bar_type):
+    """
+    一天的总成交量 / 总成交额 (只读取需要的字段)
+    """
+    if bar_type == "volume":
+        return float(load_agg_trades_day(path, ["quantity"])["quantity"].sum())
+    data = load_agg_trades_day(path, ["price", "quantity"])
+    return float(np.dot(data["price"], data["quantity"]))
+
+
+def _day_bars(path, bar_type, size, offset):
+    return trades_to_bars(load_agg_trades_day(path), bar_type, size, offset)
+
+
+def build_bars(output_dir, symbol, bar_type="time", size="1m", start_date=None, end_date=None, max_workers=None,
+               market=DEFAULT_MARKET):
+    """
+    从本地归集成交生成任意粒度的 time / volume / dollar bar，每天的成交在独立进程中合并。
+    跨天的 bar (例如 7m 的 time bar、或者跨过零点的 volume bar) 在最后一步合并，结果与整段一起计算相同。
+    time bar 只输出有成交的周期，不补空行。
+
+    :param output_dir: 数据目录 (与 download_agg_trades 相同)
+    :param symbol: 交易对
+    :param bar_type: "time" / "volume" / "dollar"
+    :param size: time bar 的周期 (例如 "1m"、"30s"、"7min")；volume / dollar bar 每根的成交量 / 成交额
+    :param start_date: 开始日期 "yyyy-mm-dd" (包含)，None 表示从第一天开始
+    :param end_date: 结束日期 "yyyy-mm-dd" (包含)，None 表示到最后一天
+    :param max_workers: 进程数，默认等于 CPU 核数
+    :param market: 市场 "spot" / "um" (默认) / "cm"
+    :return: 与下载的K线格式相同的 DataFrame (Open time / Close time 为 datetime)
+    """
+    step = _bar_size(bar_type, size)
+    paths = [path for _, path in list_agg_trade_days(output_dir, symbol, start_date, end_date, market)]
+    if not paths:
+        print(f"[警告] 未发现 {symbol} 的成交数据")
+        return pd.DataFrame(columns=RESAMPLED_COLUMNS)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # volume / dollar bar 的编号依赖之前所有成交的累计量，先并行算出每天的总量，再确定每天的起始累计量
+        offsets = [0.0] * len(paths)
+        if bar_type != "time":
+            totals = list(executor.map(_day_total, paths, [bar_type] * len(paths)))
+            offsets = np.concatenate(([0.0], np.cumsum(totals)[:-1])).tolist()
+        days = [day for day in executor.map(_day_bars, paths, [bar_type] * len(paths), [size] * len(paths), offsets)
+                if day is not None]
+
+    if not days:
+        return pd.DataFrame(columns=RESAMPLED_COLUMNS)
+    # 相邻两天编号相同的部分 bar 合并成一根
+    merged = {field: np.concatenate([day[field] for day in days]) for field in days[0]}
+    bars = _reduce_bars(merged["bar"], merged)
+
+    if bar_type == "time":
+        open_times = bars["bar"] * step + _time_bar_offset(step)
+        close_times = open_times + step - 1
+    else:
+        open_times, close_times = bars["first_time"], bars["last_time"]
+    bars["Open time"] = open_times.astype("datetime64[ms]")
+    bars["Close time"] = close_times.astype("datetime64[ms]")
+    return pd.DataFrame({column: bars[column] for column in RESAMPLED_COLUMNS})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="按天下载归集成交 (aggTrades)")
+    parser.add_argument("data_dir", help="数据目录")
+    parser.add_argument("start_date", help="开始日期，例如 2024-01-01")
+    parser.add_argument("end_date", help="结束日期 (包含)，例如 2024-01-31")
+    parser.add_argument("symbols", nargs="+", help="交易对列表")
+    parser.add_argument("--workers", type=int, default=5, help="并发线程数")
+    parser.add_argument("--market", default=DEFAULT_MARKET, help="市场 spot / um / cm")
+    args = parser.parse_args()
+
+    download_agg_trades(args.symbols, args.start_date, args.end_date, args.data_dir, max_workers=args.workers, market=args.market)